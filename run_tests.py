@@ -12,6 +12,16 @@ from tests.test_redirect_checker import RedirectCheckerTestCase
 from tests.test_utils import UtilsTestCase
 from tests.test_worker import WorkerTestCase
 from tests.test_lib_init import InitLibTestCase
+from tests.test_engine import EngineTestCase
+from tests.test_cache import CacheTestCase
+from tests.test_scheduler import SchedulerTestCase
+from tests.test_tubes import TubesTestCase
+from tests.test_supervisor import SupervisorTestCase
+from tests.test_autoscaler import AutoscalerTestCase
+from tests.test_health import HealthTestCase
+from tests.test_connections import ConnectionsTestCase
+from tests.test_retry import RetryTestCase
+from tests.test_pipeline import PipelineTestCase
 
 
 if __name__ == '__main__':
@@ -21,6 +31,16 @@ if __name__ == '__main__':
         unittest.makeSuite(UtilsTestCase),
         unittest.makeSuite(WorkerTestCase),
         unittest.makeSuite(InitLibTestCase),
+        unittest.makeSuite(EngineTestCase),
+        unittest.makeSuite(CacheTestCase),
+        unittest.makeSuite(SchedulerTestCase),
+        unittest.makeSuite(TubesTestCase),
+        unittest.makeSuite(SupervisorTestCase),
+        unittest.makeSuite(AutoscalerTestCase),
+        unittest.makeSuite(HealthTestCase),
+        unittest.makeSuite(ConnectionsTestCase),
+        unittest.makeSuite(RetryTestCase),
+        unittest.makeSuite(PipelineTestCase),
     ))
     result = unittest.TextTestRunner().run(suite)
     sys.exit(not result.wasSuccessful())
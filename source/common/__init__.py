@@ -0,0 +1,11 @@
+# coding: utf-8
+# Shared by the checker and the pusher; nothing here may import pycurl, the pusher runs without it.
+
+# causes of a failed request, see lib.get_error_class
+ERROR_DNS = 'dns'
+ERROR_CONNECT = 'connect'
+ERROR_TIMEOUT = 'timeout'
+ERROR_TLS = 'tls'
+ERROR_HTTP_5XX = 'http_5xx'
+ERROR_PARSE = 'parse'
+ERROR_OTHER = 'other'
@@ -0,0 +1,67 @@
+# coding: utf-8
+import socket
+
+from tarantool.error import DatabaseError, NetworkError
+from tarantool.request import RequestCall
+from tarantool.response import Response
+
+
+def exchange_packet(connection, packet, count):
+    """Отправляет пакет запросов и читает count ответов"""
+    connection._opt_reconnect()
+    try:
+        connection._socket.sendall(packet)
+        return [connection._read_response() for _ in xrange(count)]
+    except (socket.error, NetworkError):
+        # unread responses would be taken as answers to the next requests
+        if connection._socket:
+            connection.close()
+        raise
+
+
+def call_pipelined(connection, calls):
+    """
+    Выполняет несколько CALL запросов за один обмен с сервером.
+
+    Запросы отправляются одним пакетом, ответы читаются в том же порядке.
+    Соединение с методом execute (lib.connections.ReconnectingConnection) выполняет обмен
+    под своей блокировкой и повторяет его после переподключения.
+
+    :param calls: список (имя функции, аргументы)
+    :return: список Response или DatabaseError по каждому запросу
+    """
+    if not calls:
+        return []
+
+    packet = ''.join(bytes(RequestCall(connection, name, args, True)) for name, args in calls)
+    execute = getattr(connection, 'execute', None)
+    if execute is not None:
+        raw_responses = execute(exchange_packet, connection, packet, len(calls))
+    else:
+        raw_responses = exchange_packet(connection, packet, len(calls))
+
+    responses = []
+    for header, body in raw_responses:
+        try:
+            response = Response(connection, header, body)
+        except DatabaseError as e:
+            response = e
+        else:
+            if response.completion_status != 0:
+                response = DatabaseError(response.return_code, response.return_message)
+        responses.append(response)
+    return responses
+
+
+def get_put_args(tube, data, **kwargs):
+    """:return: аргументы queue.put, как их формирует Tube.put"""
+    opt = dict(tube.opt, **kwargs)
+    return (
+        str(tube.queue.space),
+        str(opt['tube']),
+        str(opt['delay']),
+        str(opt['ttl']),
+        str(opt['ttr']),
+        str(opt['pri']),
+        tube.serialize(data)
+    )
@@ -0,0 +1,45 @@
+# coding: utf-8
+import random
+
+from . import (ERROR_CONNECT, ERROR_DNS, ERROR_HTTP_5XX, ERROR_OTHER, ERROR_PARSE, ERROR_TIMEOUT,
+               ERROR_TLS)
+
+# error class -> (retries, delay before the first retry in seconds)
+RETRY_POLICIES = {
+    ERROR_DNS: (1, 600),
+    ERROR_CONNECT: (2, 60),
+    ERROR_TIMEOUT: (2, 30),
+    ERROR_TLS: (0, 0),
+    ERROR_HTTP_5XX: (3, 30),
+    ERROR_PARSE: (0, 0),
+    ERROR_OTHER: (1, 60),
+}
+RETRY_DELAY_MAX = 3600
+RETRY_JITTER = 0.5
+
+
+class RetryPolicy(object):
+    """
+    Решает, повторять ли проверку, закончившуюся ошибкой, и через сколько.
+
+    Для каждого класса ошибки policies задает число повторов и задержку перед первым,
+    перед каждым следующим повтором задержка удваивается до delay_max.
+    Задержка случайно уменьшается до jitter своей доли, чтобы повторы одновременно упавших задач
+    не приходили разом. Ошибки без своей политики повторяются по политике ERROR_OTHER.
+    """
+
+    def __init__(self, policies=RETRY_POLICIES, delay_max=RETRY_DELAY_MAX, jitter=RETRY_JITTER):
+        self.policies = policies
+        self.delay_max = delay_max
+        self.jitter = jitter
+
+    def get_delay(self, error_class, attempt):
+        """
+        :param attempt: номер повтора, начиная с 1
+        :return: задержка перед повтором в секундах или None, если повторять не нужно
+        """
+        retries, delay = self.policies.get(error_class, self.policies.get(ERROR_OTHER, (0, 0)))
+        if attempt > retries:
+            return None
+        delay = min(delay * 2 ** (attempt - 1), self.delay_max)
+        return int(delay * (1 - self.jitter * random.random()))
@@ -13,16 +13,99 @@ OUTPUT_QUEUE_SPACE = 0
 OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
 WORKER_POOL_SIZE = 10
+# size the pool between WORKER_POOL_MIN and WORKER_POOL_MAX by the input queue statistics instead of WORKER_POOL_SIZE
+AUTOSCALE = False
+WORKER_POOL_MIN = 2
+WORKER_POOL_MAX = 20
+# ready tasks should be checked within this many seconds
+AUTOSCALE_BACKLOG_TIME = 60
+# the pool shrinks only when this share of it is enough for AUTOSCALE_DOWN_DELAY seconds
+AUTOSCALE_DOWN_RATIO = 0.7
+AUTOSCALE_DOWN_DELAY = 300
+# tasks checked simultaneously by one worker process, 1 to check them one by one
+WORKER_CONCURRENCY = 1
+# workers take and ack tasks in pipelined batches
+QUEUE_TAKE_BATCH = 10
+ACK_BATCH_SIZE = 10
+ACK_LINGER = 0.1
+# results are written to the queues in pipelined batches, tasks are acked after their results are written
+OUTPUT_BATCH_SIZE = 10
+OUTPUT_LINGER = 0.1
 QUEUE_TAKE_TIMEOUT = 0.1
+# tasks taken ahead by a background thread of the one by one worker, 0 to take them on demand;
+# tasks waiting longer than QUEUE_PREFETCH_TOUCH seconds are touched so that their ttr does not expire
+QUEUE_PREFETCH = 2
+QUEUE_PREFETCH_TOUCH = 10
+# tubes on the same host, port and space share one connection,
+# a broken connection is reestablished with a delay growing up to QUEUE_RECONNECT_DELAY_MAX
+QUEUE_RECONNECT_DELAY = 0.1
+QUEUE_RECONNECT_DELAY_MAX = 10
+QUEUE_RECONNECT_ATTEMPTS = 10
 
 SLEEP = 10
 
+# workers exiting sooner than WORKER_MIN_UPTIME after start are respawned with a growing delay
+RESPAWN_DELAY = 1
+RESPAWN_DELAY_MAX = 60
+WORKER_MIN_UPTIME = 10
+# on shutdown workers finish or release their tasks, the ones still running after this are killed
+DRAIN_TIMEOUT = 30
+
+# timeout of one request and of connecting to the server, seconds
 HTTP_TIMEOUT = 3
+HTTP_CONNECT_TIMEOUT = 1
 MAX_REDIRECTS = 30
-RECHECK_DELAY = 300
+# time budget of the whole redirect chain, requests are cut to what remains of it,
+# a chain out of budget is reported as far as it got, ending with TIMEOUT
+TASK_DEADLINE = 15
+# enough for meta refresh and counters detection, the rest of the page is not read
+MAX_CONTENT_SIZE = 512 * 1024
+# failed checks are retried depending on the error class:
+# class -> (retries, delay before the first retry), the delay doubles with each retry up to RETRY_DELAY_MAX
+# and is randomly shortened by up to RETRY_JITTER of itself
+RETRY_POLICIES = {
+    'dns': (1, 600),
+    'connect': (2, 60),
+    'timeout': (2, 30),
+    'tls': (0, 0),
+    'http_5xx': (3, 30),
+    'parse': (0, 0),
+    'other': (1, 60),
+}
+RETRY_DELAY_MAX = 3600
+RETRY_JITTER = 0.5
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
-CHECK_URL = "http://t.mail.ru"
+# the network is up while any of these urls responds
+CHECK_URLS = ["http://t.mail.ru", "http://mail.ru", "http://ya.ru"]
+# consecutive checks needed to pause workers when the network goes down and to resume them
+NETWORK_DOWN_AFTER = 2
+NETWORK_UP_AFTER = 2
+
+# host-wide DNS cache shared by all workers, None to disable
+DNS_CACHE_PATH = '/tmp/redirect_checker_dns.sqlite'
+DNS_CACHE_SIZE = 10000
+DNS_CACHE_TTL = 300
+DNS_CACHE_NEGATIVE_TTL = 30
+
+# host-wide cache of redirect chains by start url, None to disable
+RESULT_CACHE_PATH = '/tmp/redirect_checker_results.sqlite'
+RESULT_CACHE_SIZE = 100000
+RESULT_CACHE_TTL = 600
+
+# host-wide cache of single redirects (url -> next url), None to disable
+HOP_CACHE_PATH = '/tmp/redirect_checker_hops.sqlite'
+HOP_CACHE_SIZE = 100000
+HOP_CACHE_TTL = 120
+
+# host-wide per-site politeness: in-flight limit and backoff after failed checks, None to disable
+HOST_SCHEDULER_PATH = '/tmp/redirect_checker_hosts.sqlite'
+HOST_MAX_IN_FLIGHT = 2
+HOST_BACKOFF = 10
+HOST_BACKOFF_MAX = 300
+# tasks of a busy host go back to the queue for this long
+HOST_DEFER_DELAY = 5
+HOST_SLOT_TTL = TASK_DEADLINE
 
 LOGGING = {
     'version': 1,
@@ -4,11 +4,39 @@ from codecs import getwriter
 QUEUE_HOST = 'localhost'
 QUEUE_PORT = 33013
 QUEUE_SPACE = 0
-QUEUE_TAKE_TIMEOUT = 0.1
+QUEUE_TAKE_TIMEOUT = 1
+# the dispatcher waits for a task in takes of this many seconds and the acker shares their connection,
+# so the poll bounds how long finished tasks wait for ack on an idle queue
+QUEUE_TAKE_POLL = 0.1
 QUEUE_TUBE = 'api.push_notifications'
 
 HTTP_CONNECTION_TIMEOUT = 30
-SLEEP = 0.1
+# keep-alive connections per callback host, sessions of hosts idle for HTTP_POOL_IDLE_TIMEOUT seconds are closed
+HTTP_POOL_SIZE = 10
+HTTP_POOL_IDLE_TIMEOUT = 60
+# requests per second and burst per callback host, tasks over the limit are returned to the queue with a delay
+HTTP_HOST_RATE = 50
+HTTP_HOST_BURST = 20
+# requests to a callback host stop for CIRCUIT_OPEN_TIME seconds when CIRCUIT_ERROR_RATE of its last
+# CIRCUIT_WINDOW requests (at least CIRCUIT_MIN_REQUESTS) failed or took CIRCUIT_SLOW_TIME seconds or more
+CIRCUIT_WINDOW = 20
+CIRCUIT_MIN_REQUESTS = 5
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_SLOW_TIME = 10
+CIRCUIT_OPEN_TIME = 30
+# failed pushes are put to the queue again with a delay depending on the error class:
+# class -> (retries, delay before the first retry), the delay doubles with each retry up to RETRY_DELAY_MAX
+# and is randomly shortened by up to RETRY_JITTER of itself, a task out of retries is buried.
+# Only failed pushes count as attempts, tasks postponed for an unavailable callback host do not
+RETRY_POLICIES = {
+    'connect': (5, 30),
+    'timeout': (5, 30),
+    'http_5xx': (5, 60),
+    'http_4xx': (0, 0),
+    'other': (3, 60),
+}
+RETRY_DELAY_MAX = 3600
+RETRY_JITTER = 0.5
 SLEEP_ON_FAIL = 10
 
 WORKER_POOL_SIZE = 10
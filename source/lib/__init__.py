@@ -1,35 +1,162 @@
 # coding: utf-8
+from HTMLParser import HTMLParser
 from StringIO import StringIO
 from logging import getLogger, NullHandler
+import os
 import re
+import time
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
 
-from bs4 import BeautifulSoup
 import pycurl
 
+from common import (ERROR_CONNECT, ERROR_DNS, ERROR_HTTP_5XX, ERROR_OTHER, ERROR_PARSE, ERROR_TIMEOUT,
+                    ERROR_TLS)
+
 logger = getLogger('redirect_checker')
 logger.addHandler(NullHandler())
 
 REDIRECT_META = 'meta_tag'
 REDIRECT_HTTP = 'http_status'
+REDIRECT_ERROR = 'ERROR'
+# the check ran out of its time budget, the chain is known only up to this point
+REDIRECT_TIMEOUT = 'TIMEOUT'
+
+
+CURL_ERROR_CLASSES = {
+    pycurl.E_COULDNT_RESOLVE_HOST: ERROR_DNS,
+    pycurl.E_COULDNT_RESOLVE_PROXY: ERROR_DNS,
+    pycurl.E_COULDNT_CONNECT: ERROR_CONNECT,
+    pycurl.E_OPERATION_TIMEDOUT: ERROR_TIMEOUT,
+    pycurl.E_SSL_CONNECT_ERROR: ERROR_TLS,
+    pycurl.E_SSL_PEER_CERTIFICATE: ERROR_TLS,
+    pycurl.E_SSL_CERTPROBLEM: ERROR_TLS,
+    pycurl.E_SSL_CIPHER: ERROR_TLS,
+    pycurl.E_SSL_CACERT_BADFILE: ERROR_TLS,
+    pycurl.E_SSL_SHUTDOWN_FAILED: ERROR_TLS,
+    pycurl.E_URL_MALFORMAT: ERROR_PARSE,
+    pycurl.E_UNSUPPORTED_PROTOCOL: ERROR_PARSE,
+    pycurl.E_BAD_CONTENT_ENCODING: ERROR_PARSE,
+}
 
 OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.I)
 OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
 MM_URL = re.compile(r'http(?:s)?://my\.mail\.ru/apps/', re.I)
 
+# tokens of the document head which matter for meta redirect detection,
+# comments and raw text elements are matched whole to skip the markup-like text inside them
+HEAD_TOKEN_RE = re.compile(
+    r'(?P<skip><!--.*?-->|<(?P<raw>script|style|title)\b.*?</(?P=raw)\s*>)'
+    r'|<meta\b(?P<attrs>(?:[^>"\']|"[^"]*"|\'[^\']*\')*)>|</head\s*>|<body\b',
+    re.I | re.S
+)
+TAG_ATTR_RE = re.compile(r'''([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+
+html_parser = HTMLParser()
+
+# printable ASCII is kept in the query as is, everything else is percent-quoted to keep prepared urls ASCII
+QUERY_SAFE = ''.join(chr(code) for code in xrange(33, 127))
+
+# memoized prepare_url results and IDNA-encoded hosts, bounded by URL_CACHE_SIZE
+prepared_urls = {}
+idna_hosts = {}
+
+# lowercase substrings, looked up case-insensitively
 COUNTER_TYPES = (
-    ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I+re.S)),
-    ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top-fwz1\.mail\.ru/counter.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top\.mail\.ru/jump\?from.*', re.I+re.S)),
-    ('DOUBLECLICK', re.compile(r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*', re.I+re.S)),
-    ('VISUALDNA', re.compile(r'.*//a1\.vdna-assets\.com/analytics\.js.*', re.I+re.S)),
-    ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I+re.S)),
-    ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I+re.S))
+    ('GOOGLE_ANALYTICS', 'google-analytics.com/ga.js'),
+    ('YA_METRICA', 'mc.yandex.ru/metrika/watch.js'),
+    ('TOP_MAIL_RU', 'top-fwz1.mail.ru/counter'),
+    ('TOP_MAIL_RU', 'top.mail.ru/jump?from'),
+    ('DOUBLECLICK', '//googleads.g.doubleclick.net/pagead/viewthroughconversion'),
+    ('VISUALDNA', '//a1.vdna-assets.com/analytics.js'),
+    ('LI_RU', '/counter.yadro.ru/hit'),
+    ('RAMBLER_TOP100', 'counter.rambler.ru/top100')
 )
 
 
+def trie_regex(words):
+    """
+    Собирает регулярку, находящую любую из строк words.
+
+    Строки объединяются в префиксное дерево, поэтому в каждой позиции текста
+    проверяется только ветка, начинающаяся с текущего символа,
+    и время поиска почти не зависит от количества строк.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        if node.keys() == ['']:
+            return ''
+        alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if len(alternatives) == 1 and '' not in node:
+            return alternatives[0]
+        result = '(?:{})'.format('|'.join(alternatives))
+        return result + '?' if '' in node else result
+
+    return re.compile(build(trie))
+
+
+# the lookahead matches at every position, so signatures overlapping or nested in another one are found too
+COUNTERS_RE = re.compile('(?=({}))'.format(trie_regex(signature for _, signature in COUNTER_TYPES).pattern))
+
+CURL_POOL_SIZE = 10
+URL_CACHE_SIZE = 10000
+MAX_CONTENT_SIZE = 512 * 1024
+# a redirect body up to this size is read to the end, so the connection stays open for the next hop
+MAX_REDIRECT_BODY_SIZE = 4 * 1024
+
+
+class HttpServerError(Exception):
+    """Сервер ответил статусом 5xx"""
+
+
+class RedirectError(str):
+    """
+    Тип перехода ERROR с причиной ошибки.
+
+    Равен строке 'ERROR', поэтому в истории редиректов неотличим от нее,
+    причина (одна из ERROR_*) хранится в error_class.
+    """
+
+    def __new__(cls, error_class):
+        error = str.__new__(cls, REDIRECT_ERROR)
+        error.error_class = error_class
+        return error
+
+
+def get_error_class(e):
+    """:return: причина ошибки запроса, одна из ERROR_*"""
+    if isinstance(e, HttpServerError):
+        return ERROR_HTTP_5XX
+    if isinstance(e, ValueError):
+        return ERROR_PARSE
+    if not isinstance(e, pycurl.error) or not e.args:
+        return ERROR_OTHER
+
+    error_class = CURL_ERROR_CLASSES.get(e.args[0], ERROR_OTHER)
+    if error_class == ERROR_TIMEOUT and len(e.args) > 1:
+        # curl reports the stage which timed out only in the message
+        message = str(e.args[1]).lower()
+        if message.startswith('resolving'):
+            error_class = ERROR_DNS
+        elif message.startswith('connection'):
+            error_class = ERROR_CONNECT
+    return error_class
+
+
+def get_history_error(history_types):
+    """:return: причина ошибки, которой закончилась цепочка, или None"""
+    for redirect_type in history_types:
+        if redirect_type == REDIRECT_ERROR:
+            return getattr(redirect_type, 'error_class', ERROR_OTHER)
+    return None
+
+
 def to_unicode(val, errors='strict'):
     return val if isinstance(val, unicode) else val.decode('utf8', errors=errors)
 
@@ -41,32 +168,53 @@ def to_str(val, errors='strict'):
 def get_counters(content):
     """
     Ищет в хтмл-странице счетичик и возвращает массив типов найденных
+
+    Все сигнатуры COUNTER_TYPES ищутся за один проход по странице.
+    В каждой позиции находится самая длинная сигнатура, более короткие с того же места - ее префиксы.
     """
-    counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
-            counters.append(counter_name)
-    return counters
+    found = set(match.group(1) for match in COUNTERS_RE.finditer(content.lower()))
+    return [
+        counter_name for counter_name, signature in COUNTER_TYPES
+        if any(text.startswith(signature) for text in found)
+    ]
+
+
+def get_tag_attrs(attrs_text):
+    """Разбирает атрибуты тега в словарь с именами в нижнем регистре"""
+    attrs = {}
+    for name, double_quoted, single_quoted, unquoted in TAG_ATTR_RE.findall(attrs_text):
+        attrs.setdefault(name.lower(), double_quoted or single_quoted or unquoted)
+    return attrs
 
 
 def check_for_meta(content, url):
     """
     Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
+
+    Просматриваются только мета-теги до </head> или <body>, не считая текста комментариев,
+    скриптов, стилей и заголовка, поиск заканчивается на первом теге с http-equiv="refresh".
     """
-    soup = BeautifulSoup(content, "html.parser")
-    result = soup.find("meta")
-    if result and 'content' in result.attrs:
-        for attr, value in result.attrs.items():
-            if attr == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
-                if len(splitted) != 2:
-                    return
-                wait, text = splitted
-                text = text.strip()
-                m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
-                if m:
-                    meta_url = m.groups()[0]
-                    return urljoin(url, to_unicode(meta_url, 'ignore'))
+    for token in HEAD_TOKEN_RE.finditer(content):
+        if token.group('skip'):
+            continue
+        attrs_text = token.group('attrs')
+        if attrs_text is None:
+            return
+
+        attrs = get_tag_attrs(attrs_text)
+        if 'content' not in attrs or attrs.get('http-equiv', '').lower() != 'refresh':
+            continue
+
+        splitted = html_parser.unescape(to_unicode(attrs['content'], 'ignore')).split(";")
+        if len(splitted) != 2:
+            return
+        wait, text = splitted
+        text = text.strip()
+        m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
+        if m:
+            meta_url = m.groups()[0]
+            return urljoin(url, to_unicode(meta_url, 'ignore'))
+        return
 
 
 def fix_market_url(url):
@@ -74,42 +222,216 @@ def fix_market_url(url):
     return 'http://play.google.com/store/apps/' + url[len('market://'):] if url.startswith('market://') else url
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+class CurlPool(object):
+    """
+    Пул переиспользуемых curl-хендлов процесса.
+
+    Хендлы не закрываются между запросами, поэтому сохраняют keep-alive соединения,
+    а кеш DNS и TLS-сессий общий для всех хендлов пула через CurlShare.
+    """
+
+    def __init__(self, size=CURL_POOL_SIZE):
+        self.size = size
+        self.pid = None
+        self.share = None
+        self.handles = []
+
+    def get(self):
+        """Возвращает свободный хендл или создает новый"""
+        self._check_pid()
+        if self.handles:
+            return self.handles.pop()
+        curl = pycurl.Curl()
+        curl.setopt(curl.SHARE, self.share)
+        return curl
+
+    def put(self, curl):
+        """Сбрасывает опции хендла и возвращает его в пул"""
+        if self.pid != os.getpid() or len(self.handles) >= self.size:
+            curl.close()
+            return
+        self.reset(curl)
+        self.handles.append(curl)
+
+    def reset(self, curl):
+        """Сбрасывает опции хендла, сохраняя его соединения и share"""
+        curl.reset()
+
+    def clear(self):
+        for curl in self.handles:
+            curl.close()
+        self.handles = []
+        self.share = None
+        self.pid = None
+
+    def _check_pid(self):
+        # handles and shares must not be used across fork
+        if self.pid != os.getpid():
+            self.handles = []
+            self.share = pycurl.CurlShare()
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            self.pid = os.getpid()
+
+
+curl_pool = CurlPool()
+
+# shared DNS cache (lib.cache.DnsCache) used by requests of the process, see set_dns_cache
+dns_cache = None
+
+
+def set_dns_cache(cache):
+    """Включает общий DNS кеш для запросов текущего процесса"""
+    global dns_cache
+    dns_cache = cache
+
+
+def update_dns_cache(curl, url, errno=None):
+    """Сохраняет в DNS кеш результат резолва выполненного запроса"""
+    if dns_cache is not None:
+        dns_cache.update(curl, url, errno)
+
+
+class ResponseBuffer(object):
+    """
+    Буфер ответа, ограниченный по размеру.
+
+    Тело 30x ответа с заголовком Location не сохраняется: до MAX_REDIRECT_BODY_SIZE байт оно дочитывается,
+    чтобы соединение можно было переиспользовать, больше - чтение останавливается. Тело остальных
+    ответов читается не больше max_size байт. После остановки чтения
+    curl прерывает запрос с ошибкой записи, её нужно игнорировать, если выставлен stopped.
+    Урл редиректа прерванного запроса curl не заполняет, он берется из location.
+    """
+
+    def __init__(self, max_size=MAX_CONTENT_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.buff = StringIO()
+        self.status = None
+        self.is_redirect_status = False
+        self.location = None
+        self.content_length = None
+        self.stopped = False
+
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            # new response (e.g. after 100 Continue), forget previous headers
+            status = line.split(None, 2)[1:2]
+            self.status = int(status[0]) if status and status[0].isdigit() else None
+            self.is_redirect_status = bool(status) and status[0].startswith('3')
+            self.location = None
+            self.content_length = None
+            self.size = 0
+        elif line[:9].lower() == 'location:':
+            self.location = line[9:].strip()
+        elif line[:15].lower() == 'content-length:':
+            value = line[15:].strip()
+            self.content_length = int(value) if value.isdigit() else None
+
+    def write(self, data):
+        if self.is_redirect_status and self.location:
+            self.size += len(data)
+            announced = self.content_length or 0
+            if self.size > MAX_REDIRECT_BODY_SIZE or announced > MAX_REDIRECT_BODY_SIZE:
+                self.stopped = True
+                return 0
+            return
+
+        if self.max_size is not None and self.size + len(data) >= self.max_size:
+            self.buff.write(data[:self.max_size - self.size])
+            self.size = self.max_size
+            self.stopped = True
+            return 0
+
+        self.buff.write(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        return self.buff.getvalue()
+
+
+def setup_curl(curl, url, timeout, buff, useragent=None, connect_timeout=None):
+    """
+    Настраивает curl-хендл на запрос урла (без перехода по редиректам)
 
+    Таймауты задаются в секундах и могут быть дробными.
     """
     prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
     curl.setopt(curl.URL, prepared_url)
+    if dns_cache is not None:
+        dns_cache.apply(curl, prepared_url)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
-    curl.setopt(curl.WRITEDATA, buff)
+    curl.setopt(curl.WRITEFUNCTION, buff.write)
+    curl.setopt(curl.HEADERFUNCTION, buff.header)
     curl.setopt(curl.FOLLOWLOCATION, False)
-    # curl.setopt(curl.CONNECTTIMEOUT, timeout)
-    curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
+    # zero means no timeout for curl, so a budget of less than a millisecond is rounded up
+    if connect_timeout:
+        curl.setopt(curl.CONNECTTIMEOUT_MS, max(int(min(connect_timeout, timeout) * 1000), 1))
+    curl.setopt(curl.TIMEOUT_MS, max(int(timeout * 1000), 1))
+
+
+def read_curl_response(curl, buff):
+    """
+    Возвращает контент ответа и урл редиректа для выполненного хендла
+
+    :raise HttpServerError: на ответ со статусом 5xx
+    """
+    if buff.status is not None and buff.status >= 500:
+        raise HttpServerError('HTTP status {}'.format(buff.status))
     content = buff.getvalue()
-    redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
+    if buff.stopped and buff.is_redirect_status and buff.location:
+        # curl fills REDIRECT_URL only for a completed transfer
+        redirect_url = urljoin(curl.getinfo(curl.EFFECTIVE_URL), buff.location)
+    else:
+        redirect_url = curl.getinfo(curl.REDIRECT_URL)
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
     return content, redirect_url
 
 
-def get_url(url, timeout, user_agent=None):
+def make_pycurl_request(url, timeout, useragent=None, max_size=MAX_CONTENT_SIZE, connect_timeout=None):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа (не больше max_size байт) и возможный редирект
+    :return: содержимое ответа, урл редиректа
+
+    """
+    buff = ResponseBuffer(max_size)
+    curl = curl_pool.get()
+    try:
+        setup_curl(curl, url, timeout, buff, useragent, connect_timeout)
+        try:
+            curl.perform()
+        except pycurl.error as e:
+            if not buff.stopped:
+                if e.args:
+                    update_dns_cache(curl, url, e.args[0])
+                raise
+        update_dns_cache(curl, url)
+        return read_curl_response(curl, buff)
+    finally:
+        curl_pool.put(curl)
+
+
+def get_url(url, timeout, user_agent=None, max_size=MAX_CONTENT_SIZE, connect_timeout=None):
     """
-    :return: урл, тип редиректа, содержимое страницы (если есть)
+    :return: урл, тип редиректа (RedirectError при ошибке), содержимое страницы (если есть)
     """
     content = None
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
-    except (pycurl.error, ValueError) as e:
+        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent, max_size, connect_timeout)
+    except (pycurl.error, ValueError, HttpServerError) as e:
         logger.error(u'error in url {} {}'.format(url, e))
-        return url, 'ERROR', content  # TODO add exception in ERROR
+        return url, RedirectError(get_error_class(e)), content
+
+    return process_response(url, content, new_redirect_url)
+
 
+def process_response(url, content, new_redirect_url):
+    """
+    Определяет следующий урл цепочки по ответу на запрос url
+    :return: урл, тип редиректа, содержимое страницы
+    """
     redirect_type = None
 
     # ignoring ok login redirects
@@ -129,7 +451,82 @@ def get_url(url, timeout, user_agent=None):
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+class RedirectChain(object):
+    """
+    Состояние проверки одной цепочки редиректов.
+
+    Получает результаты запросов по одному через feed(), пока не выставит done.
+    После deadline (time.time()) цепочка заканчивается переходом TIMEOUT.
+    """
+
+    def __init__(self, url, max_redirects=30, deadline=None):
+        self.max_redirects = max_redirects
+        self.deadline = deadline
+        url = prepare_url(url)
+        self.history_types = []
+        self.history_urls = [url]
+        self.next_url = url
+        self.content = None
+
+        # ignore mm / ok domains
+        self.done = bool(re.match(MM_URL, url) or re.match(OK_URL, url))
+
+    def feed(self, redirect_url, redirect_type, content):
+        """Учитывает результат запроса self.next_url"""
+        if redirect_type == REDIRECT_ERROR and self.get_timeout(0) is None:
+            # the request was cut short by the deadline rather than failed,
+            # in whatever stage it was, so curl may report it as a dns or connect error
+            redirect_type = REDIRECT_TIMEOUT
+        self.content = content
+        if not redirect_url:
+            self.done = True
+            return
+
+        self.next_url = redirect_url
+        self.history_types.append(redirect_type)
+        self.history_urls.append(redirect_url)
+
+        if redirect_type in (REDIRECT_ERROR, REDIRECT_TIMEOUT):
+            self.done = True
+        elif len(self.history_urls) > self.max_redirects or (redirect_url in self.history_urls[:-1]):
+            self.done = True
+
+    def get_timeout(self, timeout):
+        """:return: таймаут запроса, урезанный до оставшегося времени, или None, если время вышло"""
+        if self.deadline is None:
+            return timeout
+        remaining = self.deadline - time.time()
+        return min(timeout, remaining) if remaining > 0 else None
+
+    def expire(self):
+        """Заканчивает цепочку, у которой вышло время"""
+        self.feed(self.next_url, REDIRECT_TIMEOUT, None)
+
+    def result(self):
+        """:return: типы редиректов, урлы редиректов, счетчики на конечном урле"""
+        counters = get_counters(self.content) if self.content else []
+        return self.history_types, self.history_urls, counters
+
+
+def follow_cached_hops(chain, hop_cache):
+    """Проходит по цепочке переходы, известные из кеша, без запросов в сеть"""
+    while not chain.done:
+        hop = hop_cache.get(chain.next_url)
+        if hop is None:
+            return
+        redirect_url, redirect_type = hop
+        chain.feed(redirect_url, redirect_type, None)
+
+
+def cache_hop(hop_cache, url, hop):
+    """Запоминает переход с url, если это редирект"""
+    redirect_url, redirect_type, _ = hop
+    if redirect_type in (REDIRECT_HTTP, REDIRECT_META):
+        hop_cache.set(url, [redirect_url, redirect_type])
+
+
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, max_size=MAX_CONTENT_SIZE, hop_cache=None,
+                         deadline=None, connect_timeout=None):
     """
     Входные параметры:
 
@@ -137,62 +534,88 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     + timeout - таймаут на проверку *одного* урла
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
+    + max_size - сколько байт страницы читать для поиска мета-редиректа и счетчиков
+    + hop_cache - кеш переходов (url -> [урл редиректа, тип]), известные переходы не запрашиваются
+    + deadline - сколько секунд можно потратить на всю цепочку, таймаут каждого запроса урезается до остатка
+    + connect_timeout - таймаут на установку соединения
 
 
     Выходные параметры:
     Массив из трех элементов
 
-    1. типы найденных редиректов (варианты: meta_tag, http_status, ERROR)
+    1. типы найденных редиректов (варианты: meta_tag, http_status, ERROR, TIMEOUT)
     2. урлы редиректов (включая конечный)
     3. установленные счетчики на конечном урле
 
     """
-    url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
+    chain = RedirectChain(url, max_redirects, time.time() + deadline if deadline else None)
+    while True:
+        if hop_cache is not None:
+            follow_cached_hops(chain, hop_cache)
+        if chain.done:
+            break
 
-    # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
+        hop_timeout = chain.get_timeout(timeout)
+        if hop_timeout is None:
+            chain.expire()
+            break
 
-    content = None
-    while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
-            timeout=timeout,
-            user_agent=user_agent
+        hop = get_url(
+            url=chain.next_url,
+            timeout=hop_timeout,
+            user_agent=user_agent,
+            max_size=max_size,
+            connect_timeout=connect_timeout
         )
-        if not redirect_url:
-            break
+        if hop_cache is not None:
+            cache_hop(hop_cache, chain.next_url, hop)
+        chain.feed(*hop)
 
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
+    return chain.result()
 
-        if redirect_type == 'ERROR':
-            break
 
-        if len(history_urls) > max_redirects or (redirect_url in history_urls[:-1]):
-            break
+class PreparedUrl(str):
+    """Урл после prepare_url: ASCII байты, повторно не нормализуется"""
+    __slots__ = ()
+
 
-    counters = get_counters(content) if content else []
+def remember(memo, key, value):
+    """Сохраняет значение в ограниченный по размеру словарь-кеш"""
+    if len(memo) >= URL_CACHE_SIZE:
+        memo.clear()
+    memo[key] = value
+    return value
 
-    return history_types, history_urls, counters
+
+def encode_host(netloc):
+    """IDNA-кодирование хоста, результат кешируется"""
+    encoded = idna_hosts.get(netloc)
+    if encoded is None:
+        try:
+            encoded = netloc.encode('idna')
+        except UnicodeError:
+            logger.error("UnicodeError")
+            encoded = netloc
+        remember(idna_hosts, netloc, encoded)
+    return encoded
 
 
 def prepare_url(url):
     """Нормализация урла"""
-    if url is None:
+    if url is None or isinstance(url, PreparedUrl):
         return url
+
+    prepared = prepared_urls.get(url)
+    if prepared is not None:
+        return prepared
+
     scheme, netloc, path, qs, anchor, fragments = urlparse(
         to_unicode(url),
         allow_fragments=False
     )
-    try:
-        netloc = netloc.encode('idna')
-    except UnicodeError:
-        logger.error("UnicodeError")
-        pass
+    netloc = encode_host(netloc)
     path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
     qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
-    return urlunparse((scheme, netloc, path, qs, anchor, fragments))
+    anchor = quote(to_str(anchor, 'ignore'), safe=QUERY_SAFE)
+    prepared = PreparedUrl(to_str(urlunparse((scheme, netloc, path, qs, anchor, fragments)), 'ignore'))
+    return remember(prepared_urls, url, prepared)
@@ -0,0 +1,96 @@
+# coding: utf-8
+from logging import getLogger
+import math
+import socket
+import time
+
+from tarantool.error import DatabaseError
+
+logger = getLogger('redirect_checker')
+
+
+class Autoscaler(object):
+    """
+    Подбирает число воркеров между min_workers и max_workers по статистике входной очереди.
+
+    По приросту счетчиков put и ack между замерами считаются скорости поступления и обработки задач,
+    из скорости обработки и числа работающих воркеров - производительность одного воркера.
+    Воркеров нужно столько, чтобы успевать за поступлением и разобрать ready задачи за backlog_time секунд.
+    Доля take, завершившихся по таймауту, показывает простаивающих воркеров.
+    Число воркеров растет сразу, а уменьшается, только если нужно меньше в scale_down_ratio раз
+    дольше scale_down_delay секунд.
+    """
+
+    def __init__(self, tube, min_workers, max_workers, backlog_time, scale_down_ratio, scale_down_delay):
+        self.tube = tube
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.backlog_time = backlog_time
+        self.scale_down_ratio = scale_down_ratio
+        self.scale_down_delay = scale_down_delay
+
+        self.size = min_workers
+        self.sample = None
+        self.low_since = None
+
+    def get_size(self, workers=None):
+        """
+        :param workers: сколько воркеров работает сейчас, по умолчанию - последний подобранный размер
+        :return: сколько воркеров нужно сейчас
+        """
+        try:
+            stats = self.tube.statistics()
+        except (DatabaseError, socket.error) as e:
+            logger.error(u'Queue statistics error {}'.format(e))
+            return self.size
+
+        now = time.time()
+        sample = (
+            now, int(stats.get('put', 0)), int(stats.get('ack', 0)),
+            int(stats.get('take', 0)), int(stats.get('take_timeout', 0))
+        )
+        last, self.sample = self.sample, sample
+        if last is None or now <= last[0]:
+            return self.size
+
+        elapsed = float(now - last[0])
+        put_rate = (sample[1] - last[1]) / elapsed
+        ack_rate = (sample[2] - last[2]) / elapsed
+        takes = sample[3] - last[3]
+        timeouts = sample[4] - last[4]
+        idle = float(timeouts) / (takes + timeouts) if takes + timeouts else 0.0
+        ready = int(stats.get('tasks', {}).get('ready', 0))
+
+        needed = self.get_needed(ready, put_rate, ack_rate, idle, workers or self.size)
+        self.update(needed, now)
+        logger.debug(u'Autoscale ready={} put_rate={:.1f} ack_rate={:.1f} idle={:.2f} needed={} size={}'.format(
+            ready, put_rate, ack_rate, idle, needed, self.size
+        ))
+        return self.size
+
+    def get_needed(self, ready, put_rate, ack_rate, idle, workers):
+        if ack_rate > 0:
+            # the pool may still be growing or shrinking to the last size
+            per_worker = ack_rate / workers
+            needed = int(math.ceil((put_rate + float(ready) / self.backlog_time) / per_worker))
+        else:
+            needed = self.size
+        if not ready:
+            # idle workers are not needed while there is no backlog
+            needed = min(needed, int(math.ceil(workers * (1 - idle))))
+        return max(self.min_workers, min(needed, self.max_workers))
+
+    def update(self, needed, now):
+        if needed > self.size:
+            logger.info(u'Scale up {} -> {} workers'.format(self.size, needed))
+            self.size = needed
+            self.low_since = None
+        elif needed <= self.size * self.scale_down_ratio:
+            if self.low_since is None:
+                self.low_since = now
+            elif now - self.low_since >= self.scale_down_delay:
+                logger.info(u'Scale down {} -> {} workers'.format(self.size, needed))
+                self.size = needed
+                self.low_since = None
+        else:
+            self.low_since = None
@@ -0,0 +1,190 @@
+# coding: utf-8
+import json
+from logging import getLogger
+import os
+import socket
+import sqlite3
+import time
+from urlparse import urlsplit
+
+import pycurl
+
+logger = getLogger('redirect_checker')
+
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+}
+
+
+class SqliteStorage(object):
+    """
+    Общее для всех процессов хоста состояние в sqlite файле.
+
+    Соединение открывается лениво и заново после fork, таблицы из SCHEMA создаются при открытии.
+    """
+
+    DB_TIMEOUT = 1
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.db = None
+
+    def _get_db(self):
+        # sqlite connections must not be used across fork
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=self.DB_TIMEOUT, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+            self.pid = os.getpid()
+        return self.db
+
+
+class SqliteCache(SqliteStorage):
+    """
+    Кеш с ограниченным временем жизни записей, общий для всех процессов хоста.
+
+    Хранится в sqlite файле, поэтому переживает перезапуск воркеров.
+    При превышении max_size вытесняются записи, к которым дольше всего не обращались.
+    Время обращения обновляется не чаще раза в TOUCH_FRACTION от ttl: запись блокирует базу для всех процессов.
+    Ошибки базы не пробрасываются: кеш в таком случае просто промахивается.
+    """
+
+    EVICT_EVERY = 100
+    TOUCH_FRACTION = 0.1
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)',
+        'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+    )
+
+    def __init__(self, path, max_size, ttl):
+        super(SqliteCache, self).__init__(path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+
+    def get(self, key):
+        """:return: значение или None, если записи нет или она устарела"""
+        now = time.time()
+        try:
+            db = self._get_db()
+            row = db.execute('SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[1] >= now:
+                if self.TOUCH_FRACTION is not None and row[2] < now - self.ttl * self.TOUCH_FRACTION:
+                    db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+                self.hits += 1
+                return json.loads(row[0])
+        except sqlite3.Error as e:
+            logger.error(u'cache {} get error {}'.format(self.path, e))
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            db = self._get_db()
+            db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + ttl, now)
+            )
+            self.sets += 1
+            if self.sets % self.EVICT_EVERY == 0:
+                self.evict()
+        except sqlite3.Error as e:
+            logger.error(u'cache {} set error {}'.format(self.path, e))
+
+    def delete(self, key):
+        try:
+            self._get_db().execute('DELETE FROM cache WHERE key = ?', (key,))
+        except sqlite3.Error as e:
+            logger.error(u'cache {} delete error {}'.format(self.path, e))
+
+    def evict(self):
+        """Удаляет устаревшие записи и записи сверх max_size"""
+        db = self._get_db()
+        db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        count = db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self.max_size:
+            db.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (count - self.max_size,)
+            )
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def get_host_port(url):
+    """:return: хост и порт урла или (None, None), если хост не нужно резолвить"""
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or DEFAULT_PORTS.get(parts.scheme)
+    if not host or not port:
+        return None, None
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return None, None
+        except (socket.error, ValueError):
+            pass
+    return host, port
+
+
+class DnsCache(SqliteCache):
+    """
+    Общий для воркеров кеш адресов хостов.
+
+    Адреса запоминаются по результатам запросов curl (PRIMARY_IP) и подставляются
+    в следующие запросы через CURLOPT_RESOLVE. Неудачный резолв запоминается
+    на negative_ttl, и такие запросы сразу завершаются ошибкой без обращения к резолверу.
+    Время жизни записей задается настройками: TTL из DNS ответа libcurl не отдает.
+    Попадания в кеш ничего не пишут в базу, вытесняются давнее всех сохраненные адреса.
+    """
+
+    NEGATIVE = ''
+    TOUCH_FRACTION = None
+
+    def __init__(self, path, max_size, ttl, negative_ttl):
+        super(DnsCache, self).__init__(path, max_size, ttl)
+        self.negative_ttl = negative_ttl
+        self.applied = {}
+
+    def apply(self, curl, url):
+        """Подставляет закешированный адрес хоста url в curl"""
+        host, port = get_host_port(url)
+        if host is None:
+            return
+
+        address = self.get(host)
+        if address == self.NEGATIVE:
+            raise pycurl.error(pycurl.E_COULDNT_RESOLVE_HOST, 'Could not resolve host: {} (cached)'.format(host))
+
+        # drop the entry left by a previous request, so an expired address is not used by curl
+        resolve = ['-{}:{}'.format(host, port)]
+        if address:
+            resolve.append('{}:{}:{}'.format(host, port, '[{}]'.format(address) if ':' in address else address))
+            self.applied[host] = address
+        curl.setopt(curl.RESOLVE, resolve)
+
+    def update(self, curl, url, errno=None):
+        """Запоминает результат резолва по выполненному запросу"""
+        host, _ = get_host_port(url)
+        if host is None:
+            return
+
+        applied = self.applied.pop(host, None)
+        if errno == pycurl.E_COULDNT_RESOLVE_HOST:
+            self.set(host, self.NEGATIVE, self.negative_ttl)
+        elif errno == pycurl.E_COULDNT_CONNECT and applied:
+            self.delete(host)
+        elif errno is None:
+            address = curl.getinfo(curl.PRIMARY_IP)
+            if address and address != applied:
+                self.set(host, address)
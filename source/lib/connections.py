@@ -0,0 +1,159 @@
+# coding: utf-8
+import errno
+from logging import getLogger
+import os
+import socket
+import threading
+import time
+
+import tarantool
+from tarantool.const import struct_L
+from tarantool.error import NetworkError
+from tarantool_queue import tarantool_queue
+
+logger = getLogger('redirect_checker')
+
+RECONNECT_DELAY = 0.1
+RECONNECT_DELAY_MAX = 10
+RECONNECT_ATTEMPTS = 10
+
+# (host, port, space, channel) -> Queue, only for the process that created them
+queues = {}
+queues_pid = None
+
+
+def set_reconnect_policy(delay, delay_max, attempts):
+    global RECONNECT_DELAY, RECONNECT_DELAY_MAX, RECONNECT_ATTEMPTS
+    RECONNECT_DELAY = delay
+    RECONNECT_DELAY_MAX = delay_max
+    RECONNECT_ATTEMPTS = attempts
+
+
+class ReconnectingConnection(tarantool.Connection):
+    """
+    Соединение с tarantool, которое переживает обрывы.
+
+    Запрос, упавший с сетевой ошибкой, повторяется на новом соединении.
+    Пауза перед переподключением удваивается с каждой неудачей от RECONNECT_DELAY до RECONNECT_DELAY_MAX,
+    после RECONNECT_ATTEMPTS неудачных попыток подряд ошибка пробрасывается.
+    Чтение ответа, прерванное сигналом, продолжается на том же соединении.
+    Запросы из разных потоков выполняются по очереди.
+    """
+
+    def __init__(self, host, port, **kwargs):
+        # reconnects are retried here, with backoff, instead of the fixed delay loop of _opt_reconnect
+        kwargs.setdefault('reconnect_max_attempts', 0)
+        kwargs.setdefault('reconnect_delay', 0)
+        kwargs.setdefault('connect_now', False)
+        super(ReconnectingConnection, self).__init__(host, port, **kwargs)
+        self.healthy = True
+        self.failures = 0
+        self.reconnects = 0
+        self.down_since = None
+        self.lock = threading.RLock()
+
+    def _send_request(self, request, space_name=None, field_defs=None, default_type=None):
+        return self.execute(
+            super(ReconnectingConnection, self)._send_request, request, space_name, field_defs, default_type
+        )
+
+    def execute(self, send, *args):
+        """
+        Выполняет обмен send(*args) с сервером под блокировкой соединения,
+        при сетевой ошибке повторяет его на новом соединении.
+        """
+        with self.lock:
+            return self._execute_with_retries(send, args)
+
+    def _execute_with_retries(self, send, args):
+        attempt = 0
+        while True:
+            try:
+                response = send(*args)
+            except (NetworkError, socket.error) as e:
+                attempt += 1
+                self._on_error(e)
+                if attempt > RECONNECT_ATTEMPTS:
+                    raise
+                # the request may have been executed before the connection broke,
+                # so a repeated put can duplicate a task, which is fine for at-least-once processing
+                time.sleep(min(RECONNECT_DELAY * 2 ** (attempt - 1), RECONNECT_DELAY_MAX))
+                continue
+
+            self._on_success()
+            return response
+
+    def _read_response(self):
+        # a signal handler, such as the worker drain on SIGTERM, interrupts recv with EINTR;
+        # reconnecting would end the session and the server would return every task taken on it
+        buf = ''
+        to_read = 12
+        while to_read:
+            try:
+                temp_buf = self._socket.recv(to_read)
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not temp_buf:
+                raise NetworkError(socket.error(errno.ECONNRESET, 'Lost connection to server during query'))
+            buf += temp_buf
+            to_read = (12 - len(buf)) if len(buf) < 12 else (struct_L.unpack(buf[4:8])[0] + 12 - len(buf))
+
+        return buf[0:12], buf[12:]
+
+    def _on_error(self, error):
+        self.failures += 1
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        self.connected = False
+        if self.healthy:
+            self.healthy = False
+            self.down_since = time.time()
+            logger.warning(u'Lost connection to queue {}:{}: {}'.format(self.host, self.port, error))
+
+    def _on_success(self):
+        if not self.healthy:
+            self.healthy = True
+            self.reconnects += 1
+            logger.warning(u'Reconnected to queue {}:{} after {:.1f} sec'.format(
+                self.host, self.port, time.time() - self.down_since
+            ))
+            self.down_since = None
+
+    def health(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'healthy': self.healthy,
+            'failures': self.failures,
+            'reconnects': self.reconnects,
+        }
+
+
+def get_queue(host, port, space, channel=None):
+    """
+    :param channel: имя отдельного соединения, например для фонового потока
+    :return: общий для процесса Queue с одним соединением на (host, port, space, channel)
+    """
+    global queues_pid
+    # a forked child must not talk over the sockets of its parent
+    if queues_pid != os.getpid():
+        queues.clear()
+        queues_pid = os.getpid()
+
+    key = (host, port, space, channel)
+    if key not in queues:
+        queue = tarantool_queue.Queue(host=host, port=port, space=space)
+        queue.tarantool_connection = ReconnectingConnection
+        queues[key] = queue
+    return queues[key]
+
+
+def get_health():
+    """:return: состояние соединений процесса с очередями"""
+    return [
+        dict(queue.tnt.health(), space=space, channel=channel)
+        for (_, _, space, channel), queue in sorted(queues.iteritems()) if hasattr(queue, '_tnt')
+    ]
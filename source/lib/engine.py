@@ -0,0 +1,224 @@
+# coding: utf-8
+from collections import deque
+from logging import getLogger
+import time
+
+import pycurl
+
+from . import (MAX_CONTENT_SIZE, HttpServerError, RedirectChain, RedirectError, ResponseBuffer, cache_hop,
+               curl_pool, follow_cached_hops, get_error_class, process_response, read_curl_response, setup_curl,
+               update_dns_cache)
+
+logger = getLogger('redirect_checker')
+
+MAX_CONNECTIONS = 100
+SELECT_TIMEOUT = 1.0
+
+
+class RedirectEngine(object):
+    """
+    Проходит множество цепочек редиректов одновременно в одном процессе.
+
+    Каждая цепочка продвигается на один запрос за раз, сами запросы
+    выполняются параллельно через pycurl.CurlMulti.
+    Результат по каждой цепочке такой же, как у get_redirect_history.
+    Время deadline на цепочку отсчитывается от ее добавления.
+    """
+
+    def __init__(self, timeout, max_redirects=30, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                 max_connections=MAX_CONNECTIONS, hop_cache=None, deadline=None, connect_timeout=None):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.max_size = max_size
+        self.hop_cache = hop_cache
+        self.max_connections = max_connections
+
+        self.multi = pycurl.CurlMulti()
+        self.free_handles = []
+        self.handles_count = 0
+        self.pending = deque()
+        self.active = {}
+        self.finished = []
+
+    def __len__(self):
+        """Количество незавершенных цепочек"""
+        return len(self.pending) + len(self.active)
+
+    def add(self, key, url):
+        """
+        Ставит цепочку для url в обработку.
+
+        :param key: идентификатор, с которым вернется результат
+        """
+        chain = RedirectChain(url, self.max_redirects, time.time() + self.deadline if self.deadline else None)
+        if chain.done:
+            self.finished.append((key, chain.result()))
+        else:
+            self.pending.append((key, chain))
+
+    def perform(self, timeout=SELECT_TIMEOUT):
+        """
+        Ждет не дольше timeout секунд активности на сокетах и продвигает цепочки.
+
+        :return: список (key, (history_types, history_urls, counters)) завершенных цепочек
+        """
+        self._start_pending()
+
+        if self.active:
+            self.multi.select(timeout)
+            while True:
+                ret, _ = self.multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, ok_list, err_list = self.multi.info_read()
+                for curl in ok_list:
+                    self._complete(curl)
+                for curl, errno, errmsg in err_list:
+                    # the buffer aborts transfers it does not need to read further
+                    if self.active[curl][2].stopped:
+                        self._complete(curl)
+                    else:
+                        self._complete(curl, errno, errmsg)
+                if not queued:
+                    break
+
+        finished, self.finished = self.finished, []
+        return finished
+
+    def run(self, urls):
+        """
+        Проверяет все урлы и дожидается результатов.
+
+        :return: список результатов в порядке urls
+        """
+        for key, url in enumerate(urls):
+            self.add(key, url)
+
+        results = [None] * len(urls)
+        while True:
+            for key, result in self.perform():
+                results[key] = result
+            if not self:
+                break
+        return results
+
+    def cancel(self):
+        """
+        Прерывает все незавершенные цепочки без результата.
+
+        :return: ключи прерванных цепочек
+        """
+        keys = [key for key, _ in self.pending]
+        self.pending.clear()
+        for curl, (key, _, _) in self.active.items():
+            self.multi.remove_handle(curl)
+            curl_pool.reset(curl)
+            self.free_handles.append(curl)
+            keys.append(key)
+        self.active.clear()
+        return keys
+
+    def close(self):
+        for curl in self.active:
+            self.multi.remove_handle(curl)
+            curl_pool.put(curl)
+        for curl in self.free_handles:
+            curl_pool.put(curl)
+        self.active.clear()
+        self.free_handles = []
+        self.handles_count = 0
+        self.multi.close()
+
+    def _get_handle(self):
+        if self.free_handles:
+            return self.free_handles.pop()
+        if self.handles_count < self.max_connections:
+            self.handles_count += 1
+            return curl_pool.get()
+        return None
+
+    def _start_pending(self):
+        while self.pending:
+            key, chain = self.pending[0]
+            if self.hop_cache is not None:
+                follow_cached_hops(chain, self.hop_cache)
+                if chain.done:
+                    self.pending.popleft()
+                    self.finished.append((key, chain.result()))
+                    continue
+
+            timeout = chain.get_timeout(self.timeout)
+            if timeout is None:
+                self.pending.popleft()
+                chain.expire()
+                self.finished.append((key, chain.result()))
+                continue
+
+            curl = self._get_handle()
+            if curl is None:
+                break
+
+            self.pending.popleft()
+            buff = ResponseBuffer(self.max_size)
+            try:
+                setup_curl(curl, chain.next_url, timeout, buff, self.user_agent, self.connect_timeout)
+            except (pycurl.error, ValueError) as e:
+                self.free_handles.append(curl)
+                self._feed(key, chain, self._error(chain.next_url, e))
+                continue
+
+            self.active[curl] = key, chain, buff
+            self.multi.add_handle(curl)
+
+    def _complete(self, curl, errno=None, errmsg=None):
+        self.multi.remove_handle(curl)
+        key, chain, buff = self.active.pop(curl)
+        update_dns_cache(curl, chain.next_url, errno)
+
+        if errno is None:
+            try:
+                content, redirect_url = read_curl_response(curl, buff)
+            except HttpServerError as e:
+                hop = self._error(chain.next_url, e)
+            else:
+                hop = process_response(chain.next_url, content, redirect_url)
+                if self.hop_cache is not None:
+                    cache_hop(self.hop_cache, chain.next_url, hop)
+        else:
+            hop = self._error(chain.next_url, pycurl.error(errno, errmsg))
+
+        curl_pool.reset(curl)
+        self.free_handles.append(curl)
+        self._feed(key, chain, hop)
+
+    def _error(self, url, e):
+        logger.error(u'error in url {} {}'.format(url, e))
+        return url, RedirectError(get_error_class(e)), None
+
+    def _feed(self, key, chain, hop):
+        chain.feed(*hop)
+        if chain.done:
+            self.finished.append((key, chain.result()))
+        else:
+            self.pending.append((key, chain))
+
+
+def get_redirect_histories(urls, timeout, max_redirects=30, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                           max_connections=MAX_CONNECTIONS, hop_cache=None, deadline=None, connect_timeout=None):
+    """
+    Аналог get_redirect_history для списка урлов, цепочки проверяются параллельно.
+
+    :return: список (history_types, history_urls, counters) в порядке urls
+    """
+    engine = RedirectEngine(
+        timeout, max_redirects, user_agent, max_size, max_connections, hop_cache, deadline, connect_timeout
+    )
+    try:
+        return engine.run(urls)
+    finally:
+        engine.close()
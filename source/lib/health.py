@@ -0,0 +1,54 @@
+# coding: utf-8
+from logging import getLogger
+from threading import Thread
+
+from utils import check_network_status
+
+logger = getLogger('redirect_checker')
+
+
+class NetworkMonitor(object):
+    """
+    Следит за доступностью сети по нескольким адресам.
+
+    Сеть считается доступной, если отвечает хотя бы один адрес, адреса проверяются параллельно.
+    Состояние меняется, только если новое наблюдается down_after (up_after) проверок подряд,
+    так что единичный сбой не останавливает воркеров.
+    """
+
+    def __init__(self, urls, timeout, down_after, up_after):
+        self.urls = urls
+        self.timeout = timeout
+        self.down_after = down_after
+        self.up_after = up_after
+        self.is_up = True
+        self.streak = 0
+
+    def check(self):
+        """:return: True, если сеть считается доступной"""
+        up = any(self.probe())
+        if up == self.is_up:
+            self.streak = 0
+        else:
+            self.streak += 1
+            if self.streak >= (self.up_after if up else self.down_after):
+                logger.warning(u'Network is {} after {} checks'.format('up' if up else 'down', self.streak))
+                self.is_up = up
+                self.streak = 0
+        return self.is_up
+
+    def probe(self):
+        """:return: доступность каждого адреса"""
+        results = [False] * len(self.urls)
+
+        def check(index, url):
+            results[index] = check_network_status(url, self.timeout)
+
+        # threads are joined before the supervisor forks again
+        threads = [Thread(target=check, args=(index, url)) for index, url in enumerate(self.urls)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(self.timeout * 2)
+        return results
@@ -0,0 +1,103 @@
+# coding: utf-8
+from logging import getLogger
+import sqlite3
+import time
+from urlparse import urlsplit
+
+from cache import SqliteStorage
+
+logger = getLogger('redirect_checker')
+
+
+def get_host(url):
+    """:return: хост урла в нижнем регистре или None"""
+    try:
+        return urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+class HostScheduler(SqliteStorage):
+    """
+    Ограничивает нагрузку воркеров хоста на один сайт.
+
+    Одновременно проверяется не больше max_in_flight урлов одного хоста.
+    После неудачной проверки хост откладывается на backoff секунд,
+    с каждой следующей неудачей пауза удваивается до backoff_max.
+    Занятые слоты живут не дольше slot_ttl, чтобы упавший воркер не держал хост.
+    Ошибки базы не пробрасываются: проверка в таком случае не ограничивается.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS slots (id INTEGER PRIMARY KEY, host TEXT, expires REAL)',
+        'CREATE INDEX IF NOT EXISTS slots_host ON slots (host)',
+        'CREATE TABLE IF NOT EXISTS backoff (host TEXT PRIMARY KEY, failures INTEGER, until REAL)',
+    )
+
+    def __init__(self, path, max_in_flight, backoff, backoff_max, defer_delay, slot_ttl):
+        super(HostScheduler, self).__init__(path)
+        self.max_in_flight = max_in_flight
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.defer_delay = defer_delay
+        self.slot_ttl = slot_ttl
+
+    def acquire(self, host):
+        """
+        Занимает слот хоста.
+
+        :return: идентификатор слота для release или None, если хост занят или отложен
+        """
+        now = time.time()
+        try:
+            db = self._get_db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('DELETE FROM slots WHERE expires < ?', (now,))
+                row = db.execute('SELECT until FROM backoff WHERE host = ?', (host,)).fetchone()
+                in_flight = db.execute('SELECT COUNT(*) FROM slots WHERE host = ?', (host,)).fetchone()[0]
+                if (row is not None and row[0] > now) or in_flight >= self.max_in_flight:
+                    return None
+                return db.execute(
+                    'INSERT INTO slots (host, expires) VALUES (?, ?)', (host, now + self.slot_ttl)
+                ).lastrowid
+            finally:
+                db.execute('COMMIT')
+        except sqlite3.Error as e:
+            logger.error(u'host scheduler {} acquire error {}'.format(self.path, e))
+            return 0
+
+    def release(self, slot, host, failed=False):
+        """Освобождает слот и обновляет паузу хоста по результату проверки"""
+        now = time.time()
+        try:
+            db = self._get_db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute('DELETE FROM slots WHERE id = ?', (slot,))
+                if failed:
+                    row = db.execute('SELECT failures FROM backoff WHERE host = ?', (host,)).fetchone()
+                    failures = row[0] + 1 if row is not None else 1
+                    pause = min(self.backoff * 2 ** (failures - 1), self.backoff_max)
+                    db.execute(
+                        'INSERT OR REPLACE INTO backoff (host, failures, until) VALUES (?, ?, ?)',
+                        (host, failures, now + pause)
+                    )
+                    logger.info(u'host {} failed {} times, backoff {} sec'.format(host, failures, pause))
+                else:
+                    db.execute('DELETE FROM backoff WHERE host = ?', (host,))
+            finally:
+                db.execute('COMMIT')
+        except sqlite3.Error as e:
+            logger.error(u'host scheduler {} release error {}'.format(self.path, e))
+
+    def get_delay(self, host):
+        """:return: через сколько секунд имеет смысл повторить отложенную проверку хоста"""
+        try:
+            row = self._get_db().execute('SELECT until FROM backoff WHERE host = ?', (host,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(u'host scheduler {} get delay error {}'.format(self.path, e))
+            row = None
+        if row is None:
+            return self.defer_delay
+        return max(self.defer_delay, int(row[0] - time.time()) + 1)
@@ -0,0 +1,132 @@
+# coding: utf-8
+from logging import getLogger
+from multiprocessing import Event
+import os
+import signal
+import time
+
+from utils import run_child, spawn_workers
+
+logger = getLogger('redirect_checker')
+
+
+class Supervisor(object):
+    """
+    Держит заданное число воркеров.
+
+    Упавший воркер перезапускается сразу, а если воркеры падают быстрее min_uptime -
+    с задержкой, которая удваивается с каждым падением до respawn_delay_max.
+    Остановленные воркеры получают SIGTERM и доделывают или возвращают в очередь взятые задачи.
+    Воркеры получают SIGTERM и при смерти родителя.
+    Приостановленные воркеры не берут новые задачи и возвращают в очередь взятые, не доделывая их.
+    """
+
+    def __init__(self, target, args, parent_pid, respawn_delay, respawn_delay_max, min_uptime):
+        self.target = target
+        self.args = args
+        self.parent_pid = parent_pid
+        self.respawn_delay = respawn_delay
+        self.respawn_delay_max = respawn_delay_max
+        self.min_uptime = min_uptime
+
+        # pid -> (process, start time)
+        self.processes = {}
+        self.stopping = set()
+        self.failures = 0
+        self.next_spawn = 0
+        self.child_exited = False
+        # shared with the workers, they do not take tasks while it is set
+        self.paused = Event()
+
+        # wake up wait() as soon as a worker exits, without breaking other syscalls
+        signal.signal(signal.SIGCHLD, self._on_child_exit)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def __len__(self):
+        """Количество работающих воркеров, не считая останавливаемых"""
+        return len(self.processes) - len(self.stopping)
+
+    def resize(self, num):
+        """Запускает недостающих и останавливает лишних воркеров"""
+        self.reap()
+        required = num - len(self)
+        if required > 0 and time.time() >= self.next_spawn:
+            logger.info('Spawning {} workers'.format(required))
+            self.spawn(required)
+        elif required < 0:
+            running = sorted(
+                (started, pid) for pid, (_, started) in self.processes.iteritems() if pid not in self.stopping
+            )
+            # the youngest workers have the least warm caches
+            self.stop([pid for _, pid in running[required:]])
+
+    def spawn(self, num):
+        now = time.time()
+        args = (self.target,) + tuple(self.args)
+        for process in spawn_workers(num, run_child, args, self.parent_pid, paused=self.paused):
+            self.processes[process.pid] = process, now
+
+    def stop(self, pids=None):
+        """Просит воркеров завершиться, не дожидаясь их"""
+        for pid in self.processes if pids is None else pids:
+            if pid not in self.stopping:
+                self.stopping.add(pid)
+                self.processes[pid][0].terminate()
+
+    def pause(self):
+        if not self.paused.is_set():
+            logger.warning('Pausing workers')
+            self.paused.set()
+
+    def resume(self):
+        if self.paused.is_set():
+            logger.warning('Resuming workers')
+            self.paused.clear()
+
+    def reap(self):
+        """Забирает завершившихся воркеров и считает задержку перезапуска"""
+        now = time.time()
+        for pid, (process, started) in self.processes.items():
+            if process.is_alive():
+                continue
+            del self.processes[pid]
+            if pid in self.stopping:
+                self.stopping.discard(pid)
+                continue
+
+            if now - started < self.min_uptime:
+                self.failures += 1
+                delay = min(self.respawn_delay * 2 ** (self.failures - 1), self.respawn_delay_max)
+                self.next_spawn = now + delay
+                logger.warning(u'Worker {} exited with code {} after {:.1f} sec, respawn in {} sec'.format(
+                    pid, process.exitcode, now - started, delay
+                ))
+            else:
+                self.failures = 0
+                logger.warning(u'Worker {} exited with code {}'.format(pid, process.exitcode))
+
+    def wait(self, timeout):
+        """Ждет timeout секунд, завершения любого воркера или времени отложенного перезапуска"""
+        now = time.time()
+        if self.next_spawn > now:
+            timeout = min(timeout, self.next_spawn - now)
+        if not self.child_exited:
+            # sleep is interrupted by SIGCHLD
+            time.sleep(timeout)
+        self.child_exited = False
+
+    def shutdown(self, timeout):
+        """Останавливает всех воркеров и ждет их не дольше timeout секунд, оставшихся убивает"""
+        self.stop()
+        deadline = time.time() + timeout
+        for process, _ in self.processes.values():
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.warning(u'Worker {} did not stop in {} sec, killing'.format(process.pid, timeout))
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        self.processes.clear()
+        self.stopping.clear()
+
+    def _on_child_exit(self, signum, frame):
+        self.child_exited = True
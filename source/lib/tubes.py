@@ -0,0 +1,266 @@
+# coding: utf-8
+from collections import deque
+from logging import getLogger
+import socket
+import threading
+import time
+
+from tarantool.error import DatabaseError
+from tarantool_queue.tarantool_queue import Task
+
+from common.pipeline import call_pipelined, get_put_args
+
+logger = getLogger('redirect_checker')
+
+# the shortest take timeout, the server waits for a task forever on a zero timeout
+TAKE_NOWAIT = 0.001
+
+
+def take_batch(tube, size, timeout):
+    """
+    Забирает из tube до size задач.
+
+    Первую задачу ждет не дольше timeout секунд, остальные забирает без ожидания за один обмен с сервером.
+    """
+    task = tube.take(timeout)
+    if not task:
+        return []
+
+    tasks = [task]
+    if size > 1:
+        queue = tube.queue
+        take = ('queue.take', (str(queue.space), str(tube.opt['tube']), str(TAKE_NOWAIT)))
+        for response in call_pipelined(queue.tnt, [take] * (size - 1)):
+            if isinstance(response, DatabaseError):
+                logger.error(u'Task take fail {}'.format(response))
+            elif response.rowcount:
+                tasks.append(Task.from_tuple(queue, response))
+    return tasks
+
+
+class BatchAcker(object):
+    """
+    Копит подтверждения задач и отправляет их пачками.
+
+    Пачка уходит, когда набралось batch_size задач или самая старая ждет дольше linger секунд.
+    """
+
+    def __init__(self, batch_size, linger):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.tasks = []
+        self.since = None
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def ack(self, task):
+        if not self.tasks:
+            self.since = time.time()
+        self.tasks.append(task)
+        if len(self.tasks) >= self.batch_size:
+            self.flush()
+
+    def poll(self):
+        """Отправляет подтверждения, которые ждут дольше linger"""
+        if self.tasks and time.time() - self.since >= self.linger:
+            self.flush()
+
+    def flush(self):
+        tasks, self.tasks = self.tasks, []
+        # a task can be acked only on the connection it was taken with
+        by_queue = {}
+        for task in tasks:
+            by_queue.setdefault(task.queue, []).append(task)
+
+        for queue, queue_tasks in by_queue.iteritems():
+            for task in queue_tasks:
+                task.modified = True
+            try:
+                responses = call_pipelined(
+                    queue.tnt, [('queue.ack', (str(queue.space), task.task_id)) for task in queue_tasks]
+                )
+            except (DatabaseError, socket.error) as e:
+                logger.info('Task ack fail')
+                logger.exception(e)
+                continue
+
+            for task, response in zip(queue_tasks, responses):
+                if isinstance(response, DatabaseError):
+                    logger.error(u'Task id={} ack fail {}'.format(task.task_id, response))
+                else:
+                    logger.info(u'Task id={} done'.format(task.task_id))
+
+
+class BatchWriter(object):
+    """
+    Копит результаты задач и кладет их в очереди пачками.
+
+    Пачка уходит, когда набралось batch_size результатов или самый старый ждет дольше linger секунд.
+    Исходная задача подтверждается через acker только после записи ее результата,
+    задача с незаписанным результатом возвращается в очередь.
+    """
+
+    def __init__(self, acker, batch_size, linger):
+        self.acker = acker
+        self.batch_size = batch_size
+        self.linger = linger
+        self.items = []
+        self.since = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, task, tube=None, data=None, **kwargs):
+        """Запоминает результат задачи для tube, без tube задача сразу уходит на подтверждение"""
+        if tube is None:
+            self.acker.ack(task)
+            return
+        if not self.items:
+            self.since = time.time()
+        self.items.append((task, tube, data, kwargs))
+        if len(self.items) >= self.batch_size:
+            self.flush()
+
+    def poll(self):
+        """Записывает результаты, которые ждут дольше linger"""
+        if self.items and time.time() - self.since >= self.linger:
+            self.flush()
+
+    def flush(self):
+        items, self.items = self.items, []
+        by_queue = {}
+        for item in items:
+            by_queue.setdefault(item[1].queue, []).append(item)
+
+        for queue, queue_items in by_queue.iteritems():
+            calls = [('queue.put', get_put_args(tube, data, **kwargs)) for _, tube, data, kwargs in queue_items]
+            try:
+                responses = call_pipelined(queue.tnt, calls)
+            except (DatabaseError, socket.error) as e:
+                logger.exception(e)
+                responses = [e] * len(queue_items)
+
+            for (task, _, _, _), response in zip(queue_items, responses):
+                if isinstance(response, Exception):
+                    logger.error(u'Task id={} result put fail {}'.format(task.task_id, response))
+                    self._release(task)
+                else:
+                    self.acker.ack(task)
+
+    def _release(self, task):
+        try:
+            task.release()
+        except (DatabaseError, socket.error) as e:
+            logger.error(u'Task id={} release fail {}'.format(task.task_id, e))
+
+
+class Prefetcher(object):
+    """
+    Забирает задачи из tube в фоновом потоке и держит наготове до size задач.
+
+    Задачи, которые ждут в буфере дольше touch_interval секунд, продлеваются через touch,
+    чтобы не истек их ttr. Пока выставлен paused, задачи не берутся, а взятые возвращаются в очередь,
+    при остановке тоже. У tube должно быть свое соединение: задачи подтверждаются через него из другого потока.
+    Поэтому задачи берутся пачками без ожидания на сервере, а пустая очередь опрашивается раз в take_timeout секунд,
+    и подтверждение ждет соединения не дольше одного такого запроса.
+    """
+
+    def __init__(self, tube, size, take_timeout, touch_interval, paused=None):
+        self.tube = tube
+        self.size = size
+        self.take_timeout = take_timeout
+        self.touch_interval = touch_interval
+        self.paused = paused
+
+        # [task, time of take or last touch]
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='prefetcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, timeout):
+        """:return: взятая задача или None, если за timeout секунд задач не появилось"""
+        with self.condition:
+            if not self.buffer:
+                self.condition.wait(timeout)
+            if not self.buffer:
+                return None
+            task, _ = self.buffer.popleft()
+            self.condition.notify_all()
+        return task
+
+    def stop(self):
+        """Останавливает поток и возвращает в очередь невыданные задачи"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.release()
+
+    def run(self):
+        while self.running:
+            if self.paused is not None and self.paused.is_set():
+                self.release()
+                time.sleep(self.take_timeout)
+                continue
+
+            with self.condition:
+                if len(self.buffer) >= self.size:
+                    self.condition.wait(self.touch_interval)
+                    full = len(self.buffer) >= self.size
+                else:
+                    full = False
+            if not full and self.running:
+                self.take()
+            self.touch()
+
+    def take(self):
+        # a blocking take would hold the connection lock and delay acks of the worker by up to take_timeout
+        with self.condition:
+            free = max(self.size - len(self.buffer), 1)
+        try:
+            tasks = take_batch(self.tube, free, TAKE_NOWAIT)
+        except (DatabaseError, socket.error) as e:
+            logger.error(u'Task prefetch fail {}'.format(e))
+            time.sleep(self.take_timeout)
+            return
+        with self.condition:
+            if tasks:
+                now = time.time()
+                self.buffer.extend([task, now] for task in tasks)
+                self.condition.notify_all()
+            elif self.running:
+                self.condition.wait(self.take_timeout)
+
+    def touch(self):
+        """Продлевает ttr задач, которые давно ждут в буфере"""
+        now = time.time()
+        with self.condition:
+            stale = [item for item in self.buffer if now - item[1] >= self.touch_interval]
+        for item in stale:
+            try:
+                item[0].touch()
+            except (DatabaseError, socket.error) as e:
+                logger.error(u'Task id={} touch fail {}'.format(item[0].task_id, e))
+            item[1] = now
+
+    def release(self):
+        with self.condition:
+            items, self.buffer = self.buffer, deque()
+            self.condition.notify_all()
+        for task, _ in items:
+            try:
+                task.release()
+            except (DatabaseError, socket.error) as e:
+                logger.error(u'Task id={} release fail {}'.format(task.task_id, e))
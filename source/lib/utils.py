@@ -1,11 +1,15 @@
 # coding: utf-8
 import argparse
+import ctypes
+import ctypes.util
 from multiprocessing import Process
 import os
+import signal
 import socket
 import urllib2
 
-from tarantool_queue import tarantool_queue
+from common import ERROR_OTHER
+from connections import get_queue
 
 
 def daemonize():
@@ -58,9 +62,24 @@ def load_config_from_pyfile(filepath):
         if key.isupper():
             setattr(cfg, key, value)
 
+    apply_config_aliases(cfg)
     return cfg
 
 
+def apply_config_aliases(cfg):
+    """Переводит устаревшие настройки в новые, если новых в конфиге нет"""
+    if not hasattr(cfg, 'CHECK_URLS') and hasattr(cfg, 'CHECK_URL'):
+        cfg.CHECK_URLS = [cfg.CHECK_URL]
+    if not hasattr(cfg, 'RETRY_POLICIES') and hasattr(cfg, 'RECHECK_DELAY'):
+        # a failed check used to be rechecked once after RECHECK_DELAY seconds whatever the error,
+        # classes without a policy of their own are retried by the ERROR_OTHER one
+        cfg.RETRY_POLICIES = {ERROR_OTHER: (1, cfg.RECHECK_DELAY)}
+        if not hasattr(cfg, 'RETRY_DELAY_MAX'):
+            cfg.RETRY_DELAY_MAX = cfg.RECHECK_DELAY
+        if not hasattr(cfg, 'RETRY_JITTER'):
+            cfg.RETRY_JITTER = 0
+
+
 def parse_cmd_args(args, app_description=''):
     """
     Разбирает аргументы командной строки.
@@ -97,11 +116,9 @@ def parse_cmd_args(args, app_description=''):
     return parser.parse_args(args=args)
 
 
-def get_tube(host, port, space, name):
-    queue = tarantool_queue.Queue(
-        host=host, port=port, space=space
-    )
-    return queue.tube(name)
+def get_tube(host, port, space, name, channel=None):
+    """Трубы одного (host, port, space, channel) используют одно соединение"""
+    return get_queue(host, port, space, channel).tube(name)
 
 
 class Config(object):
@@ -111,11 +128,43 @@ class Config(object):
     pass
 
 
-def spawn_workers(num, target, args, parent_pid):
+PR_SET_PDEATHSIG = 1
+
+
+def spawn_workers(num, target, args, parent_pid, **kwargs):
+    """
+    :param kwargs: дополнительные именованные аргументы target
+    :return: список запущенных процессов
+    """
+    processes = []
     for _ in xrange(num):
-        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid})
+        p = Process(target=target, args=args, kwargs=dict(kwargs, parent_pid=parent_pid))
         p.daemon = True
         p.start()
+        processes.append(p)
+    return processes
+
+
+def set_parent_death_signal(signum):
+    """Просит ядро прислать процессу signum, когда умрет его родитель (только linux)"""
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return False
+    return ctypes.CDLL(libc_name).prctl(PR_SET_PDEATHSIG, signum, 0, 0, 0) == 0
+
+
+def run_child(target, *args, **kwargs):
+    """
+    Запускает target в дочернем процессе.
+
+    Процесс получит SIGTERM, когда умрет родитель с pid parent_pid.
+    """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    set_parent_death_signal(signal.SIGTERM)
+    # the parent may have died before prctl
+    if os.getppid() != kwargs['parent_pid']:
+        return
+    target(*args, **kwargs)
 
 
 def check_network_status(check_url, timeout):
@@ -1,44 +1,134 @@
 # coding: utf-8
+from collections import deque
 from logging import getLogger
 import os.path
+import signal
+import time
 
 from tarantool.error import DatabaseError
-from . import to_unicode, get_redirect_history
 
+from common.retry import RetryPolicy
+
+from . import (MAX_CONTENT_SIZE, REDIRECT_ERROR, REDIRECT_TIMEOUT, to_unicode, get_history_error,
+               get_redirect_history, prepare_url, set_dns_cache)
+
+from cache import DnsCache, SqliteCache
+from connections import get_health, set_reconnect_policy
+from engine import RedirectEngine
+from scheduler import HostScheduler, get_host
+from tubes import TAKE_NOWAIT, BatchAcker, BatchWriter, Prefetcher, take_batch
 from utils import get_tube
 
 logger = getLogger('redirect_checker')
 
+is_run = True
+
+
+def stop(signum, frame):
+    """Обработчик SIGTERM: воркер доделывает взятые задачи и завершается"""
+    global is_run
+    is_run = False
+
+
+def is_paused(paused):
+    """:return: True, если воркеру нельзя брать новые задачи и доделывать взятые"""
+    return paused is not None and paused.is_set()
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
+
+def get_task_url(task):
     url = to_unicode(task.data['url'], 'ignore')
     is_recheck = bool(task.data.get('recheck'))
 
     logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
         task.task_id, url, task.data["url_id"], is_recheck
     ))
+    return url
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
-    if 'ERROR' in history_types and not is_recheck:
-        task.data['recheck'] = True
-        data = task.data
-        is_input = True
-    else:
-        data = {
-            "url_id": task.data["url_id"],
-            "result": [history_types, history_urls, counters],
-            "check_type": "normal"
-        }
-        if 'suspicious' in task.data:
-            data['suspicious'] = task.data['suspicious']
 
-        is_input = False
-    return is_input, data
+def get_cached_history(task, url, result_cache):
+    """:return: закешированный результат проверки url или None"""
+    if result_cache is None:
+        return None
+    cached = result_cache.get(prepare_url(url))
+    if cached is not None:
+        logger.info(u'Task id={} result found in cache'.format(task.task_id))
+    return cached
+
+
+def cache_history(url, history, result_cache):
+    history_types, history_urls, counters = history
+    # failed and unfinished checks are not cached
+    if result_cache is not None and REDIRECT_ERROR not in history_types and REDIRECT_TIMEOUT not in history_types:
+        result_cache.set(prepare_url(url), [history_types, history_urls, counters])
+
+
+def get_task_attempts(task):
+    """:return: сколько раз проверка задачи уже повторялась"""
+    # tasks rechecked before retry policies have no attempts counter
+    return task.data.get('attempts', 1 if task.data.get('recheck') else 0)
+
+
+def make_task_result(task, history_types, history_urls, counters, retry_policy=None):
+    """
+    :return: (is_input, data) - куда и что положить по результату проверки
+
+    Задача с ошибкой возвращается во входную очередь, пока это разрешает retry_policy,
+    задержка повтора передается в complete_task через retry_delay.
+    """
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+
+    error = get_history_error(history_types)
+    if error is not None:
+        attempt = get_task_attempts(task) + 1
+        delay = retry_policy.get_delay(error, attempt)
+        if delay is not None:
+            logger.info(u'Task id={} failed with {} error, retry #{} in {} sec'.format(
+                task.task_id, error, attempt, delay
+            ))
+            task.data.update(recheck=True, attempts=attempt, error=error, retry_delay=delay)
+            return True, task.data
+
+    data = {
+        "url_id": task.data["url_id"],
+        "result": [history_types, history_urls, counters],
+        "check_type": "normal"
+    }
+    if 'suspicious' in task.data:
+        data['suspicious'] = task.data['suspicious']
+    if error is not None:
+        data['error'] = error
+    return False, data
+
+
+def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                                   result_cache=None, hop_cache=None, retry_policy=None, deadline=None,
+                                   connect_timeout=None):
+    url = get_task_url(task)
+
+    history = get_cached_history(task, url, result_cache)
+    if history is None:
+        history = get_redirect_history(
+            url, timeout, max_redirects, user_agent, max_size, hop_cache, deadline, connect_timeout
+        )
+        cache_history(url, history, result_cache)
+    return make_task_result(task, *history, retry_policy=retry_policy)
 
 
-def worker(config, parent_pid):
+def is_failed(result):
+    """:return: True, если проверка по задаче завершилась ошибкой"""
+    if not result:
+        return False
+    is_input, data = result
+    return is_input or 'ERROR' in data['result'][0]
+
+
+def get_tubes(config):
+    set_reconnect_policy(
+        config.QUEUE_RECONNECT_DELAY,
+        config.QUEUE_RECONNECT_DELAY_MAX,
+        config.QUEUE_RECONNECT_ATTEMPTS
+    )
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
@@ -64,36 +154,332 @@ def worker(config, parent_pid):
         space=output_tube.queue.space,
         name=output_tube.opt['tube']
     ))
+    return input_tube, output_tube
+
+
+def get_caches(config):
+    """:return: (dns_cache, result_cache, hop_cache), выключенные кеши - None"""
+    dns_cache = None
+    if config.DNS_CACHE_PATH:
+        dns_cache = DnsCache(
+            config.DNS_CACHE_PATH,
+            config.DNS_CACHE_SIZE,
+            config.DNS_CACHE_TTL,
+            config.DNS_CACHE_NEGATIVE_TTL
+        )
+        set_dns_cache(dns_cache)
+        logger.info(u'Use DNS cache {}'.format(config.DNS_CACHE_PATH))
+
+    result_cache = None
+    if config.RESULT_CACHE_PATH:
+        result_cache = SqliteCache(
+            config.RESULT_CACHE_PATH,
+            config.RESULT_CACHE_SIZE,
+            config.RESULT_CACHE_TTL
+        )
+        logger.info(u'Use result cache {}'.format(config.RESULT_CACHE_PATH))
+
+    hop_cache = None
+    if config.HOP_CACHE_PATH:
+        hop_cache = SqliteCache(
+            config.HOP_CACHE_PATH,
+            config.HOP_CACHE_SIZE,
+            config.HOP_CACHE_TTL
+        )
+        logger.info(u'Use hop cache {}'.format(config.HOP_CACHE_PATH))
+
+    return dns_cache, result_cache, hop_cache
+
+
+def log_cache_stats(dns_cache, result_cache, hop_cache):
+    if dns_cache is not None:
+        logger.info(u'DNS cache hits={hits} misses={misses}'.format(**dns_cache.stats()))
+    if result_cache is not None:
+        logger.info(u'Result cache hits={hits} misses={misses}'.format(**result_cache.stats()))
+    if hop_cache is not None:
+        logger.info(u'Hop cache hits={hits} misses={misses}'.format(**hop_cache.stats()))
+
+
+def log_queue_health():
+    for health in get_health():
+        logger.info(
+            u'Queue {host}:{port} space #{space} channel={channel} '
+            u'healthy={healthy} failures={failures} reconnects={reconnects}'.format(**health)
+        )
+
+
+def get_prefetcher(config, paused=None):
+    """:return: запущенный Prefetcher входной очереди или None, если он выключен"""
+    if not config.QUEUE_PREFETCH:
+        return None
+    # a connection of its own, so the puts of the worker do not wait for the prefetcher thread;
+    # prefetched tasks are acked over this connection, which the prefetcher holds only for short takes
+    tube = get_tube(
+        host=config.INPUT_QUEUE_HOST,
+        port=config.INPUT_QUEUE_PORT,
+        space=config.INPUT_QUEUE_SPACE,
+        name=config.INPUT_QUEUE_TUBE,
+        channel='prefetch'
+    )
+    prefetcher = Prefetcher(
+        tube, config.QUEUE_PREFETCH, config.QUEUE_TAKE_TIMEOUT, config.QUEUE_PREFETCH_TOUCH, paused
+    )
+    prefetcher.start()
+    logger.info(u'Prefetch up to {} tasks'.format(config.QUEUE_PREFETCH))
+    return prefetcher
+
+
+def get_retry_policy(config):
+    return RetryPolicy(config.RETRY_POLICIES, config.RETRY_DELAY_MAX, config.RETRY_JITTER)
+
+
+def get_host_scheduler(config):
+    if not config.HOST_SCHEDULER_PATH:
+        return None
+    logger.info(u'Use host scheduler {}'.format(config.HOST_SCHEDULER_PATH))
+    return HostScheduler(
+        config.HOST_SCHEDULER_PATH,
+        config.HOST_MAX_IN_FLIGHT,
+        config.HOST_BACKOFF,
+        config.HOST_BACKOFF_MAX,
+        config.HOST_DEFER_DELAY,
+        config.HOST_SLOT_TTL
+    )
+
+
+def acquire_host(task, host_scheduler):
+    """
+    Занимает слот хоста задачи, задачу занятого хоста возвращает в очередь с задержкой.
+
+    :return: (host, slot) для release_host или None, если задача отложена
+    """
+    host = slot = None
+    if host_scheduler is not None:
+        host = get_host(prepare_url(to_unicode(task.data['url'], 'ignore')))
+    if host is not None:
+        slot = host_scheduler.acquire(host)
+        if slot is None:
+            delay = host_scheduler.get_delay(host)
+            logger.info(u'Task id={} host {} is busy, deferred for {} sec'.format(task.task_id, host, delay))
+            task.release(delay=delay)
+            return None
+    return host, slot
+
+
+def release_host(host_scheduler, host, slot, result):
+    if slot is not None:
+        host_scheduler.release(slot, host, failed=is_failed(result))
+
+
+def release_in_flight(in_flight, host_scheduler):
+    """Возвращает в очередь взятые задачи, не дожидаясь конца их проверки"""
+    for task, url, host, slot in in_flight.itervalues():
+        if slot is not None:
+            host_scheduler.release(slot, host)
+        task.release()
+    in_flight.clear()
+
+
+def complete_task(task, result, input_tube, output_tube, writer=None):
+    """
+    Кладет результат проверки в очередь и подтверждает задачу.
+
+    С writer результат пишется пачкой, а задача подтверждается после записи.
+    """
+    tube = data = None
+    options = {}
+    if result:
+        is_input, data = result
+        if is_input:
+            tube = input_tube
+            # the delay instructs this put only and is not kept in the task
+            options = dict(delay=data.pop('retry_delay'), pri=task.meta()['pri'])
+        else:
+            tube = output_tube
+        logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+
+    if writer is not None:
+        writer.put(task, tube, data, **options)
+        return
+
+    if tube is not None:
+        tube.put(data, **options)
+    try:
+        task.ack()
+        logger.info(u'Task id={} done'.format(task.task_id))
+    except DatabaseError as e:
+        logger.info('Task ack fail')
+        logger.exception(e)
+
+
+def release_taken(taken):
+    """Возвращает в очередь взятые задачи, проверка которых не начиналась"""
+    while taken:
+        taken.popleft().release()
+
+
+def worker(config, parent_pid, paused=None):
+    """
+    Воркер, который проверяет задачи по одной.
+
+    Задачи забираются пачками за один обмен с сервером: по QUEUE_TAKE_BATCH или, с Prefetcher,
+    до QUEUE_PREFETCH в фоновом потоке.
+    Результаты пишутся пачками по OUTPUT_BATCH_SIZE, задачи подтверждаются пачками по ACK_BATCH_SIZE,
+    и то и другое не позже чем через OUTPUT_LINGER и ACK_LINGER секунд после конца проверки.
+
+    :param paused: multiprocessing.Event, пока он выставлен, новые задачи не берутся, взятые, но не начатые,
+                   и задача, проверка которой закончилась ошибкой, возвращаются в очередь
+    """
+    input_tube, output_tube = get_tubes(config)
+    dns_cache, result_cache, hop_cache = get_caches(config)
+    host_scheduler = get_host_scheduler(config)
+    retry_policy = get_retry_policy(config)
+    prefetcher = get_prefetcher(config, paused)
+    acker = BatchAcker(config.ACK_BATCH_SIZE, config.ACK_LINGER)
+    writer = BatchWriter(acker, config.OUTPUT_BATCH_SIZE, config.OUTPUT_LINGER)
+    taken = deque()
+    signal.signal(signal.SIGTERM, stop)
 
     parent_proc = '/proc/{}'.format(parent_pid)
 
     # run while parent is alive
-    while os.path.exists(parent_proc):
-        task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
+    while is_run and os.path.exists(parent_proc):
+        writer.poll()
+        acker.poll()
+        if is_paused(paused):
+            release_taken(taken)
+            time.sleep(config.QUEUE_TAKE_TIMEOUT)
+            continue
+
+        if not taken:
+            if prefetcher is not None:
+                taken.extend(filter(None, [prefetcher.get(config.QUEUE_TAKE_TIMEOUT)]))
+            else:
+                taken.extend(take_batch(input_tube, config.QUEUE_TAKE_BATCH, config.QUEUE_TAKE_TIMEOUT))
+        task = taken.popleft() if taken else None
         if task:
+            placed = acquire_host(task, host_scheduler)
+            if placed is None:
+                continue
+
             logger.info(u'Starting task id={}.'.format(task.task_id))
             result = get_redirect_history_from_task(
                 task,
                 config.HTTP_TIMEOUT,
                 config.MAX_REDIRECTS,
-                config.USER_AGENT
+                config.USER_AGENT,
+                config.MAX_CONTENT_SIZE,
+                result_cache,
+                hop_cache,
+                retry_policy,
+                config.TASK_DEADLINE,
+                config.HTTP_CONNECT_TIMEOUT
             )
-            if result:
-                is_input, data = result
-                if is_input:
-                    input_tube.put(
-                        data,
-                        delay=config.RECHECK_DELAY,
-                        pri=task.meta()['pri']
-                    )
-                else:
-                    output_tube.put(data)
-                logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
-            try:
-                task.ack()
-                logger.info(u'Task id={} done'.format(task.task_id))
-            except DatabaseError as e:
-                logger.info('Task ack fail')
-                logger.exception(e)
+            if is_paused(paused) and is_failed(result):
+                # the network was lost during the check, the error is not the host's fault
+                logger.info(u'Task id={} failed while paused, returned to the queue'.format(task.task_id))
+                release_host(host_scheduler, placed[0], placed[1], None)
+                task.release()
+                continue
+            release_host(host_scheduler, placed[0], placed[1], result)
+            complete_task(task, result, input_tube, output_tube, writer)
+    else:
+        logger.info('Parent is dead. exiting' if is_run else 'Stopped. exiting')
+
+    writer.flush()
+    acker.flush()
+    release_taken(taken)
+    if prefetcher is not None:
+        prefetcher.stop()
+    log_cache_stats(dns_cache, result_cache, hop_cache)
+    log_queue_health()
+
+
+def concurrent_worker(config, parent_pid, paused=None):
+    """
+    Воркер, который держит в обработке до WORKER_CONCURRENCY задач одновременно.
+
+    Запросы всех задач выполняются в одном RedirectEngine,
+    новые задачи забираются из очереди пачками, пока идут запросы по уже взятым.
+    Результаты пишутся пачками по OUTPUT_BATCH_SIZE, задачи подтверждаются пачками по ACK_BATCH_SIZE,
+    и то и другое не позже чем через OUTPUT_LINGER и ACK_LINGER секунд.
+
+    :param paused: multiprocessing.Event, пока он выставлен, новые задачи не берутся,
+                   а запросы по взятым прерываются и задачи возвращаются в очередь
+    """
+    input_tube, output_tube = get_tubes(config)
+    dns_cache, result_cache, hop_cache = get_caches(config)
+    host_scheduler = get_host_scheduler(config)
+    retry_policy = get_retry_policy(config)
+    engine = RedirectEngine(
+        config.HTTP_TIMEOUT,
+        config.MAX_REDIRECTS,
+        config.USER_AGENT,
+        config.MAX_CONTENT_SIZE,
+        config.WORKER_CONCURRENCY,
+        hop_cache,
+        config.TASK_DEADLINE,
+        config.HTTP_CONNECT_TIMEOUT
+    )
+    acker = BatchAcker(config.ACK_BATCH_SIZE, config.ACK_LINGER)
+    writer = BatchWriter(acker, config.OUTPUT_BATCH_SIZE, config.OUTPUT_LINGER)
+    # task_id -> (task, url, host, slot)
+    in_flight = {}
+
+    def finish(task_id, history):
+        task, url, host, slot = in_flight.pop(task_id)
+        result = make_task_result(task, *history, retry_policy=retry_policy)
+        release_host(host_scheduler, host, slot, result)
+        complete_task(task, result, input_tube, output_tube, writer)
+
+    signal.signal(signal.SIGTERM, stop)
+    parent_proc = '/proc/{}'.format(parent_pid)
+
+    # run while parent is alive
+    while is_run and os.path.exists(parent_proc):
+        if is_paused(paused):
+            if in_flight:
+                # checks against the lost network would end with errors counted against hosts and retries
+                logger.info(u'Paused, returning {} tasks to the queue'.format(len(in_flight)))
+                engine.cancel()
+                release_in_flight(in_flight, host_scheduler)
+            writer.poll()
+            acker.poll()
+            time.sleep(config.QUEUE_TAKE_TIMEOUT)
+            continue
+
+        free = config.WORKER_CONCURRENCY - len(in_flight)
+        # do not wait for new tasks while there are requests to run
+        tasks = take_batch(
+            input_tube, min(free, config.QUEUE_TAKE_BATCH), TAKE_NOWAIT if in_flight else config.QUEUE_TAKE_TIMEOUT
+        ) if free > 0 else []
+        for task in tasks:
+            placed = acquire_host(task, host_scheduler)
+            if placed is None:
+                continue
+
+            logger.info(u'Starting task id={}.'.format(task.task_id))
+            url = get_task_url(task)
+            in_flight[task.task_id] = (task, url) + placed
+            history = get_cached_history(task, url, result_cache)
+            if history is not None:
+                finish(task.task_id, history)
+            else:
+                engine.add(task.task_id, url)
+
+        for task_id, history in engine.perform(min(config.ACK_LINGER, config.OUTPUT_LINGER)):
+            cache_history(in_flight[task_id][1], history, result_cache)
+            finish(task_id, history)
+        writer.poll()
+        acker.poll()
     else:
-        logger.info('Parent is dead. exiting')
+        logger.info('Parent is dead. exiting' if is_run else 'Stopped. exiting')
+
+    writer.flush()
+    acker.flush()
+    # unfinished tasks go back to the queue right away instead of waiting for ttr
+    release_in_flight(in_flight, host_scheduler)
+    engine.close()
+
+    log_cache_stats(dns_cache, result_cache, hop_cache)
+    log_queue_health()
@@ -4,22 +4,33 @@
 import argparse
 import json
 import logging
+import math
 import os
 import signal
+import socket
 import sys
+import time
+from collections import deque
 from logging.config import dictConfig
 from threading import current_thread
+from urlparse import urlsplit
 
 import gevent
 from gevent import Greenlet
 from gevent import queue as gevent_queue
 from gevent import sleep
+from gevent.lock import Semaphore
 from gevent.monkey import patch_all
 from gevent.pool import Pool
 import requests
+from requests.adapters import HTTPAdapter
 import tarantool
 import tarantool_queue
 
+from common import ERROR_CONNECT, ERROR_HTTP_5XX, ERROR_OTHER, ERROR_TIMEOUT
+from common.pipeline import call_pipelined, get_put_args
+from common.retry import RetryPolicy
+
 SIGNAL_EXIT_CODE_OFFSET = 128
 """Коды выхода рассчитываются как 128 + номер сигнала"""
 
@@ -31,8 +42,287 @@ exit_code = 0
 
 logger = logging.getLogger('pusher')
 
+ERROR_HTTP_4XX = 'http_4xx'
+"""Класс ошибки для ответов колбэков 4xx, остальные классы общие с redirect_checker"""
+
+ATTEMPTS_FIELD = 'attempts'
+"""Поле данных повторяемой задачи с числом неудачных попыток"""
+
+ORIGIN_ID_FIELD = 'origin_id'
+"""Поле данных повторяемой задачи с id, под которым уведомление было отправлено впервые"""
+
+QUEUE_TIME_UNIT = 1000000
+"""tarantool.queue хранит времена задач в микросекундах, а принимает в секундах"""
+
+
+class SessionPool(object):
+    """
+    Keep-alive сессии requests по хостам колбэков.
+
+    На каждый хост заводится своя requests.Session, которая держит до pool_size соединений с ним,
+    обработчики сверх pool_size ждут свободного соединения.
+    Сессии хостов, к которым не было запросов дольше idle_timeout секунд, закрываются.
+    """
+
+    def __init__(self, pool_size, idle_timeout):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+
+        # (scheme, netloc) -> [session, adapter, active requests, last use time]
+        self.sessions = {}
+        self.requests_count = 0
+        # connections opened by the already closed sessions
+        self.closed_connections = 0
+
+    def _get(self, url):
+        """
+        Возвращает запись о сессии хоста url, создавая сессию при первом обращении.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        item = self.sessions.get(key)
+        if item is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            item = self.sessions[key] = [session, adapter, 0, time.time()]
+        return item
+
+    def post(self, url, *args, **kwargs):
+        """
+        Аналог requests.post через сессию хоста url.
+
+        :rtype: requests.Response
+        """
+        item = self._get(url)
+        item[2] += 1
+        self.requests_count += 1
+        try:
+            return item[0].post(url, *args, **kwargs)
+        finally:
+            item[2] -= 1
+            item[3] = time.time()
+
+    def expire(self):
+        """
+        Закрывает сессии хостов, простаивающие дольше idle_timeout.
+        """
+        now = time.time()
+        for key, (session, adapter, active, last_used) in self.sessions.items():
+            if not active and now - last_used >= self.idle_timeout:
+                logger.debug('Close idle session to {host}.'.format(host=key[1]))
+                del self.sessions[key]
+                self.closed_connections += self._count_connections(adapter)
+                session.close()
+
+    def stats(self):
+        """
+        :return: число хостов, запросов и открытых за все время соединений
+        :rtype: dict
+        """
+        connections = self.closed_connections + sum(
+            self._count_connections(adapter) for _, adapter, _, _ in self.sessions.itervalues()
+        )
+        return {'hosts': len(self.sessions), 'requests': self.requests_count, 'connections': connections}
+
+    @staticmethod
+    def _count_connections(adapter):
+        pools = adapter.poolmanager.pools
+        # the pools container allows only keys() to be listed safely
+        return sum(getattr(pools.get(key), 'num_connections', 0) for key in pools.keys())
+
+
+class TokenBucket(object):
+    """
+    Ограничение частоты запросов: в среднем rate запросов в секунду, но не больше burst подряд.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def take(self):
+        """
+        :return: 0, если запрос можно выполнить сейчас, иначе через сколько секунд это станет возможно
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / float(self.rate)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker хоста колбэков.
+
+    Неудачей считается ошибка запроса или ответ дольше slow_time секунд.
+    Если из последних window запросов, но не меньше чем min_requests, неудачной была доля error_rate,
+    запросы к хосту прекращаются на open_time секунд, после чего один пробный запрос решает,
+    возобновить их или подождать еще open_time секунд.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, window, min_requests, error_rate, slow_time, open_time):
+        self.host = host
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_time = slow_time
+        self.open_time = open_time
+
+        self.state = self.CLOSED
+        # True for each failed request of the window
+        self.results = deque(maxlen=window)
+        self.opened = None
+        self.probing = False
+
+    def get_delay(self):
+        """
+        :return: 0, если к хосту можно обратиться, иначе через сколько секунд стоит попробовать снова
+        """
+        if self.state == self.OPEN:
+            delay = self.opened + self.open_time - time.time()
+            if delay > 0:
+                return delay
+            logger.info('Circuit of {host} is half-open, probe it.'.format(host=self.host))
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and self.probing:
+            return self.open_time
+        return 0
+
+    def start(self):
+        """
+        Отмечает начало запроса к хосту, разрешенного get_delay.
+        """
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def record(self, ok, latency):
+        """
+        Учитывает результат запроса.
+
+        :param ok: запрос выполнен без ошибок
+        :param latency: время выполнения запроса в секундах
+        """
+        failed = not ok or latency >= self.slow_time
+        if self.state == self.HALF_OPEN:
+            self.probing = False
+            if failed:
+                self._open()
+            else:
+                logger.warning('Circuit of {host} is closed.'.format(host=self.host))
+                self.state = self.CLOSED
+                self.results.clear()
+        elif self.state == self.CLOSED:
+            self.results.append(failed)
+            if len(self.results) >= self.min_requests and sum(self.results) >= self.error_rate * len(self.results):
+                self._open()
+
+    def _open(self):
+        logger.warning('Circuit of {host} is open for {time} sec.'.format(host=self.host, time=self.open_time))
+        self.state = self.OPEN
+        self.opened = time.time()
+        self.results.clear()
+
+
+class CallbackHosts(object):
+    """
+    Circuit breaker и ограничение частоты запросов для каждого хоста колбэков.
+
+    Без rate запросы к хосту не ограничиваются по частоте.
+    Состояние хостов, к которым не было запросов дольше idle_timeout секунд и чей circuit закрыт, забывается.
+    """
+
+    def __init__(self, circuit_args, rate=None, burst=None, idle_timeout=60):
+        """
+        :param circuit_args: аргументы CircuitBreaker после host
+        :type circuit_args: tuple
+        """
+        self.circuit_args = circuit_args
+        self.rate = rate
+        self.burst = burst
+        self.idle_timeout = idle_timeout
+
+        # (scheme, netloc) -> [circuit breaker, token bucket, last use time]
+        self.hosts = {}
+
+    def _get(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        item = self.hosts.get(key)
+        if item is None:
+            bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+            item = self.hosts[key] = [CircuitBreaker(parts.netloc, *self.circuit_args), bucket, time.time()]
+        return item
+
+    def acquire(self, url):
+        """
+        Решает, можно ли сейчас отправить запрос на url.
+
+        :return: 0, если можно, иначе через сколько целых секунд стоит попробовать снова
+        :rtype: int
+        """
+        item = self._get(url)
+        item[2] = time.time()
+        circuit, bucket = item[0], item[1]
+        delay = circuit.get_delay()
+        if not delay and bucket is not None:
+            delay = bucket.take()
+        if delay:
+            return max(int(math.ceil(delay)), 1)
+        circuit.start()
+        return 0
+
+    def record(self, url, ok, latency):
+        """
+        Учитывает результат запроса на url.
+        """
+        item = self._get(url)
+        item[2] = time.time()
+        item[0].record(ok, latency)
+
+    def expire(self):
+        """
+        Забывает хосты, простаивающие дольше idle_timeout.
+        """
+        now = time.time()
+        for key, (circuit, _, last_used) in self.hosts.items():
+            if circuit.state == CircuitBreaker.CLOSED and now - last_used >= self.idle_timeout:
+                del self.hosts[key]
+
+
+def get_request_error_class(exc):
+    """
+    :type exc: requests.RequestException
+    :return: класс ошибки запроса для политики повторов
+    """
+    if isinstance(exc, requests.Timeout):
+        return ERROR_TIMEOUT
+    if isinstance(exc, requests.ConnectionError):
+        return ERROR_CONNECT
+    return ERROR_OTHER
+
 
-def notification_worker(task, task_queue, *args, **kwargs):
+def get_status_error_class(status_code):
+    """
+    :return: класс ошибки для HTTP статуса ответа или None, если запрос выполнен успешно
+    """
+    if status_code >= 500:
+        return ERROR_HTTP_5XX
+    if status_code >= 400:
+        return ERROR_HTTP_4XX
+    return None
+
+
+def notification_worker(task, task_queue, session_pool=None, callback_hosts=None, *args, **kwargs):
     """
     Обработчик задачи отправки уведомления.
 
@@ -40,20 +330,31 @@ def notification_worker(task, task_queue, *args, **kwargs):
     :type task: tarantool_queue.Task
     :param task_queue: очередь для обработанных задач
     :type task_queue: gevent.queue.Queue
+    :param session_pool: keep-alive сессии, без него каждый запрос открывает новое соединение
+    :type session_pool: SessionPool
+    :param callback_hosts: состояние хостов колбэков, в которое записывается результат запроса
+    :type callback_hosts: CallbackHosts
     :param args:
     :param kwargs:
     """
+    url = None
+    ok = False
+    started = time.time()
     try:
         current_thread().name = "pusher.worker#{task_id}".format(task_id=task.task_id)
 
         data = task.data.copy()
 
         url = data.pop('callback_url')
-        data['id'] = task.task_id
+        data.pop(ATTEMPTS_FIELD, None)
+        # a retried task is a new task in the queue, the callback gets the id of the first one
+        data['id'] = data.pop(ORIGIN_ID_FIELD, task.task_id)
 
         logger.info('Send data to callback url [{url}].'.format(url=url))
 
-        response = requests.post(
+        started = time.time()
+        post = session_pool.post if session_pool is not None else requests.post
+        response = post(
             url, data=json.dumps(data), *args, **kwargs
         )
 
@@ -61,35 +362,185 @@ def notification_worker(task, task_queue, *args, **kwargs):
             url=url, status_code=response.status_code
         ))
 
-        task_queue.put((task, 'ack'))
+        ok = response.status_code < 500
+        error_class = get_status_error_class(response.status_code)
+        if error_class:
+            task_queue.put((task, 'retry', error_class))
+        else:
+            task_queue.put((task, 'ack'))
     except requests.RequestException as exc:
         logger.exception(exc)
-        task_queue.put((task, 'bury'))
+        task_queue.put((task, 'retry', get_request_error_class(exc)))
+    finally:
+        if callback_hosts is not None and url is not None:
+            callback_hosts.record(url, ok, time.time() - started)
+
+
+def get_task_call(task, action_name, delay=0):
+    """
+    :return: имя и аргументы функции tarantool.queue, выполняющей действие над задачей
+    """
+    if action_name == 'release':
+        return 'queue.release', (str(task.queue.space), str(task.task_id), str(delay), '0')
+    return 'queue.' + action_name, (str(task.queue.space), task.task_id)
+
+
+def get_retry_action(task, error_class, retry_policy):
+    """
+    Решает, повторить ли отправку уведомления, закончившуюся ошибкой.
+
+    Попытки считаются в данных задачи, выдачи задачи, отложенные из-за недоступности хоста колбэка,
+    попытками не считаются.
+
+    :return: (задача, 'put', задержка), пока retry_policy разрешает повтор, иначе (задача, 'bury')
+    """
+    if retry_policy is None:
+        return task, 'bury'
+
+    attempt = (task.data or {}).get(ATTEMPTS_FIELD, 0) + 1
+
+    delay = retry_policy.get_delay(error_class, attempt)
+    if delay is None:
+        logger.warning('Bury task#{task_id} after {attempt} attempts, last error: {error}.'.format(
+            task_id=task.task_id, attempt=attempt, error=error_class
+        ))
+        return task, 'bury'
+
+    logger.info('Retry task#{task_id} in {delay} sec after attempt {attempt}, error: {error}.'.format(
+        task_id=task.task_id, delay=delay, attempt=attempt, error=error_class
+    ))
+    return task, 'put', delay
+
+
+def get_retry_data(task):
+    """:return: данные копии задачи для повтора с засчитанной попыткой"""
+    data = dict(task.data or {})
+    data[ATTEMPTS_FIELD] = data.get(ATTEMPTS_FIELD, 0) + 1
+    data.setdefault(ORIGIN_ID_FIELD, task.task_id)
+    return data
 
 
-def done_with_processed_tasks(task_queue):
+def get_retry_options(task):
+    """
+    :return: оставшийся ttl, ttr и pri исходной задачи для ее копии
+        или пустой словарь, если прочитать их не удалось и копия получит настройки очереди
+    """
+    try:
+        meta = task.meta()
+    except tarantool.DatabaseError as e:
+        logger.warning('Meta of task#{task_id} fail: {error}.'.format(task_id=task.task_id, error=e))
+        return {}
+    if not meta:
+        return {}
+
+    # a ttl of 0 means the tube default, so an expiring task keeps the least one
+    ttl = (meta['created'] + meta['ttl'] - meta['now']) // QUEUE_TIME_UNIT
+    return dict(ttl=max(ttl, 1), ttr=meta['ttr'] // QUEUE_TIME_UNIT, pri=meta['pri'])
+
+
+def put_retried_tasks(queue, processed):
+    """
+    Кладет в tarantool.queue копии повторяемых задач с задержкой.
+
+    Копия живет столько, сколько оставалось исходной задаче, и сохраняет ее ttr и приоритет.
+    Исходная задача подтверждается только после того, как ее копия положена,
+    задача, копию которой положить не удалось, возвращается в очередь с той же задержкой без засчитанной попытки.
+
+    :param processed: список кортежей (объект задачи, имя действия[, задержка])
+    :return: тот же список, где действие 'put' заменено на 'ack' или 'release'
+    """
+    retried = [item for item in processed if item[1] == 'put']
+    if not retried:
+        return processed
+
+    responses = iter(call_pipelined(queue.tnt, [
+        ('queue.put', get_put_args(queue.tube(task.tube), get_retry_data(task), delay=delay, **get_retry_options(task)))
+        for task, _, delay in retried
+    ]))
+
+    result = []
+    for item in processed:
+        if item[1] != 'put':
+            result.append(item)
+            continue
+        task, _, delay = item
+        response = next(responses)
+        if isinstance(response, tarantool.DatabaseError):
+            logger.error('Put task#{task_id} fail: {error}.'.format(task_id=task.task_id, error=response))
+            result.append((task, 'release', delay))
+        else:
+            result.append((task, 'ack'))
+    return result
+
+
+def done_with_processed_tasks(task_queue, retry_policy=None):
     """
     Удаляет завешенные задачи.
 
-    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    Действия над всеми накопившимися задачами отправляются в tarantool.queue одним пакетом,
+    задачи с ошибкой кладутся в tarantool.queue заново с задержкой или хоронятся по retry_policy.
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия[, задержка для release
+                       или класс ошибки для retry])
+    :param retry_policy: политика повторов, без нее задачи с ошибкой сразу хоронятся
+    :type retry_policy: common.retry.RetryPolicy
     """
     logger.debug('Send info about finished tasks to queue.')
 
+    by_queue = {}
     for _ in xrange(task_queue.qsize()):
         try:
-            task, action_name = task_queue.get_nowait()
-
-            logger.debug('{name} task#{task_id}.'.format(
-                name=action_name.capitalize(),
-                task_id=task.task_id
-            ))
-
-            try:
-                getattr(task, action_name)()
-            except tarantool.DatabaseError as exc:
-                logger.exception(exc)
+            item = task_queue.get_nowait()
         except gevent_queue.Empty:
             break
+        if item[1] == 'retry':
+            item = get_retry_action(item[0], item[2], retry_policy)
+        task, action_name = item[:2]
+
+        logger.debug('{name} task#{task_id}.'.format(
+            name=action_name.capitalize(),
+            task_id=task.task_id
+        ))
+
+        # otherwise the task is released when garbage collected
+        task.modified = True
+        by_queue.setdefault(task.queue, []).append(item)
+
+    for queue, processed in by_queue.iteritems():
+        try:
+            processed = put_retried_tasks(queue, processed)
+            responses = call_pipelined(queue.tnt, [get_task_call(*item) for item in processed])
+        except (tarantool.DatabaseError, socket.error) as exc:
+            logger.exception(exc)
+            continue
+
+        for item, response in zip(processed, responses):
+            if isinstance(response, tarantool.DatabaseError):
+                logger.error('{name} task#{task_id} fail: {error}.'.format(
+                    name=item[1].capitalize(), task_id=item[0].task_id, error=response
+                ))
+
+
+def ack_worker(task_queue, queue_lock, retry_policy=None):
+    """
+    Обработчик завершенных задач.
+
+    Ждет, пока обработчики уведомлений положат в очередь задачи, и сразу отправляет их в tarantool.queue,
+    задачи, завершенные за время ожидания соединения, уходят тем же пакетом.
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    :type task_queue: gevent.queue.Queue
+    :param queue_lock: блокировка соединения с tarantool.queue, которым задачи были взяты
+    :type queue_lock: gevent.lock.Semaphore
+    :param retry_policy: политика повторов задач с ошибкой
+    :type retry_policy: common.retry.RetryPolicy
+    """
+    current_thread().name = 'pusher.acker'
+
+    while True:
+        task_queue.peek()
+        with queue_lock:
+            done_with_processed_tasks(task_queue, retry_policy)
 
 
 def stop_handler(signum):
@@ -110,6 +561,26 @@ def stop_handler(signum):
     exit_code = SIGNAL_EXIT_CODE_OFFSET + signum
 
 
+def take_task(tube, queue_lock, timeout, poll):
+    """
+    Берет задачу из tube, ожидая ее не дольше timeout секунд.
+
+    Соединение занимается не дольше poll секунд за раз, между попытками его получает ack_worker.
+
+    :param queue_lock: блокировка соединения с tarantool.queue
+    :type queue_lock: gevent.lock.Semaphore
+    :return: задача или None, если ее не дождались
+    """
+    deadline = time.time() + timeout
+    while True:
+        with queue_lock:
+            task = tube.take(poll)
+        # let the waiting acker use the connection before the next take
+        sleep(0)
+        if task or not run_application or time.time() >= deadline:
+            return task
+
+
 def main_loop(config):
     """
     Основной цикл приложения.
@@ -121,10 +592,14 @@ def main_loop(config):
      * Открываем соединение с tarantool.queue, использую config.QUEUE_* настройки.
      * Создаем пул обработчиков.
      * Создаем очередь куда обработчики будут помещать выполненные задачи.
-     * Пока количество обработчиков <= config.WORKER_POOL_SIZE, берем задачу из tarantool.queue
-       и запускаем greenlet для ее обработки.
-     * Посылаем уведомления о том, что задачи завершены в tarantool.queue.
-     * Спим config.SLEEP секунд.
+     * Ждем, пока в пуле освободится обработчик.
+     * Берем задачу из tarantool.queue, ожидая ее не дольше config.QUEUE_TAKE_TIMEOUT секунд
+       короткими запросами по config.QUEUE_TAKE_POLL секунд, и сразу запускаем greenlet для ее обработки.
+     * Задачу, хост колбэка которой недоступен или исчерпал лимит запросов, возвращаем в tarantool.queue
+       с задержкой.
+     * Посылаем уведомления о том, что задачи завершены в tarantool.queue, в отдельном greenlet
+       по мере завершения задач. Задачи с ошибкой кладем в tarantool.queue заново с растущей задержкой,
+       пока не кончатся попытки по config.RETRY_POLICIES, после чего хороним.
     """
     logger.info('Connect to queue server on {host}:{port} space #{space}.'.format(
         host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
@@ -145,40 +620,72 @@ def main_loop(config):
 
     processed_task_queue = gevent_queue.Queue()
 
-    logger.info('Run main loop. Worker pool size={count}. Sleep time is {sleep}.'.format(
-        count=config.WORKER_POOL_SIZE, sleep=config.SLEEP
+    # a task can be acked only on the connection it was taken with, so the acker shares it with take
+    queue_lock = Semaphore()
+    retry_policy = RetryPolicy(config.RETRY_POLICIES, config.RETRY_DELAY_MAX, config.RETRY_JITTER)
+    acker = gevent.spawn(ack_worker, processed_task_queue, queue_lock, retry_policy)
+
+    logger.info('Keep up to {size} connections per callback host, close idle in {timeout} sec.'.format(
+        size=config.HTTP_POOL_SIZE, timeout=config.HTTP_POOL_IDLE_TIMEOUT
     ))
+    session_pool = SessionPool(config.HTTP_POOL_SIZE, config.HTTP_POOL_IDLE_TIMEOUT)
 
-    while run_application:
-        free_workers_count = worker_pool.free_count()
+    logger.info('Limit callback hosts to {rate} requests per second, open circuit for {time} sec.'.format(
+        rate=config.HTTP_HOST_RATE, time=config.CIRCUIT_OPEN_TIME
+    ))
+    callback_hosts = CallbackHosts(
+        (config.CIRCUIT_WINDOW, config.CIRCUIT_MIN_REQUESTS, config.CIRCUIT_ERROR_RATE,
+         config.CIRCUIT_SLOW_TIME, config.CIRCUIT_OPEN_TIME),
+        rate=config.HTTP_HOST_RATE, burst=config.HTTP_HOST_BURST, idle_timeout=config.HTTP_POOL_IDLE_TIMEOUT
+    )
 
-        logger.debug('Pool has {count} free workers.'.format(count=free_workers_count))
+    logger.info('Run main loop. Worker pool size={count}.'.format(count=config.WORKER_POOL_SIZE))
 
-        for number in xrange(free_workers_count):
-            logger.debug('Get task from tube for worker#{number}.'.format(number=number))
+    try:
+        while run_application:
+            # the take below blocks only while a worker is free, so a finished worker gets the next task at once
+            worker_pool.wait_available()
 
-            task = tube.take(config.QUEUE_TAKE_TIMEOUT)
+            logger.debug('Pool has {count} free workers, get task from tube.'.format(count=worker_pool.free_count()))
 
-            if task:
-                logger.info('Start worker#{number} for task id={task_id}.'.format(
-                    task_id=task.task_id, number=number
-                ))
+            task = take_task(tube, queue_lock, config.QUEUE_TAKE_TIMEOUT, config.QUEUE_TAKE_POLL)
+
+            delay = 0
+            if task and 'callback_url' in task.data:
+                delay = callback_hosts.acquire(task.data['callback_url'])
+
+            if delay:
+                # the worker is left for the hosts that can take requests now
+                logger.info('Postpone task id={task_id} for {delay} sec.'.format(task_id=task.task_id, delay=delay))
+                processed_task_queue.put((task, 'release', delay))
+            elif task:
+                logger.info('Start worker for task id={task_id}.'.format(task_id=task.task_id))
 
                 worker = Greenlet(
                     notification_worker,
                     task,
                     processed_task_queue,
+                    session_pool=session_pool,
+                    callback_hosts=callback_hosts,
                     timeout=config.HTTP_CONNECTION_TIMEOUT,
                     verify=False
                 )
                 worker_pool.add(worker)
                 worker.start()
 
-        done_with_processed_tasks(processed_task_queue)
-
-        sleep(config.SLEEP)
-    else:
-        logger.info('Stop application loop.')
+            session_pool.expire()
+            callback_hosts.expire()
+        else:
+            logger.info('Stop application loop.')
+    finally:
+        # the acker is not interrupted in the middle of a batch and doesn't outlive a failed loop
+        with queue_lock:
+            acker.kill()
+    done_with_processed_tasks(processed_task_queue, retry_policy)
+
+    logger.info('Callback sessions: {hosts} hosts, {requests} requests over {connections} connections.'.format(
+        **session_pool.stats()
+    ))
 
 
 def parse_cmd_args(args):
@@ -268,9 +775,17 @@ def load_config_from_pyfile(filepath):
         if key.isupper():
             setattr(cfg, key, value)
 
+    apply_config_aliases(cfg)
     return cfg
 
 
+def apply_config_aliases(cfg):
+    """Переводит устаревшие настройки в новые, если новых в конфиге нет"""
+    # the dispatcher used to sleep SLEEP seconds between takes, now it waits for a task in takes of QUEUE_TAKE_POLL
+    if not hasattr(cfg, 'QUEUE_TAKE_POLL') and hasattr(cfg, 'SLEEP'):
+        cfg.QUEUE_TAKE_POLL = cfg.SLEEP
+
+
 def install_signal_handlers():
     """
     Устанавливает обработчики системных сигналов.
@@ -2,45 +2,80 @@
 # coding: utf-8
 import logging
 import os
+import signal
 import sys
 from logging.config import dictConfig
-from multiprocessing import active_children
-from time import sleep
 
-from lib.utils import (check_network_status, create_pidfile, daemonize,
-                       load_config_from_pyfile, parse_cmd_args, spawn_workers)
-from lib.worker import worker
+from lib.autoscaler import Autoscaler
+from lib.health import NetworkMonitor
+from lib.supervisor import Supervisor
+from lib.utils import (create_pidfile, daemonize, get_tube,
+                       load_config_from_pyfile, parse_cmd_args)
+from lib.worker import concurrent_worker, worker
 
 logger = logging.getLogger('redirect_checker')
 
 is_run = True
 
 
+def stop(signum, frame):
+    global is_run
+    is_run = False
+
+
 def main_loop(config):
+    if config.AUTOSCALE:
+        pool_description = u'{}-{} (autoscale)'.format(config.WORKER_POOL_MIN, config.WORKER_POOL_MAX)
+    else:
+        pool_description = config.WORKER_POOL_SIZE
     logger.info(
         u'Run main loop. Worker pool size={}. Sleep time is {}.'.format(
-            config.WORKER_POOL_SIZE, config.SLEEP
+            pool_description, config.SLEEP
         ))
     parent_pid = os.getpid()
+    target = concurrent_worker if config.WORKER_CONCURRENCY > 1 else worker
+    supervisor = Supervisor(
+        target,
+        (config,),
+        parent_pid,
+        config.RESPAWN_DELAY,
+        config.RESPAWN_DELAY_MAX,
+        config.WORKER_MIN_UPTIME
+    )
+    autoscaler = None
+    if config.AUTOSCALE:
+        autoscaler = Autoscaler(
+            get_tube(
+                host=config.INPUT_QUEUE_HOST,
+                port=config.INPUT_QUEUE_PORT,
+                space=config.INPUT_QUEUE_SPACE,
+                name=config.INPUT_QUEUE_TUBE
+            ),
+            config.WORKER_POOL_MIN,
+            config.WORKER_POOL_MAX,
+            config.AUTOSCALE_BACKLOG_TIME,
+            config.AUTOSCALE_DOWN_RATIO,
+            config.AUTOSCALE_DOWN_DELAY
+        )
+    network_monitor = NetworkMonitor(
+        config.CHECK_URLS,
+        config.HTTP_TIMEOUT,
+        config.NETWORK_DOWN_AFTER,
+        config.NETWORK_UP_AFTER
+    )
     while is_run:
-        if check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
-            required_workers_count = config.WORKER_POOL_SIZE - len(
-                active_children())
-            if required_workers_count > 0:
-                logger.info(
-                    'Spawning {} workers'.format(required_workers_count))
-                spawn_workers(
-                    num=required_workers_count,
-                    target=worker,
-                    args=(config,),
-                    parent_pid=parent_pid
-                )
+        if network_monitor.check():
+            supervisor.resume()
+            pool_size = config.WORKER_POOL_SIZE if autoscaler is None else autoscaler.get_size(len(supervisor))
+            supervisor.resize(pool_size)
         else:
-            logger.critical('Network is down. stopping workers')
-            for c in active_children():
-                c.terminate()
+            logger.critical('Network is down. pausing workers')
+            supervisor.pause()
+
+        supervisor.wait(config.SLEEP)
 
-        sleep(config.SLEEP)
+    logger.info('Stopping workers')
+    supervisor.shutdown(config.DRAIN_TIMEOUT)
 
 
 def main(argv):
@@ -56,6 +91,8 @@ def main(argv):
         os.path.realpath(os.path.expanduser(args.config))
     )
     dictConfig(config.LOGGING)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
     main_loop(config)
 
     return config.EXIT_CODE
@@ -0,0 +1,71 @@
+# coding: utf-8
+import mock
+import socket
+import unittest
+from lib import autoscaler
+
+
+def make_stats(put=0, ack=0, take=0, take_timeout=0, ready=0):
+    return {
+        'put': str(put), 'ack': str(ack), 'take': str(take), 'take_timeout': str(take_timeout),
+        'tasks': {'ready': str(ready)}
+    }
+
+
+class AutoscalerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tube = mock.Mock()
+        self.autoscaler = autoscaler.Autoscaler(
+            self.tube, min_workers=2, max_workers=20, backlog_time=10, scale_down_ratio=0.7, scale_down_delay=60
+        )
+
+    def get_size(self, now, workers=None, **stats):
+        self.tube.statistics = mock.Mock(return_value=make_stats(**stats))
+        with mock.patch('time.time', mock.Mock(return_value=now)):
+            return self.autoscaler.get_size(workers)
+
+    def test_first_sample(self):
+        self.assertEqual(2, self.get_size(0, ready=1000))
+
+    def test_scale_up(self):
+        self.get_size(0)
+        # 2 workers ack 2 tasks per second, 4 per second arrive and 100 are waiting
+        self.assertEqual(14, self.get_size(10, put=40, ack=20, ready=100))
+
+    def test_scale_up_limited(self):
+        self.get_size(0)
+        self.assertEqual(20, self.get_size(10, put=1000, ack=10, ready=10000))
+
+    def test_scale_up_by_running_workers(self):
+        self.autoscaler.size = 10
+        self.get_size(0)
+        # only 5 of 10 workers are running yet, each acks 1 task per second
+        self.assertEqual(12, self.get_size(10, workers=5, put=100, ack=50, ready=20))
+
+    def test_scale_down_hysteresis(self):
+        self.autoscaler.size = 10
+        self.get_size(0)
+        # 2 of 10 workers are enough for the incoming tasks
+        self.assertEqual(10, self.get_size(10, put=2, ack=10, take=10))
+        self.assertEqual(10, self.get_size(40, put=8, ack=40, take=40))
+        self.assertEqual(2, self.get_size(70, put=14, ack=70, take=70))
+
+    def test_scale_down_idle(self):
+        self.autoscaler.size = 10
+        self.get_size(0)
+        # half of takes find nothing, throughput is unknown
+        self.get_size(10, take=10, take_timeout=10)
+        self.assertEqual(5, self.get_size(70, take=70, take_timeout=70))
+
+    def test_scale_down_interrupted(self):
+        self.autoscaler.size = 10
+        self.get_size(0)
+        self.get_size(10, take=10, take_timeout=10)
+        self.get_size(40, take=10, take_timeout=10, ready=1)
+        self.assertIsNone(self.autoscaler.low_since)
+        self.assertEqual(10, self.get_size(70, take=20, take_timeout=20))
+
+    def test_statistics_error(self):
+        self.autoscaler.size = 5
+        self.tube.statistics = mock.Mock(side_effect=socket.error)
+        self.assertEqual(5, self.autoscaler.get_size())
@@ -0,0 +1,118 @@
+# coding: utf-8
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+import pycurl
+from lib import cache
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+
+    def get_accessed(self, key):
+        db = cache.SqliteCache(self.path, max_size=10, ttl=10)._get_db()
+        return db.execute('SELECT accessed FROM cache WHERE key = ?', (key,)).fetchone()[0]
+
+    def test_get_set(self):
+        sqlite_cache = cache.SqliteCache(self.path, max_size=10, ttl=10)
+        self.assertIsNone(sqlite_cache.get('key'))
+
+        sqlite_cache.set('key', ['value', 1])
+
+        self.assertEqual(['value', 1], sqlite_cache.get('key'))
+        self.assertEqual({'hits': 1, 'misses': 1}, sqlite_cache.stats())
+
+    def test_shared_between_instances(self):
+        cache.SqliteCache(self.path, max_size=10, ttl=10).set('key', 'value')
+        self.assertEqual('value', cache.SqliteCache(self.path, max_size=10, ttl=10).get('key'))
+
+    def test_expired(self):
+        sqlite_cache = cache.SqliteCache(self.path, max_size=10, ttl=10)
+        sqlite_cache.set('key', 'value', ttl=-1)
+        self.assertIsNone(sqlite_cache.get('key'))
+
+    def test_delete(self):
+        sqlite_cache = cache.SqliteCache(self.path, max_size=10, ttl=10)
+        sqlite_cache.set('key', 'value')
+        sqlite_cache.delete('key')
+        self.assertIsNone(sqlite_cache.get('key'))
+
+    def test_evict_least_recently_used(self):
+        sqlite_cache = cache.SqliteCache(self.path, max_size=2, ttl=10 ** 10)
+        with mock.patch('time.time', mock.Mock(side_effect=[1, 2, 2 * 10 ** 9, 2 * 10 ** 9 + 1, 2 * 10 ** 9 + 2])):
+            sqlite_cache.set('first', 1)
+            sqlite_cache.set('second', 2)
+            sqlite_cache.get('first')
+            sqlite_cache.set('third', 3)
+            sqlite_cache.evict()
+
+        self.assertEqual(1, sqlite_cache.get('first'))
+        self.assertIsNone(sqlite_cache.get('second'))
+        self.assertEqual(3, sqlite_cache.get('third'))
+
+    def test_get_touches_only_stale_entries(self):
+        sqlite_cache = cache.SqliteCache(self.path, max_size=10, ttl=100)
+        with mock.patch('time.time', mock.Mock(side_effect=[1, 5, 20])):
+            sqlite_cache.set('key', 'value')
+            sqlite_cache.get('key')
+            accessed_fresh = self.get_accessed('key')
+            sqlite_cache.get('key')
+
+        self.assertEqual(1, accessed_fresh)
+        self.assertEqual(20, self.get_accessed('key'))
+
+    def test_dns_cache_get_does_not_touch(self):
+        dns_cache = cache.DnsCache(self.path, max_size=10, ttl=10, negative_ttl=1)
+        with mock.patch('time.time', mock.Mock(side_effect=[1, 5])):
+            dns_cache.set('test.com', '1.2.3.4')
+            self.assertEqual('1.2.3.4', dns_cache.get('test.com'))
+
+        self.assertEqual(1, self.get_accessed('test.com'))
+
+    def test_db_error(self):
+        sqlite_cache = cache.SqliteCache(os.path.join(self.dir, 'no', 'such', 'dir'), max_size=10, ttl=10)
+        mock_logger = mock.Mock()
+        with mock.patch('lib.cache.logger', mock_logger):
+            sqlite_cache.set('key', 'value')
+            self.assertIsNone(sqlite_cache.get('key'))
+
+        self.assertEqual(2, mock_logger.error.call_count)
+
+    def test_get_host_port(self):
+        self.assertEqual(('test.com', 80), cache.get_host_port('http://test.com/path'))
+        self.assertEqual(('test.com', 8443), cache.get_host_port('https://test.com:8443/'))
+        self.assertEqual((None, None), cache.get_host_port('http://127.0.0.1/'))
+        self.assertEqual((None, None), cache.get_host_port('http://[::1]/'))
+        self.assertEqual((None, None), cache.get_host_port('market://details'))
+
+    def test_dns_cache_apply_miss(self):
+        dns_cache = cache.DnsCache(self.path, max_size=10, ttl=10, negative_ttl=1)
+        curl = mock.Mock()
+        dns_cache.apply(curl, 'http://test.com/')
+        curl.setopt.assert_called_once_with(curl.RESOLVE, ['-test.com:80'])
+
+    def test_dns_cache_update_and_apply(self):
+        dns_cache = cache.DnsCache(self.path, max_size=10, ttl=10, negative_ttl=1)
+        curl = mock.Mock()
+        curl.getinfo = mock.Mock(return_value='1.2.3.4')
+        dns_cache.update(curl, 'http://test.com/')
+        dns_cache.apply(curl, 'https://test.com/')
+
+        curl.setopt.assert_called_once_with(curl.RESOLVE, ['-test.com:443', 'test.com:443:1.2.3.4'])
+
+    def test_dns_cache_negative(self):
+        dns_cache = cache.DnsCache(self.path, max_size=10, ttl=10, negative_ttl=10)
+        dns_cache.update(mock.Mock(), 'http://test.com/', pycurl.E_COULDNT_RESOLVE_HOST)
+        self.assertRaises(pycurl.error, dns_cache.apply, mock.Mock(), 'http://test.com/')
+
+    def test_dns_cache_connect_error_drops_address(self):
+        dns_cache = cache.DnsCache(self.path, max_size=10, ttl=10, negative_ttl=10)
+        dns_cache.set('test.com', '1.2.3.4')
+        dns_cache.apply(mock.Mock(), 'http://test.com/')
+        dns_cache.update(mock.Mock(), 'http://test.com/', pycurl.E_COULDNT_CONNECT)
+        self.assertIsNone(dns_cache.get('test.com'))
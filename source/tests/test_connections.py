@@ -0,0 +1,88 @@
+# coding: utf-8
+import errno
+import mock
+import socket
+import struct
+import unittest
+from tarantool.error import NetworkError
+from lib import connections
+
+
+class ConnectionsTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict('lib.connections.queues', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('lib.connections.time.sleep')
+        self.mock_sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(connections.set_reconnect_policy, 0.1, 10, 10)
+        connections.set_reconnect_policy(1, 3, 3)
+
+        self.connection = connections.ReconnectingConnection('localhost', 33013)
+        self.connection._socket = mock.Mock()
+
+    def test_get_queue_shared(self):
+        queue = connections.get_queue('localhost', 33013, 0)
+
+        self.assertIs(queue, connections.get_queue('localhost', 33013, 0))
+        self.assertIsNot(queue, connections.get_queue('localhost', 33013, 1))
+        self.assertIsNot(queue, connections.get_queue('localhost', 33013, 0, 'prefetch'))
+        self.assertIs(connections.ReconnectingConnection, queue.tarantool_connection)
+
+    def test_get_queue_after_fork(self):
+        queue = connections.get_queue('localhost', 33013, 0)
+
+        with mock.patch('lib.connections.os.getpid', mock.Mock(return_value=-1)):
+            self.assertIsNot(queue, connections.get_queue('localhost', 33013, 0))
+
+    def test_send_request_reconnect(self):
+        response = mock.Mock()
+        send = mock.Mock(side_effect=[NetworkError(socket.error(111, 'refused')), socket.error(), response, response])
+
+        with mock.patch('lib.connections.tarantool.Connection._send_request', send):
+            self.assertIs(response, self.connection._send_request(mock.Mock()))
+            self.assertIs(response, self.connection._send_request(mock.Mock()))
+
+        self.assertEqual([mock.call(1), mock.call(2)], self.mock_sleep.call_args_list)
+        self.assertEqual(
+            dict(host='localhost', port=33013, healthy=True, failures=2, reconnects=1),
+            self.connection.health()
+        )
+
+    def test_send_request_attempts_exhausted(self):
+        send = mock.Mock(side_effect=socket.error())
+
+        with mock.patch('lib.connections.tarantool.Connection._send_request', send):
+            with self.assertRaises(socket.error):
+                self.connection._send_request(mock.Mock())
+
+        self.assertEqual(4, send.call_count)
+        self.assertEqual([mock.call(1), mock.call(2), mock.call(3)], self.mock_sleep.call_args_list)
+        self.assertFalse(self.connection.healthy)
+        self.assertIsNone(self.connection._socket)
+
+    def test_read_response_interrupted(self):
+        header = struct.pack('<LLL', 1, 4, 0)
+        self.connection._socket.recv = mock.Mock(side_effect=[
+            header[:5], socket.error(errno.EINTR, 'Interrupted system call'), header[5:], 'body'
+        ])
+
+        self.assertEqual((header, 'body'), self.connection._read_response())
+        self.assertTrue(self.connection.healthy)
+        self.assertFalse(self.connection._socket.close.called)
+
+    def test_read_response_error(self):
+        self.connection._socket.recv = mock.Mock(side_effect=socket.error(errno.ECONNRESET, 'reset'))
+
+        with self.assertRaises(socket.error):
+            self.connection._read_response()
+
+    def test_get_health(self):
+        connections.get_queue('localhost', 33013, 0)
+        connections.get_queue('localhost', 33013, 1).tnt
+
+        self.assertEqual(
+            [dict(host='localhost', port=33013, space=1, channel=None, healthy=True, failures=0, reconnects=0)],
+            connections.get_health()
+        )
@@ -0,0 +1,202 @@
+# coding: utf-8
+import mock
+import unittest
+import pycurl
+from lib import engine, curl_pool
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        curl_pool.clear()
+        self.addCleanup(curl_pool.clear)
+
+        self.multi = mock.MagicMock()
+        self.multi.perform = mock.Mock(return_value=(0, 0))
+        self.curl = mock.MagicMock()
+
+        patcher_multi = mock.patch("pycurl.CurlMulti", mock.Mock(return_value=self.multi))
+        patcher_curl = mock.patch("pycurl.Curl", mock.Mock(return_value=self.curl))
+        patcher_multi.start()
+        patcher_curl.start()
+        self.addCleanup(patcher_multi.stop)
+        self.addCleanup(patcher_curl.stop)
+
+    def test_add_ignored_domain(self):
+        url = u'http://my.mail.ru/apps/'
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+
+        self.assertEqual(0, len(redirect_engine))
+        self.assertEqual([('key', ([], [url], []))], redirect_engine.perform())
+        self.assertFalse(self.multi.add_handle.called)
+
+    def test_perform_final_page(self):
+        url = u'http://test.com'
+        self.multi.info_read = mock.Mock(return_value=(0, [self.curl], []))
+        process_response = mock.Mock(return_value=(None, None, 'content'))
+
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+        with mock.patch("lib.engine.read_curl_response", mock.Mock(return_value=('content', None))):
+            with mock.patch("lib.engine.process_response", process_response):
+                finished = redirect_engine.perform()
+
+        process_response.assert_called_once_with(url, 'content', None)
+        self.multi.add_handle.assert_called_once_with(self.curl)
+        self.multi.remove_handle.assert_called_once_with(self.curl)
+        self.assertEqual([('key', ([], [url], []))], finished)
+        self.assertEqual(0, len(redirect_engine))
+        self.assertEqual([self.curl], redirect_engine.free_handles)
+        self.assertTrue(self.curl.reset.called)
+        self.assertFalse(self.curl.close.called)
+
+    def test_perform_redirect_continues_chain(self):
+        url = u'http://test.com'
+        redirect_url = u'http://redirect.com'
+        self.multi.info_read = mock.Mock(return_value=(0, [self.curl], []))
+
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+        with mock.patch("lib.engine.read_curl_response", mock.Mock(return_value=('', redirect_url))):
+            with mock.patch("lib.engine.process_response", mock.Mock(return_value=(redirect_url, 'http_status', ''))):
+                finished = redirect_engine.perform()
+
+        self.assertEqual([], finished)
+        self.assertEqual(1, len(redirect_engine))
+        self.assertEqual(redirect_url, redirect_engine.pending[0][1].next_url)
+
+    def test_perform_hop_cache(self):
+        url = u'http://test.com'
+        cached_url = u'http://cached.com'
+        final_url = u'http://final.com'
+        hops = {url: [cached_url, 'http_status']}
+        hop_cache = mock.Mock()
+        hop_cache.get = mock.Mock(side_effect=hops.get)
+        self.multi.info_read = mock.Mock(return_value=(0, [self.curl], []))
+
+        redirect_engine = engine.RedirectEngine(timeout=1, hop_cache=hop_cache)
+        redirect_engine.add('key', url)
+        with mock.patch("lib.engine.read_curl_response", mock.Mock(return_value=('', final_url))):
+            with mock.patch("lib.engine.process_response", mock.Mock(return_value=(final_url, 'http_status', ''))):
+                redirect_engine.perform()
+
+        self.assertEqual(1, self.multi.add_handle.call_count)
+        self.assertEqual([url, cached_url, final_url], redirect_engine.pending[0][1].history_urls)
+        hop_cache.set.assert_called_once_with(cached_url, [final_url, 'http_status'])
+
+    def test_perform_hop_cache_whole_chain(self):
+        url = u'http://test.com'
+        hops = {url: [url, 'http_status']}
+        hop_cache = mock.Mock()
+        hop_cache.get = mock.Mock(side_effect=hops.get)
+
+        redirect_engine = engine.RedirectEngine(timeout=1, hop_cache=hop_cache)
+        redirect_engine.add('key', url)
+
+        self.assertEqual([('key', (['http_status'], [url, url], []))], redirect_engine.perform())
+        self.assertFalse(self.multi.add_handle.called)
+
+    def test_perform_error(self):
+        url = u'http://test.com'
+        self.multi.info_read = mock.Mock(return_value=(0, [], [(self.curl, 28, 'timeout')]))
+
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+        finished = redirect_engine.perform()
+
+        self.assertEqual([('key', (['ERROR'], [url, url], []))], finished)
+        self.assertEqual('timeout', finished[0][1][0][0].error_class)
+
+    def test_perform_server_error(self):
+        url = u'http://test.com'
+        self.multi.info_read = mock.Mock(return_value=(0, [self.curl], []))
+
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+        with mock.patch("lib.engine.read_curl_response", mock.Mock(side_effect=engine.HttpServerError)):
+            finished = redirect_engine.perform()
+
+        self.assertEqual([('key', (['ERROR'], [url, url], []))], finished)
+        self.assertEqual('http_5xx', finished[0][1][0][0].error_class)
+
+    def test_perform_deadline(self):
+        url = u'http://test.com'
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        redirect_engine = engine.RedirectEngine(timeout=3, deadline=10, connect_timeout=1)
+        setup_curl = mock.Mock()
+        with mock.patch("time.time", mock.Mock(side_effect=[100, 108])):
+            redirect_engine.add('key', url)
+            with mock.patch("lib.engine.setup_curl", setup_curl):
+                redirect_engine.perform()
+
+        self.assertEqual(2, setup_curl.call_args[0][2])
+        self.assertEqual(1, setup_curl.call_args[0][5])
+
+    def test_perform_deadline_exceeded(self):
+        url = u'http://test.com'
+        redirect_engine = engine.RedirectEngine(timeout=3, deadline=10)
+        with mock.patch("time.time", mock.Mock(side_effect=[100, 111])):
+            redirect_engine.add('key', url)
+            finished = redirect_engine.perform()
+
+        self.assertEqual([('key', (['TIMEOUT'], [url, url], []))], finished)
+        self.assertFalse(self.multi.add_handle.called)
+
+    def test_perform_stopped_by_buffer(self):
+        url = u'http://test.com'
+        self.multi.info_read = mock.Mock(return_value=(0, [], [(self.curl, 23, 'write error')]))
+        buff = mock.Mock()
+        buff.stopped = True
+
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+        with mock.patch("lib.engine.ResponseBuffer", mock.Mock(return_value=buff)):
+            with mock.patch("lib.engine.read_curl_response", mock.Mock(return_value=('', None))):
+                with mock.patch("lib.engine.process_response", mock.Mock(return_value=(None, None, ''))):
+                    finished = redirect_engine.perform()
+
+        self.assertEqual([('key', ([], [url], []))], finished)
+
+    def test_perform_setup_error(self):
+        url = u'http://test.com'
+        redirect_engine = engine.RedirectEngine(timeout=1)
+        redirect_engine.add('key', url)
+        with mock.patch("lib.engine.setup_curl", mock.Mock(side_effect=pycurl.error)):
+            finished = redirect_engine.perform()
+
+        self.assertEqual([('key', (['ERROR'], [url, url], []))], finished)
+        self.assertFalse(self.multi.add_handle.called)
+
+    def test_max_connections(self):
+        redirect_engine = engine.RedirectEngine(timeout=1, max_connections=1)
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        redirect_engine.add(1, u'http://first.com')
+        redirect_engine.add(2, u'http://second.com')
+        redirect_engine.perform()
+
+        self.assertEqual(1, self.multi.add_handle.call_count)
+        self.assertEqual(1, len(redirect_engine.active))
+        self.assertEqual(1, len(redirect_engine.pending))
+
+    def test_get_redirect_histories(self):
+        urls = [u'http://first.com', u'http://my.mail.ru/apps/']
+        self.multi.info_read = mock.Mock(return_value=(0, [self.curl], []))
+
+        with mock.patch("lib.engine.read_curl_response", mock.Mock(return_value=('', None))):
+            with mock.patch("lib.engine.process_response", mock.Mock(return_value=(None, None, ''))):
+                results = engine.get_redirect_histories(urls, timeout=1)
+
+        self.assertEqual([([], [urls[0]], []), ([], [urls[1]], [])], results)
+        self.assertTrue(self.multi.close.called)
+
+    def test_cancel(self):
+        redirect_engine = engine.RedirectEngine(timeout=1, max_connections=1)
+        redirect_engine.add('first', u'http://first.ru')
+        redirect_engine.add('second', u'http://second.ru')
+        self.multi.info_read = mock.Mock(return_value=(0, [], []))
+        redirect_engine.perform()
+
+        self.assertEqual(['second', 'first'], redirect_engine.cancel())
+        self.multi.remove_handle.assert_called_once_with(self.curl)
+        self.assertEqual(0, len(redirect_engine))
+        self.assertEqual([self.curl], redirect_engine.free_handles)
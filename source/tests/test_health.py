@@ -0,0 +1,40 @@
+# coding: utf-8
+import mock
+import unittest
+from lib import health
+
+
+class HealthTestCase(unittest.TestCase):
+    def setUp(self):
+        self.monitor = health.NetworkMonitor(['http://first.ru', 'http://second.ru'], 1, down_after=2, up_after=3)
+
+    def test_probe(self):
+        statuses = {'http://first.ru': False, 'http://second.ru': True}
+        mock_check = mock.Mock(side_effect=lambda url, timeout: statuses[url])
+
+        with mock.patch('lib.health.check_network_status', mock_check):
+            self.assertEqual([False, True], self.monitor.probe())
+
+        self.assertEqual(2, mock_check.call_count)
+
+    def test_check_one_target_down(self):
+        with mock.patch.object(self.monitor, 'probe', mock.Mock(return_value=[False, True])):
+            for _ in xrange(5):
+                self.assertTrue(self.monitor.check())
+
+    def test_check_hysteresis(self):
+        probe = mock.Mock(return_value=[False, False])
+        with mock.patch.object(self.monitor, 'probe', probe):
+            self.assertTrue(self.monitor.check())
+            self.assertFalse(self.monitor.check())
+
+            probe.return_value = [True, False]
+            self.assertFalse(self.monitor.check())
+            self.assertFalse(self.monitor.check())
+            self.assertTrue(self.monitor.check())
+
+    def test_check_blip(self):
+        probe = mock.Mock(side_effect=[[False, False], [True, True], [False, False]])
+        with mock.patch.object(self.monitor, 'probe', probe):
+            for _ in xrange(3):
+                self.assertTrue(self.monitor.check())
@@ -1,12 +1,61 @@
 # coding: utf-8
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 import mock
+import re
+import threading
 import unittest
 import pycurl
-from lib import to_unicode, to_str, get_counters, check_for_meta, fix_market_url, prepare_url, get_redirect_history, \
-    get_url, make_pycurl_request
+from lib import to_unicode, to_str, get_counters, trie_regex, check_for_meta, fix_market_url, prepare_url, get_redirect_history, \
+    get_url, make_pycurl_request, curl_pool, CurlPool, ResponseBuffer, MAX_CONTENT_SIZE, MAX_REDIRECT_BODY_SIZE, PreparedUrl, prepared_urls, \
+    idna_hosts, get_error_class, get_history_error, HttpServerError, RedirectError, read_curl_response, setup_curl
+from lib.engine import get_redirect_histories
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    """Отвечает на /redir редиректом с телом, на остальные урлы - страницей"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/redir':
+            body = '<html><body>Moved to <a href="/final">/final</a></body></html>'
+            self.send_response(302)
+            self.send_header('Location', '/final')
+        else:
+            body = '<html><body>final</body></html>'
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(test_case):
+    """:return: адрес локального http сервера, остановится по окончании теста"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RedirectHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return 'http://127.0.0.1:{}'.format(server.server_port)
 
 
 class InitLibTestCase(unittest.TestCase):
+    def setUp(self):
+        curl_pool.clear()
+        self.addCleanup(curl_pool.clear)
+        prepared_urls.clear()
+        idna_hosts.clear()
+        self.addCleanup(prepared_urls.clear)
+        self.addCleanup(idna_hosts.clear)
+
     def test_to_unicode(self):
         val = u"val"
         result = to_unicode(val)
@@ -31,6 +80,29 @@ class InitLibTestCase(unittest.TestCase):
         content = 'http://google-analytics.com/ga.js'
         self.assertEquals(1, len(get_counters(content)))
 
+    def test_get_counters_many(self):
+        content = '''
+            <script src="//mc.yandex.ru/metrika/watch.js"></script>
+            <img src="http://top-fwz1.mail.ru/counter?id=1">
+            <a href="http://top.mail.ru/jump?from=1">
+            <script src="http://www.Google-Analytics.com/ga.js"></script>
+            <script src="//mc.yandex.ru/metrika/watch.js"></script>
+        '''
+        self.assertEquals(['GOOGLE_ANALYTICS', 'YA_METRICA', 'TOP_MAIL_RU', 'TOP_MAIL_RU'], get_counters(content))
+
+    def test_get_counters_overlapping(self):
+        content = '<img src="http://top-fwz1.mail.ru/counter.yadro.ru/hit?id=1">'
+        self.assertEquals(['TOP_MAIL_RU', 'LI_RU'], get_counters(content))
+
+    def test_get_counters_nested(self):
+        with mock.patch('lib.COUNTER_TYPES', (('LONG', 'abcd'), ('INNER', 'bc'), ('PREFIX', 'ab'))):
+            with mock.patch('lib.COUNTERS_RE', re.compile('(?=({}))'.format(trie_regex(['abcd', 'bc', 'ab']).pattern))):
+                self.assertEquals(['LONG', 'INNER', 'PREFIX'], get_counters('xabcdx'))
+
+    def test_trie_regex(self):
+        regexp = trie_regex(['abc', 'abd', 'ab', 'x.y'])
+        self.assertEquals(['abc', 'abd', 'ab', 'x.y'], regexp.findall('abc abd abe x.y xzy'))
+
     def test_get_counters_else(self):
         content = ''
         self.assertEquals(get_counters(content), [])
@@ -38,114 +110,47 @@ class InitLibTestCase(unittest.TestCase):
     ############################################################
 
     def test_check_for_meta_no_result(self):
-        content = "content"
-        url = "url"
-
-        soup = mock.Mock()
-        soup.find = mock.Mock(return_value=False)
-
-        with mock.patch("lib.BeautifulSoup", mock.Mock(return_value=soup)):
-            self.assertIsNone(check_for_meta(content, url))
+        content = "<html><head><title>title</title></head></html>"
+        self.assertIsNone(check_for_meta(content, "http://url.ru/"))
 
     def test_check_for_meta_result_no_attrs(self):
-        content = "content"
-        url = "url"
-
-        result = mock.MagicMock()
-        result.attrs = {
-            'content': "content",
-        }
-
-        soup = mock.Mock()
-        soup.find = mock.Mock(return_value=result)
-
-        with mock.patch("lib.BeautifulSoup", mock.Mock(return_value=soup)):
-            with mock.patch("re.search", mock.Mock()) as mock_re_search:
-                res = check_for_meta(content, url)
-
-        self.assertIsNone(res)
-        self.assertFalse(mock_re_search.called)
+        content = '<html><head><meta content="0;url=http://redirect.ru"></head></html>'
+        self.assertIsNone(check_for_meta(content, "http://url.ru/"))
 
     def test_check_for_meta_result_wrong_value(self):
-        content = "content"
-        url = "url"
-
-        result = mock.MagicMock()
-        result.attrs = {
-            'content': "content",
-            'http-equiv': "Refresh"
-        }
-
-        soup = mock.Mock()
-        soup.find = mock.Mock(return_value=result)
-
-        with mock.patch("lib.BeautifulSoup", mock.Mock(return_value=soup)):
-            with mock.patch("re.search", mock.Mock()) as mock_re_search:
-                res = check_for_meta(content, url)
-
-        self.assertIsNone(res)
-        self.assertFalse(mock_re_search.called)
-
-    def test_check_for_meta_result_not_split(self):
-        content = "content"
-        url = "url"
-
-        result = mock.MagicMock()
-        result.attrs = {
-            'content': "content",
-            'http-equiv': "refresh"
-        }
-
-        soup = mock.Mock()
-        soup.find = mock.Mock(return_value=result)
-
-        with mock.patch("lib.BeautifulSoup", mock.Mock(return_value=soup)):
-            with mock.patch("re.search", mock.Mock()) as mock_re_search:
-                res = check_for_meta(content, url)
+        content = '<html><head><meta http-equiv="Refresh" content="content"></head></html>'
+        with mock.patch("re.search", mock.Mock()) as mock_re_search:
+            res = check_for_meta(content, "http://url.ru/")
 
         self.assertIsNone(res)
         self.assertFalse(mock_re_search.called)
 
-    def test_check_for_meta_result_split(self):
-        content = "content"
-        url = "url"
-
-        result = mock.MagicMock()
-        result.attrs = {
-            'content': "wait;text",
-            'http-equiv': "refresh"
-        }
-
-        soup = mock.Mock()
-        soup.find = mock.Mock(return_value=result)
-        re_search = mock.Mock()
-
-        with mock.patch("lib.BeautifulSoup", mock.Mock(return_value=soup)):
-            with mock.patch("re.search", re_search):
-                res = check_for_meta(content, url)
-
-        self.assertIsNone(res)
+    def test_check_for_meta_result_split_no_url(self):
+        content = '<html><head><meta http-equiv="refresh" content="wait;text"></head></html>'
+        self.assertIsNone(check_for_meta(content, "http://url.ru/"))
 
     def test_check_for_meta_result_m(self):
-        content = "content"
-        url = "url"
+        content = '<html><head><meta charset="utf-8"><META HTTP-EQUIV=refresh CONTENT="0; URL=\'/next?a=1&amp;b=2\'"></head></html>'
+        self.assertEquals(u"http://url.ru/next?a=1&b=2", check_for_meta(content, "http://url.ru/path"))
 
-        result = mock.MagicMock()
-        result.attrs = {
-            'content': "wait;text",
-            'http-equiv': "refresh"
-        }
+    def test_check_for_meta_stops_at_first_refresh(self):
+        content = '<meta http-equiv="refresh" content="5"><meta http-equiv="refresh" content="0;url=http://redirect.ru">'
+        self.assertIsNone(check_for_meta(content, "http://url.ru/"))
 
-        soup = mock.Mock()
-        soup.find = mock.Mock(return_value=result)
-        m_mock = mock.MagicMock()
-        re_search = mock.Mock(return_value=m_mock)
+    def test_check_for_meta_only_head(self):
+        content = '<html><head></head><body><meta http-equiv="refresh" content="0;url=http://redirect.ru"></body></html>'
+        self.assertIsNone(check_for_meta(content, "http://url.ru/"))
 
-        with mock.patch("lib.BeautifulSoup", mock.Mock(return_value=soup)):
-            with mock.patch("re.search", re_search):
-                res = check_for_meta(content, url)
+    def test_check_for_meta_no_head(self):
+        content = '<!-- <meta http-equiv="refresh" content="0;url=/comment"> -->' \
+                  '<meta http-equiv="refresh" content="0;url=http://redirect.ru"><body>'
+        self.assertEquals(u"http://redirect.ru", check_for_meta(content, "http://url.ru/"))
 
-        self.assertIsNone(res)
+    def test_check_for_meta_skips_raw_text(self):
+        content = '<html><head><script>document.write("</head><body>");</script>' \
+                  '<style>a:after { content: "<body>" }</style><title>a </head> b</title>' \
+                  '<meta http-equiv="refresh" content="0;url=http://redirect.ru"></head></html>'
+        self.assertEquals(u"http://redirect.ru", check_for_meta(content, "http://url.ru/"))
 
     #####################################################################
 
@@ -189,6 +194,159 @@ class InitLibTestCase(unittest.TestCase):
             with mock.patch('pycurl.Curl', mock.Mock(return_value=curl)):
                 self.assertEquals((content, None), make_pycurl_request(url, timeout))
 
+    def test_make_pycurl_request_reuses_handle(self):
+        curl = mock.MagicMock()
+        curl.getinfo = mock.Mock(return_value=None)
+        mock_curl = mock.Mock(return_value=curl)
+        with mock.patch('pycurl.Curl', mock_curl):
+            make_pycurl_request(u'http://url.ru', 5)
+            make_pycurl_request(u'http://url.ru', 5)
+
+        mock_curl.assert_called_once_with()
+        self.assertEquals(2, curl.perform.call_count)
+        self.assertEquals(2, curl.reset.call_count)
+        self.assertFalse(curl.close.called)
+
+    def test_make_pycurl_request_error_returns_handle(self):
+        curl = mock.MagicMock()
+        curl.perform = mock.Mock(side_effect=pycurl.error)
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=curl)):
+            self.assertRaises(pycurl.error, make_pycurl_request, u'http://url.ru', 5)
+
+        self.assertEquals([curl], curl_pool.handles)
+
+    def test_make_pycurl_request_stopped(self):
+        curl = mock.MagicMock()
+        curl.perform = mock.Mock(side_effect=pycurl.error)
+        curl.getinfo = mock.Mock(return_value='http://url.ru/path/page')
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: ../next\r\n')
+        buff.header('Content-Length: 100000\r\n')
+        buff.write('body')
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=curl)):
+            with mock.patch('lib.ResponseBuffer', mock.Mock(return_value=buff)):
+                self.assertEquals(('', u'http://url.ru/next'), make_pycurl_request(u'http://url.ru', 5))
+        curl.getinfo.assert_called_once_with(curl.EFFECTIVE_URL)
+
+    def test_redirect_with_body_real_curl(self):
+        base_url = start_http_server(self)
+        expected = (['http_status'], [base_url + '/redir', base_url + '/final'], [])
+
+        self.assertEquals(expected, get_redirect_history(base_url + '/redir', 5))
+        self.assertEquals([expected], get_redirect_histories([base_url + '/redir'], 5))
+
+    def test_redirect_keeps_connection_real_curl(self):
+        base_url = start_http_server(self)
+        connects = []
+
+        def read_response(curl, buff):
+            connects.append(curl.getinfo(pycurl.NUM_CONNECTS))
+            return read_curl_response(curl, buff)
+
+        with mock.patch('lib.read_curl_response', mock.Mock(side_effect=read_response)):
+            for path in ('/redir', '/redir', '/redir', '/final', '/final'):
+                make_pycurl_request(base_url + path, 5)
+
+        self.assertEquals([1, 0, 0, 0, 0], connects)
+
+    def test_response_buffer_redirect(self):
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: /next\r\n')
+        self.assertIsNone(buff.write('body'))
+        self.assertFalse(buff.stopped)
+        self.assertEquals('', buff.getvalue())
+
+    def test_response_buffer_redirect_large_body(self):
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: /next\r\n')
+        self.assertIsNone(buff.write('a' * MAX_REDIRECT_BODY_SIZE))
+        self.assertEquals(0, buff.write('a'))
+        self.assertTrue(buff.stopped)
+        self.assertEquals('', buff.getvalue())
+
+    def test_response_buffer_redirect_large_content_length(self):
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: /next\r\n')
+        buff.header('Content-Length: {}\r\n'.format(MAX_REDIRECT_BODY_SIZE + 1))
+        self.assertEquals(0, buff.write('body'))
+        self.assertTrue(buff.stopped)
+
+    def test_response_buffer_redirect_status_without_location(self):
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 304 Not Modified\r\n')
+        self.assertIsNone(buff.write('body'))
+        self.assertFalse(buff.stopped)
+
+    def test_response_buffer_continue(self):
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 302 Found\r\n')
+        buff.header('Location: /next\r\n')
+        buff.header('HTTP/1.1 200 OK\r\n')
+        self.assertIsNone(buff.write('body'))
+        self.assertEquals('body', buff.getvalue())
+
+    def test_response_buffer_status(self):
+        buff = ResponseBuffer()
+        self.assertIsNone(buff.status)
+        buff.header('HTTP/1.1 503 Service Unavailable\r\n')
+        self.assertEquals(503, buff.status)
+
+    def test_read_curl_response_server_error(self):
+        buff = ResponseBuffer()
+        buff.header('HTTP/1.1 502 Bad Gateway\r\n')
+        self.assertRaises(HttpServerError, read_curl_response, mock.Mock(), buff)
+
+    def test_get_error_class(self):
+        self.assertEquals('dns', get_error_class(pycurl.error(6, "Couldn't resolve host 'url.ru'")))
+        self.assertEquals('dns', get_error_class(pycurl.error(28, 'Resolving timed out after 3000 milliseconds')))
+        self.assertEquals('connect', get_error_class(pycurl.error(7, 'Failed to connect')))
+        self.assertEquals('connect', get_error_class(pycurl.error(28, 'Connection timed out after 3000 milliseconds')))
+        self.assertEquals('timeout', get_error_class(pycurl.error(28, 'Operation timed out after 3000 milliseconds')))
+        self.assertEquals('tls', get_error_class(pycurl.error(35, 'SSL connect error')))
+        self.assertEquals('http_5xx', get_error_class(HttpServerError('HTTP status 500')))
+        self.assertEquals('parse', get_error_class(pycurl.error(3, 'URL using bad/illegal format')))
+        self.assertEquals('parse', get_error_class(ValueError()))
+        self.assertEquals('other', get_error_class(pycurl.error(56, 'Recv failure')))
+        self.assertEquals('other', get_error_class(pycurl.error()))
+
+    def test_get_history_error(self):
+        self.assertIsNone(get_history_error(['http_status', 'meta_tag']))
+        self.assertEquals('dns', get_history_error(['http_status', RedirectError('dns')]))
+        self.assertEquals('other', get_history_error(['ERROR']))
+
+    def test_response_buffer_max_size(self):
+        buff = ResponseBuffer(max_size=6)
+        self.assertIsNone(buff.write('abc'))
+        self.assertEquals(0, buff.write('defgh'))
+        self.assertTrue(buff.stopped)
+        self.assertEquals('abcdef', buff.getvalue())
+
+    def test_curl_pool_put_full(self):
+        pool = CurlPool(size=1)
+        first, second = mock.MagicMock(), mock.MagicMock()
+        with mock.patch('pycurl.Curl', mock.Mock(side_effect=[first, second])):
+            handles = [pool.get(), pool.get()]
+            for handle in handles:
+                pool.put(handle)
+
+        self.assertFalse(first.close.called)
+        self.assertTrue(second.close.called)
+        self.assertEquals([first], pool.handles)
+
+    def test_curl_pool_after_fork(self):
+        pool = CurlPool()
+        curl = mock.MagicMock()
+        with mock.patch('pycurl.Curl', mock.Mock(return_value=curl)):
+            pool.put(pool.get())
+            with mock.patch('os.getpid', mock.Mock(return_value=-1)):
+                pool.get()
+
+        self.assertEquals([], pool.handles)
+
     #####################################################################
 
     def test_get_url_meta(self):
@@ -206,7 +364,7 @@ class InitLibTestCase(unittest.TestCase):
                 with mock.patch('lib.prepare_url', mock.Mock(return_value=new_redirect_meta)):
                     url, red, con = get_url(url_test, timeout_test)
 
-        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None)
+        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None, MAX_CONTENT_SIZE, None)
         self.assertEqual(new_redirect_meta, url)
         self.assertEqual(REDIRECT_META, red)
         self.assertEqual(content, con)
@@ -225,7 +383,7 @@ class InitLibTestCase(unittest.TestCase):
                 with mock.patch('lib.prepare_url', mock.Mock(return_value=new_redirect)):
                     url, red, con = get_url(url_test, timeout_test)
 
-        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None)
+        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None, MAX_CONTENT_SIZE, None)
         self.assertEqual(new_redirect, url)
         self.assertEqual(REDIRECT_HTTP, red)
         self.assertEqual(content, con)
@@ -242,7 +400,7 @@ class InitLibTestCase(unittest.TestCase):
             with mock.patch('lib.prepare_url', mock.Mock(return_value=None)):
                 url, red, con = get_url(url_test, timeout_test)
 
-        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None)
+        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None, MAX_CONTENT_SIZE, None)
         self.assertEqual(None, url)
         self.assertEqual(None, red)
         self.assertEqual(content, con)
@@ -262,7 +420,7 @@ class InitLibTestCase(unittest.TestCase):
                 with mock.patch('lib.prepare_url', mock.Mock(return_value=return_fix_market)):
                     url, red, con = get_url(url_test, timeout_test)
 
-        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None)
+        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None, MAX_CONTENT_SIZE, None)
         mock_fix_market_url.assert_called_once_with(new_redirect)
         self.assertEqual(return_fix_market, url)
         self.assertEqual(REDIRECT_HTTP, red)
@@ -276,9 +434,10 @@ class InitLibTestCase(unittest.TestCase):
         with mock.patch('lib.make_pycurl_request', mock_make_pycurl):
             url, red, con = get_url(url_test, timeout_test)
 
-        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None)
+        mock_make_pycurl.assert_called_once_with(url_test, timeout_test, None, MAX_CONTENT_SIZE, None)
         self.assertEqual(url_test, url)
         self.assertEqual('ERROR', red)
+        self.assertEqual('other', red.error_class)
         self.assertEqual(None, con)
 
     ####################################################################
@@ -309,7 +468,8 @@ class InitLibTestCase(unittest.TestCase):
                 with mock.patch('lib.get_url', mock_get_url):
                     history_type, history_urls, counters = get_redirect_history(url_test, timeout_test)
 
-        mock_get_url.assert_called_once_with(url=url_test, timeout=timeout_test, user_agent=None)
+        mock_get_url.assert_called_once_with(url=url_test, timeout=timeout_test, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                                             connect_timeout=None)
         self.assertEqual([], history_type)
         self.assertEqual([url_test], history_urls)
         self.assertEqual([], counters)
@@ -328,7 +488,8 @@ class InitLibTestCase(unittest.TestCase):
                 with mock.patch('lib.get_url', get_url_mock):
                     history_type, history_urls, counters = get_redirect_history(url_test, timeout_test)
 
-        get_url_mock.assert_called_once_with(url=url_test, timeout=timeout_test, user_agent=None)
+        get_url_mock.assert_called_once_with(url=url_test, timeout=timeout_test, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                                             connect_timeout=None)
         self.assertEqual([return_redirect_type], history_type)
         self.assertEqual([url_test, return_redirect_url], history_urls)
         self.assertEqual([], counters)
@@ -348,11 +509,111 @@ class InitLibTestCase(unittest.TestCase):
                 with mock.patch('lib.get_url', get_url_mock):
                     history_type, history_urls, counters = get_redirect_history(url_test, timeout_test, max_redirects_test)
 
-        get_url_mock.assert_called_with(url=url_test, timeout=timeout_test, user_agent=None)
+        get_url_mock.assert_called_with(url=url_test, timeout=timeout_test, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                                        connect_timeout=None)
         self.assertEqual([return_redirect_type], history_type)
         self.assertEqual([url_test, return_redirect_url], history_urls)
         self.assertEqual([], counters)
 
+    def test_get_redirect_history_deadline_cuts_timeout(self):
+        url_test = 'http://test.com'
+        get_url_mock = mock.Mock(return_value=(None, None, ''))
+
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 108, 108])):
+            with mock.patch('lib.get_url', get_url_mock):
+                get_redirect_history(url_test, 3, deadline=10, connect_timeout=1)
+
+        get_url_mock.assert_called_once_with(url=url_test, timeout=2, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                                             connect_timeout=1)
+
+    def test_get_redirect_history_deadline_exceeded(self):
+        url_test = 'http://test.com'
+        redirect_url = 'http://redirect.com'
+        get_url_mock = mock.Mock(return_value=(redirect_url, 'http_status', ''))
+
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 101, 111])):
+            with mock.patch('lib.get_url', get_url_mock):
+                history_types, history_urls, counters = get_redirect_history(url_test, 3, deadline=10)
+
+        self.assertEqual(1, get_url_mock.call_count)
+        self.assertEqual(['http_status', 'TIMEOUT'], history_types)
+        self.assertEqual([url_test, redirect_url, redirect_url], history_urls)
+        self.assertEqual([], counters)
+
+    def test_get_redirect_history_timeout_error_after_deadline(self):
+        url_test = 'http://test.com'
+        get_url_mock = mock.Mock(return_value=(url_test, RedirectError('timeout'), None))
+
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 108, 110])):
+            with mock.patch('lib.get_url', get_url_mock):
+                history_types, _, _ = get_redirect_history(url_test, 3, deadline=10)
+
+        self.assertEqual(['TIMEOUT'], history_types)
+
+    def test_get_redirect_history_connect_error_after_deadline(self):
+        url_test = 'http://test.com'
+        get_url_mock = mock.Mock(return_value=(url_test, RedirectError('connect'), None))
+
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 108, 110])):
+            with mock.patch('lib.get_url', get_url_mock):
+                history_types, _, _ = get_redirect_history(url_test, 3, deadline=10)
+
+        self.assertEqual(['TIMEOUT'], history_types)
+
+    def test_get_redirect_history_error_before_deadline(self):
+        url_test = 'http://test.com'
+        get_url_mock = mock.Mock(return_value=(url_test, RedirectError('dns'), None))
+
+        with mock.patch('time.time', mock.Mock(side_effect=[100, 101, 102])):
+            with mock.patch('lib.get_url', get_url_mock):
+                history_types, _, _ = get_redirect_history(url_test, 3, deadline=10)
+
+        self.assertEqual(['ERROR'], history_types)
+        self.assertEqual('dns', history_types[0].error_class)
+
+    def test_setup_curl_timeouts(self):
+        curl = mock.Mock()
+        setup_curl(curl, u'http://url.ru', 2.5, ResponseBuffer(), connect_timeout=1)
+
+        curl.setopt.assert_any_call(curl.CONNECTTIMEOUT_MS, 1000)
+        curl.setopt.assert_any_call(curl.TIMEOUT_MS, 2500)
+
+    def test_setup_curl_timeouts_less_than_ms(self):
+        curl = mock.Mock()
+        setup_curl(curl, u'http://url.ru', 0.0004, ResponseBuffer(), connect_timeout=1)
+
+        curl.setopt.assert_any_call(curl.CONNECTTIMEOUT_MS, 1)
+        curl.setopt.assert_any_call(curl.TIMEOUT_MS, 1)
+
+    def test_get_redirect_history_hop_cache(self):
+        url_test = 'http://test.com'
+        cached_url = 'http://cached.com'
+        final_url = 'http://final.com'
+        hops = {url_test: [cached_url, 'http_status']}
+        hop_cache = mock.Mock()
+        hop_cache.get = mock.Mock(side_effect=hops.get)
+
+        get_url_mock = mock.Mock(side_effect=[(final_url, 'meta_tag', ''), (None, None, 'content')])
+        with mock.patch('lib.get_url', get_url_mock):
+            history_types, history_urls, counters = get_redirect_history(url_test, 777, hop_cache=hop_cache)
+
+        self.assertEqual(['http_status', 'meta_tag'], history_types)
+        self.assertEqual([url_test, cached_url, final_url], history_urls)
+        self.assertEqual(2, get_url_mock.call_count)
+        get_url_mock.assert_any_call(url=cached_url, timeout=777, user_agent=None, max_size=MAX_CONTENT_SIZE,
+                                     connect_timeout=None)
+        hop_cache.set.assert_called_once_with(cached_url, [final_url, 'meta_tag'])
+
+    def test_get_redirect_history_hop_cache_error_not_cached(self):
+        url_test = 'http://test.com'
+        hop_cache = mock.Mock()
+        hop_cache.get = mock.Mock(return_value=None)
+
+        with mock.patch('lib.get_url', mock.Mock(return_value=(url_test, 'ERROR', None))):
+            get_redirect_history(url_test, 777, hop_cache=hop_cache)
+
+        self.assertFalse(hop_cache.set.called)
+
     #################################################################################################
 
     def test_prepare_url_none(self):
@@ -377,3 +638,43 @@ class InitLibTestCase(unittest.TestCase):
                 prepare_url('url')
                 
         self.assertTrue(urlunparse.called)
+
+    def test_prepare_url_result(self):
+        result = prepare_url(u'http://пример.рф/путь')
+        self.assertTrue(isinstance(result, PreparedUrl))
+        self.assertEqual('http://xn--e1afmkfd.xn--p1ai/%D0%BF%D1%83%D1%82%D1%8C', result)
+
+    def test_prepare_url_non_ascii_query(self):
+        result = prepare_url(u'http://url.ru/p?q=привет&a=%20b')
+        self.assertEqual('http://url.ru/p?q=%D0%BF%D1%80%D0%B8%D0%B2%D0%B5%D1%82&a=%20b', result)
+
+    def test_get_url_error_non_ascii_query(self):
+        url = prepare_url(u'http://url.ru/p?q=привет')
+        with mock.patch('lib.make_pycurl_request', mock.Mock(side_effect=pycurl.error(6, 'resolve'))):
+            self.assertEqual(url, get_url(url, 2)[0])
+
+        self.assertEqual(url + '#a', check_for_meta(
+            '<html><head><meta http-equiv="refresh" content="0; url=#a"></head></html>', url
+        ))
+
+    def test_prepare_url_prepared(self):
+        url = prepare_url('http://url.ru/path')
+        with mock.patch('lib.urlparse', mock.Mock()) as urlparse:
+            self.assertIs(url, prepare_url(url))
+
+        self.assertFalse(urlparse.called)
+
+    def test_prepare_url_memoized(self):
+        url = prepare_url('http://url.ru/path')
+        with mock.patch('lib.urlparse', mock.Mock()) as urlparse:
+            self.assertIs(url, prepare_url('http://url.ru/path'))
+
+        self.assertFalse(urlparse.called)
+
+    def test_prepare_url_cache_bounded(self):
+        with mock.patch('lib.URL_CACHE_SIZE', 2):
+            for path in ('a', 'b', 'c'):
+                prepare_url('http://url.ru/' + path)
+
+        self.assertEqual(['http://url.ru/c'], prepared_urls.keys())
+        self.assertEqual(['url.ru'], idna_hosts.keys())
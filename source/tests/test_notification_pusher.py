@@ -1,8 +1,11 @@
+import gevent
 import mock
 import requests
+import tarantool
 import unittest
 from notification_pusher import create_pidfile, notification_worker, done_with_processed_tasks
 import notification_pusher
+from common.retry import RetryPolicy
 
 
 def stop_main_loop(*args, **kwargs):
@@ -28,7 +31,7 @@ class NotificationPusherTestCase(unittest.TestCase):
         task_queue = mock.Mock()
 
         response = mock.Mock()
-        response.status_code = mock.Mock()
+        response.status_code = 200
 
         with mock.patch("requests.post", mock.Mock(return_value=response)):
             notification_worker(task, task_queue)
@@ -47,45 +50,62 @@ class NotificationPusherTestCase(unittest.TestCase):
         with mock.patch("requests.post", mock.Mock(side_effect=response)):
             notification_worker(task, task_queue)
 
-        task_queue.put.assert_called_with((task, "bury"))
+        task_queue.put.assert_called_with((task, "retry", "other"))
 
     def test_done_with_processed_tasks(self):
-        task = mock.Mock()
-        task.task_id = mock.Mock()
-        task.action_name = mock.Mock()
-
-        qsize = 3
+        queue = mock.Mock()
+        queue.space = 1
+        tasks = [mock.Mock(task_id=task_id, queue=queue) for task_id in (1, 2, 3)]
 
         task_queue = mock.Mock()
-        task_queue.get_nowait = mock.Mock(return_value= (task, "action_name"))
-        task_queue.qsize = mock.Mock(return_value=qsize)
+        task_queue.get_nowait = mock.Mock(side_effect=[(tasks[0], "ack"), (tasks[1], "bury"), (tasks[2], "ack")])
+        task_queue.qsize = mock.Mock(return_value=3)
 
-        done_with_processed_tasks(task_queue)
+        mock_call_pipelined = mock.Mock(return_value=[mock.Mock(), mock.Mock(), mock.Mock()])
 
-        self.assertTrue(task.action_name.call_count == qsize)
+        with mock.patch("notification_pusher.call_pipelined", mock_call_pipelined):
+            done_with_processed_tasks(task_queue)
+
+        mock_call_pipelined.assert_called_once_with(queue.tnt, [
+            ('queue.ack', ('1', 1)), ('queue.bury', ('1', 2)), ('queue.ack', ('1', 3))
+        ])
+        self.assertTrue(all(task.modified for task in tasks))
+        self.assertFalse(any(task.ack.called or task.bury.called for task in tasks))
 
     def test_done_with_processed_tasks_db_exception(self):
         task = mock.Mock()
-        task.task_id = mock.Mock()
-        task.action_name = mock.Mock()
+        task.task_id = 1
 
         task_queue = mock.Mock()
-        task_queue.get_nowait = mock.Mock(return_value=(task, "action_name"))
+        task_queue.get_nowait = mock.Mock(return_value=(task, "ack"))
         task_queue.qsize = mock.Mock(return_value=1)
 
         import tarantool
-        task.action_name = mock.Mock(side_effect=tarantool.DatabaseError())
         logger = mock.Mock()
         with mock.patch("notification_pusher.logger", logger):
-            done_with_processed_tasks(task_queue)
+            with mock.patch("notification_pusher.call_pipelined", mock.Mock(side_effect=tarantool.DatabaseError())):
+                done_with_processed_tasks(task_queue)
 
         self.assertTrue(logger.exception.called)
 
-    def test_done_with_processed_tasks_queue_empty_exception(self):
+    def test_done_with_processed_tasks_task_error(self):
         task = mock.Mock()
-        task.task_id = mock.Mock()
-        task.action_name = mock.Mock()
+        task.task_id = 1
 
+        task_queue = mock.Mock()
+        task_queue.get_nowait = mock.Mock(return_value=(task, "ack"))
+        task_queue.qsize = mock.Mock(return_value=1)
+
+        import tarantool
+        logger = mock.Mock()
+        with mock.patch("notification_pusher.logger", logger):
+            with mock.patch("notification_pusher.call_pipelined", mock.Mock(return_value=[tarantool.DatabaseError()])):
+                done_with_processed_tasks(task_queue)
+
+        self.assertTrue(logger.error.called)
+        self.assertFalse(logger.exception.called)
+
+    def test_done_with_processed_tasks_queue_empty_exception(self):
         task_queue = mock.Mock()
         task_queue.qsize = mock.Mock(return_value=1)
 
@@ -93,12 +113,27 @@ class NotificationPusherTestCase(unittest.TestCase):
         task_queue.get_nowait = mock.Mock(side_effect=gevent_queue.Empty)
 
         logger = mock.Mock()
+        mock_call_pipelined = mock.Mock()
 
         with mock.patch("notification_pusher.logger", logger):
-            done_with_processed_tasks(task_queue)
+            with mock.patch("notification_pusher.call_pipelined", mock_call_pipelined):
+                done_with_processed_tasks(task_queue)
 
         self.assertFalse(logger.exception.called)
-        self.assertFalse(task.action_name.called)
+        self.assertFalse(mock_call_pipelined.called)
+
+    def test_ack_worker(self):
+        task_queue = mock.Mock()
+        queue_lock = mock.MagicMock()
+        mock_done_with_processed_tasks = mock.Mock(side_effect=[None, gevent.GreenletExit])
+
+        with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
+            with self.assertRaises(gevent.GreenletExit):
+                notification_pusher.ack_worker(task_queue, queue_lock)
+
+        self.assertEqual(2, task_queue.peek.call_count)
+        self.assertEqual(2, queue_lock.__enter__.call_count)
+        mock_done_with_processed_tasks.assert_called_with(task_queue, None)
 
     def test_stop_handler(self):
         run_app = notification_pusher.run_application
@@ -118,12 +153,12 @@ class NotificationPusherTestCase(unittest.TestCase):
         config.QUEUE_SPACE = 1
         config.QUEUE_TUBE = 'queue_tube'
         config.QUEUE_TAKE_TIMEOUT = 1
+        config.QUEUE_TAKE_POLL = 0.1
         config.WORKER_POOL_SIZE = 1
-        config.SLEEP = 1
         config.HTTP_CONNECTION_TIMEOUT = 2
 
         tube = mock.MagicMock()
-        tube.take = mock.Mock(return_value=False)
+        tube.take = mock.Mock(side_effect=stop_main_loop)
         queue = mock.MagicMock()
         queue.tube = mock.Mock(return_value=tube)
 
@@ -134,22 +169,22 @@ class NotificationPusherTestCase(unittest.TestCase):
 
         mock_done_with_processed_tasks = mock.Mock()
         mock_logger = mock.Mock()
-        mock_sleep = mock.Mock(side_effect=stop_main_loop)
+        acker = mock.Mock()
 
         with mock.patch("notification_pusher.logger", mock_logger):
             with mock.patch("notification_pusher.tarantool_queue.Queue", mock.Mock(return_value=queue)):
                 with mock.patch("notification_pusher.Pool", mock.Mock(return_value=worker_pool)):
                     with mock.patch("notification_pusher.gevent_queue.Queue", mock.Mock(return_value=processed_task_queue)):
-                        with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
-                            with mock.patch("notification_pusher.sleep", mock_sleep):
+                        with mock.patch("notification_pusher.gevent.spawn", mock.Mock(return_value=acker)):
+                            with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
                                 with mock.patch("notification_pusher.run_application", True):
                                     notification_pusher.main_loop(config)
 
-        worker_pool.free_count.assert_called_once_with()
-        tube.take.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
-        mock_done_with_processed_tasks.assert_called_once_with(processed_task_queue)
-        mock_sleep.assert_called_once_with(config.SLEEP)
-        self.assertTrue(mock_logger.debug.call_count == 2)
+        worker_pool.wait_available.assert_called_once_with()
+        tube.take.assert_called_once_with(config.QUEUE_TAKE_POLL)
+        acker.kill.assert_called_once_with()
+        mock_done_with_processed_tasks.assert_called_once_with(processed_task_queue, mock.ANY)
+        self.assertTrue(mock_logger.debug.call_count == 1)
         self.assertFalse(worker_pool.add.called)
 
     def test_main_loop_run_app_with_task(self):
@@ -159,13 +194,18 @@ class NotificationPusherTestCase(unittest.TestCase):
         config.QUEUE_SPACE = 1
         config.QUEUE_TUBE = 'queue_tube'
         config.QUEUE_TAKE_TIMEOUT = 1
+        config.QUEUE_TAKE_POLL = 0.1
         config.WORKER_POOL_SIZE = 1
-        config.SLEEP = 1
         config.HTTP_CONNECTION_TIMEOUT = 2
 
         task = mock.MagicMock()
         tube = mock.MagicMock()
-        tube.take = mock.Mock(return_value=task)
+
+        def take(timeout):
+            stop_main_loop()
+            return task
+
+        tube.take = mock.Mock(side_effect=take)
         queue = mock.MagicMock()
         queue.tube = mock.Mock(return_value=tube)
 
@@ -176,22 +216,22 @@ class NotificationPusherTestCase(unittest.TestCase):
 
         mock_done_with_processed_tasks = mock.Mock()
         mock_logger = mock.Mock()
-        mock_sleep = mock.Mock(side_effect=stop_main_loop)
+        acker = mock.Mock()
 
         with mock.patch("notification_pusher.logger", mock_logger):
             with mock.patch("notification_pusher.tarantool_queue.Queue", mock.Mock(return_value=queue)):
                 with mock.patch("notification_pusher.Pool", mock.Mock(return_value=worker_pool)):
                     with mock.patch("notification_pusher.gevent_queue.Queue", mock.Mock(return_value=processed_task_queue)):
-                        with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
-                            with mock.patch("notification_pusher.sleep", mock_sleep):
+                        with mock.patch("notification_pusher.gevent.spawn", mock.Mock(return_value=acker)):
+                            with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
                                 with mock.patch("notification_pusher.run_application", True):
                                     notification_pusher.main_loop(config)
 
-        worker_pool.free_count.assert_called_once_with()
-        tube.take.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
-        mock_done_with_processed_tasks.assert_called_once_with(processed_task_queue)
-        mock_sleep.assert_called_once_with(config.SLEEP)
-        self.assertTrue(mock_logger.debug.call_count == 2)
+        worker_pool.wait_available.assert_called_once_with()
+        tube.take.assert_called_once_with(config.QUEUE_TAKE_POLL)
+        acker.kill.assert_called_once_with()
+        mock_done_with_processed_tasks.assert_called_once_with(processed_task_queue, mock.ANY)
+        self.assertTrue(mock_logger.debug.call_count == 1)
         self.assertTrue(worker_pool.add.called)
 
     def test_main_loop_not_run_app(self):
@@ -201,8 +241,8 @@ class NotificationPusherTestCase(unittest.TestCase):
         config.QUEUE_SPACE = 1
         config.QUEUE_TUBE = 'queue_tube'
         config.QUEUE_TAKE_TIMEOUT = 1
+        config.QUEUE_TAKE_POLL = 0.1
         config.WORKER_POOL_SIZE = 1
-        config.SLEEP = 1
         config.HTTP_CONNECTION_TIMEOUT = 2
 
         tube = mock.MagicMock()
@@ -217,19 +257,45 @@ class NotificationPusherTestCase(unittest.TestCase):
 
         mock_done_with_processed_tasks = mock.Mock()
         mock_logger = mock.Mock()
-        mock_sleep = mock.Mock(side_effect=stop_main_loop)
+        acker = mock.Mock()
 
         with mock.patch("notification_pusher.logger", mock_logger):
             with mock.patch("notification_pusher.tarantool_queue.Queue", mock.Mock(return_value=queue)):
                 with mock.patch("notification_pusher.Pool", mock.Mock(return_value=mock_worker_pool)):
                     with mock.patch("notification_pusher.gevent_queue.Queue", mock.Mock(return_value=processed_task_queue)):
-                        with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
-                            with mock.patch("notification_pusher.sleep", mock_sleep):
+                        with mock.patch("notification_pusher.gevent.spawn", mock.Mock(return_value=acker)):
+                            with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
                                 with mock.patch("notification_pusher.run_application", False):
                                     notification_pusher.main_loop(config)
 
+        self.assertFalse(mock_worker_pool.wait_available.called)
+        acker.kill.assert_called_once_with()
+        mock_done_with_processed_tasks.assert_called_once_with(processed_task_queue, mock.ANY)
+
+    def test_main_loop_error_kills_acker(self):
+        config = mock.MagicMock()
+        config.QUEUE_TAKE_TIMEOUT = 1
+        config.QUEUE_TAKE_POLL = 0.1
+        config.WORKER_POOL_SIZE = 1
+
+        tube = mock.MagicMock()
+        tube.take = mock.Mock(side_effect=tarantool.DatabaseError())
+        queue = mock.MagicMock()
+        queue.tube = mock.Mock(return_value=tube)
+
+        mock_done_with_processed_tasks = mock.Mock()
+        acker = mock.Mock()
+
+        with mock.patch("notification_pusher.logger", mock.Mock()):
+            with mock.patch("notification_pusher.tarantool_queue.Queue", mock.Mock(return_value=queue)):
+                with mock.patch("notification_pusher.Pool", mock.Mock()):
+                    with mock.patch("notification_pusher.gevent.spawn", mock.Mock(return_value=acker)):
+                        with mock.patch("notification_pusher.done_with_processed_tasks", mock_done_with_processed_tasks):
+                            with mock.patch("notification_pusher.run_application", True):
+                                self.assertRaises(tarantool.DatabaseError, notification_pusher.main_loop, config)
+
+        acker.kill.assert_called_once_with()
         self.assertFalse(mock_done_with_processed_tasks.called)
-        self.assertFalse(mock_sleep.called)
 
     def test_parse_cmd_args(self):
         arg = mock.Mock()
@@ -293,6 +359,17 @@ class NotificationPusherTestCase(unittest.TestCase):
             'value_key_2': 'value_2'
         })
 
+    def test_apply_config_aliases(self):
+        cfg = notification_pusher.Config()
+        cfg.SLEEP = 0.5
+
+        notification_pusher.apply_config_aliases(cfg)
+        self.assertEqual(0.5, cfg.QUEUE_TAKE_POLL)
+
+        cfg.SLEEP = 2
+        notification_pusher.apply_config_aliases(cfg)
+        self.assertEqual(0.5, cfg.QUEUE_TAKE_POLL)
+
     def test_install_signal_handlers(self):
         mock_signal = mock.Mock()
         mock_signal.SIGTERM = 13
@@ -430,4 +507,359 @@ class NotificationPusherTestCase(unittest.TestCase):
         mock_create_pidfile.assert_called_once_with(args.pidfile)
         self.assertTrue(mock_main_loop.called)
         self.assertTrue(mock_sleep.called)
-        self.assertTrue(code == notification_pusher.exit_code)
\ No newline at end of file
+        self.assertTrue(code == notification_pusher.exit_code)
+    def test_notification_worker_session_pool(self):
+        task = mock.Mock()
+        task.data.copy = mock.Mock(return_value={"callback_url": "callback_url"})
+        task.task_id = 13
+        task_queue = mock.Mock()
+        session_pool = mock.Mock()
+        session_pool.post.return_value.status_code = 200
+
+        with mock.patch("requests.post", mock.Mock()) as mock_post:
+            notification_worker(task, task_queue, session_pool=session_pool, timeout=2)
+
+        self.assertFalse(mock_post.called)
+        session_pool.post.assert_called_once_with("callback_url", data='{"id": 13}', timeout=2)
+        task_queue.put.assert_called_with((task, "ack"))
+
+    def test_notification_worker_retried_task(self):
+        task = mock.Mock()
+        task.data.copy = mock.Mock(return_value={"callback_url": "callback_url", "attempts": 2, "origin_id": 7})
+        task.task_id = 13
+        task_queue = mock.Mock()
+        session_pool = mock.Mock()
+        session_pool.post.return_value.status_code = 200
+
+        notification_worker(task, task_queue, session_pool=session_pool)
+
+        session_pool.post.assert_called_once_with("callback_url", data='{"id": 7}')
+
+    def test_session_pool_post(self):
+        session_pool = notification_pusher.SessionPool(pool_size=2, idle_timeout=60)
+        sessions = [mock.Mock(), mock.Mock()]
+
+        with mock.patch("notification_pusher.requests.Session", mock.Mock(side_effect=sessions)):
+            session_pool.post("http://host.ru/first", data="1")
+            session_pool.post("http://host.ru/second", data="2")
+            session_pool.post("https://other.ru/", data="3")
+
+        self.assertEqual(2, sessions[0].post.call_count)
+        sessions[1].post.assert_called_once_with("https://other.ru/", data="3")
+        self.assertEqual({'hosts': 2, 'requests': 3, 'connections': 0}, session_pool.stats())
+
+    def test_session_pool_expire(self):
+        session_pool = notification_pusher.SessionPool(pool_size=2, idle_timeout=60)
+        idle, active = mock.Mock(), mock.Mock()
+        session_pool.sessions = {
+            ('http', 'idle.ru'): [idle, mock.MagicMock(), 0, 100],
+            ('http', 'active.ru'): [active, mock.MagicMock(), 1, 100],
+        }
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=200)):
+            session_pool.expire()
+
+        self.assertTrue(idle.close.called)
+        self.assertFalse(active.close.called)
+        self.assertEqual([('http', 'active.ru')], session_pool.sessions.keys())
+
+    def test_notification_worker_callback_hosts(self):
+        task = mock.Mock()
+        task.data.copy = mock.Mock(return_value={"callback_url": "callback_url"})
+        task.task_id = 13
+        task_queue = mock.Mock()
+        session_pool = mock.Mock()
+        session_pool.post.return_value.status_code = 503
+        callback_hosts = mock.Mock()
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(side_effect=[10, 10, 12])):
+            notification_worker(task, task_queue, session_pool=session_pool, callback_hosts=callback_hosts)
+
+        callback_hosts.record.assert_called_once_with("callback_url", False, 2)
+
+    def test_token_bucket(self):
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=100)):
+            bucket = notification_pusher.TokenBucket(rate=2, burst=2)
+            self.assertEqual([0, 0, 0.5], [bucket.take(), bucket.take(), bucket.take()])
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=100.5)):
+            self.assertEqual(0, bucket.take())
+            self.assertEqual(0.5, bucket.take())
+
+    def test_circuit_breaker(self):
+        circuit = notification_pusher.CircuitBreaker(
+            'host.ru', window=4, min_requests=2, error_rate=0.5, slow_time=10, open_time=30
+        )
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=100)):
+            circuit.record(True, 1)
+            circuit.record(True, 1)
+            circuit.record(True, 1)
+            self.assertEqual(circuit.CLOSED, circuit.state)
+            circuit.record(False, 1)
+            circuit.record(True, 15)
+            self.assertEqual(circuit.OPEN, circuit.state)
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=120)):
+            self.assertEqual(10, circuit.get_delay())
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=130)):
+            self.assertEqual(0, circuit.get_delay())
+            circuit.start()
+            self.assertEqual(circuit.HALF_OPEN, circuit.state)
+            self.assertEqual(30, circuit.get_delay())
+            circuit.record(False, 1)
+            self.assertEqual(circuit.OPEN, circuit.state)
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=160)):
+            self.assertEqual(0, circuit.get_delay())
+            circuit.start()
+            circuit.record(True, 1)
+            self.assertEqual(circuit.CLOSED, circuit.state)
+            self.assertEqual(0, circuit.get_delay())
+
+    def test_callback_hosts_acquire(self):
+        callback_hosts = notification_pusher.CallbackHosts((4, 1, 0.5, 10, 30), rate=1, burst=1)
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=100)):
+            self.assertEqual(0, callback_hosts.acquire("http://host.ru/first"))
+            self.assertEqual(1, callback_hosts.acquire("http://host.ru/second"))
+            self.assertEqual(0, callback_hosts.acquire("http://other.ru/"))
+            callback_hosts.record("http://other.ru/", False, 1)
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=110)):
+            self.assertEqual(0, callback_hosts.acquire("http://host.ru/"))
+            self.assertEqual(20, callback_hosts.acquire("http://other.ru/"))
+
+    def test_callback_hosts_expire(self):
+        callback_hosts = notification_pusher.CallbackHosts((4, 1, 0.5, 10, 30), idle_timeout=60)
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=100)):
+            callback_hosts.record("http://idle.ru/", True, 1)
+            callback_hosts.record("http://failing.ru/", False, 1)
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(return_value=200)):
+            callback_hosts.expire()
+
+        self.assertEqual([('http', 'failing.ru')], callback_hosts.hosts.keys())
+
+    def test_main_loop_postpone_task(self):
+        config = mock.MagicMock()
+        config.QUEUE_TAKE_TIMEOUT = 1
+        config.QUEUE_TAKE_POLL = 0.1
+
+        task = mock.MagicMock()
+        task.data = {'callback_url': 'http://host.ru/'}
+        tube = mock.MagicMock()
+
+        def take(timeout):
+            stop_main_loop()
+            return task
+
+        tube.take = mock.Mock(side_effect=take)
+        queue = mock.MagicMock()
+        queue.tube = mock.Mock(return_value=tube)
+
+        processed_task_queue = mock.MagicMock()
+        worker_pool = mock.Mock()
+        callback_hosts = mock.Mock()
+        callback_hosts.acquire = mock.Mock(return_value=5)
+
+        with mock.patch("notification_pusher.logger", mock.Mock()):
+            with mock.patch("notification_pusher.tarantool_queue.Queue", mock.Mock(return_value=queue)):
+                with mock.patch("notification_pusher.Pool", mock.Mock(return_value=worker_pool)):
+                    with mock.patch("notification_pusher.gevent_queue.Queue", mock.Mock(return_value=processed_task_queue)):
+                        with mock.patch("notification_pusher.gevent.spawn", mock.Mock()):
+                            with mock.patch("notification_pusher.done_with_processed_tasks", mock.Mock()):
+                                with mock.patch("notification_pusher.CallbackHosts", mock.Mock(return_value=callback_hosts)):
+                                    with mock.patch("notification_pusher.run_application", True):
+                                        notification_pusher.main_loop(config)
+
+        callback_hosts.acquire.assert_called_once_with('http://host.ru/')
+        processed_task_queue.put.assert_called_once_with((task, 'release', 5))
+        self.assertFalse(worker_pool.add.called)
+
+    def test_take_task_polls_until_timeout(self):
+        tube = mock.Mock()
+        tube.take = mock.Mock(return_value=None)
+        queue_lock = mock.MagicMock()
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(side_effect=[100, 100.1, 100.2, 101])):
+            with mock.patch("notification_pusher.sleep", mock.Mock()):
+                with mock.patch("notification_pusher.run_application", True):
+                    self.assertIsNone(notification_pusher.take_task(tube, queue_lock, 1, 0.1))
+
+        self.assertEqual([mock.call(0.1)] * 3, tube.take.call_args_list)
+        self.assertEqual(3, queue_lock.__exit__.call_count)
+
+    def test_take_task(self):
+        task = mock.Mock()
+        tube = mock.Mock()
+        tube.take = mock.Mock(side_effect=[None, task])
+
+        with mock.patch("notification_pusher.time.time", mock.Mock(side_effect=[100, 100.1])):
+            with mock.patch("notification_pusher.sleep", mock.Mock()):
+                with mock.patch("notification_pusher.run_application", True):
+                    self.assertIs(task, notification_pusher.take_task(tube, mock.MagicMock(), 1, 0.1))
+
+    def test_done_with_processed_tasks_release(self):
+        task = mock.Mock()
+        task.task_id = 7
+        task.queue.space = 1
+
+        task_queue = mock.Mock()
+        task_queue.get_nowait = mock.Mock(return_value=(task, "release", 5))
+        task_queue.qsize = mock.Mock(return_value=1)
+
+        mock_call_pipelined = mock.Mock(return_value=[mock.Mock()])
+
+        with mock.patch("notification_pusher.call_pipelined", mock_call_pipelined):
+            done_with_processed_tasks(task_queue)
+
+        mock_call_pipelined.assert_called_once_with(task.queue.tnt, [('queue.release', ('1', '7', '5', '0'))])
+
+    def test_notification_worker_error_status(self):
+        task = mock.Mock()
+        task.data.copy = mock.Mock(side_effect=lambda: {"callback_url": "callback_url"})
+        task.task_id = 13
+        task_queue = mock.Mock()
+        response = mock.Mock()
+
+        for status_code, error_class in ((502, 'http_5xx'), (404, 'http_4xx')):
+            response.status_code = status_code
+            with mock.patch("requests.post", mock.Mock(return_value=response)):
+                notification_worker(task, task_queue)
+
+            task_queue.put.assert_called_with((task, "retry", error_class))
+
+    def test_notification_worker_timeout(self):
+        task = mock.Mock()
+        task.data.copy = mock.Mock(side_effect=lambda: {"callback_url": "callback_url"})
+        task.task_id = 13
+        task_queue = mock.Mock()
+
+        with mock.patch("notification_pusher.logger", mock.Mock()):
+            with mock.patch("requests.post", mock.Mock(side_effect=requests.Timeout())):
+                notification_worker(task, task_queue)
+            with mock.patch("requests.post", mock.Mock(side_effect=requests.ConnectionError())):
+                notification_worker(task, task_queue)
+
+        self.assertEqual(
+            [mock.call((task, "retry", "timeout")), mock.call((task, "retry", "connect"))],
+            task_queue.put.call_args_list
+        )
+
+    def test_get_retry_action(self):
+        task = mock.Mock()
+        task.data = {'callback_url': 'callback_url', 'attempts': 1}
+        retry_policy = mock.Mock()
+        retry_policy.get_delay = mock.Mock(return_value=60)
+
+        self.assertEqual((task, 'put', 60), notification_pusher.get_retry_action(task, 'http_5xx', retry_policy))
+        retry_policy.get_delay.assert_called_once_with('http_5xx', 2)
+
+    def test_get_retry_action_out_of_retries(self):
+        task = mock.Mock()
+        task.data = {'callback_url': 'callback_url', 'attempts': 5}
+        retry_policy = RetryPolicy({'http_5xx': (5, 60)})
+
+        with mock.patch("notification_pusher.logger", mock.Mock()):
+            self.assertEqual((task, 'bury'), notification_pusher.get_retry_action(task, 'http_5xx', retry_policy))
+        self.assertEqual((task, 'bury'), notification_pusher.get_retry_action(task, 'http_5xx', None))
+
+    def test_get_retry_action_first_attempt(self):
+        task = mock.Mock()
+        task.data = None
+        retry_policy = mock.Mock()
+        retry_policy.get_delay = mock.Mock(return_value=60)
+
+        with mock.patch("notification_pusher.logger", mock.Mock()):
+            self.assertEqual((task, 'put', 60), notification_pusher.get_retry_action(task, 'other', retry_policy))
+        retry_policy.get_delay.assert_called_once_with('other', 1)
+
+    def test_get_retry_data(self):
+        task = mock.Mock()
+        task.task_id = 7
+        task.data = {'callback_url': 'callback_url'}
+
+        retry_data = notification_pusher.get_retry_data(task)
+
+        self.assertEqual({'callback_url': 'callback_url', 'attempts': 1, 'origin_id': 7}, retry_data)
+        task.data = retry_data
+        task.task_id = 8
+        self.assertEqual(
+            {'callback_url': 'callback_url', 'attempts': 2, 'origin_id': 7}, notification_pusher.get_retry_data(task)
+        )
+
+    def test_put_retried_tasks(self):
+        queue = mock.Mock()
+        acked, retried, failed = mock.Mock(), mock.Mock(data={}), mock.Mock(data={})
+        processed = [(acked, 'ack'), (retried, 'put', 30), (failed, 'put', 60)]
+        mock_call_pipelined = mock.Mock(return_value=[mock.Mock(), tarantool.DatabaseError()])
+
+        mock_get_retry_options = mock.Mock(return_value={'pri': 3})
+
+        with mock.patch("notification_pusher.call_pipelined", mock_call_pipelined):
+            with mock.patch("notification_pusher.get_put_args", mock.Mock(return_value=('args',))) as get_put_args:
+                with mock.patch("notification_pusher.get_retry_options", mock_get_retry_options):
+                    with mock.patch("notification_pusher.logger", mock.Mock()):
+                        self.assertEqual(
+                            [(acked, 'ack'), (retried, 'ack'), (failed, 'release', 60)],
+                            notification_pusher.put_retried_tasks(queue, processed)
+                        )
+
+        mock_call_pipelined.assert_called_once_with(queue.tnt, [('queue.put', ('args',))] * 2)
+        get_put_args.assert_any_call(queue.tube(retried.tube), mock.ANY, delay=30, pri=3)
+        mock_get_retry_options.assert_any_call(retried)
+
+    def test_get_retry_options(self):
+        task = mock.Mock()
+        task.meta = mock.Mock(return_value={
+            'created': 10 * 10 ** 6, 'ttl': 100 * 10 ** 6, 'now': 40 * 10 ** 6, 'ttr': 5 * 10 ** 6, 'pri': 7
+        })
+        self.assertEqual({'ttl': 70, 'ttr': 5, 'pri': 7}, notification_pusher.get_retry_options(task))
+
+    def test_get_retry_options_expiring(self):
+        task = mock.Mock()
+        task.meta = mock.Mock(return_value={
+            'created': 10 * 10 ** 6, 'ttl': 100 * 10 ** 6, 'now': 120 * 10 ** 6, 'ttr': 0, 'pri': 0
+        })
+        self.assertEqual(1, notification_pusher.get_retry_options(task)['ttl'])
+
+    def test_get_retry_options_meta_fail(self):
+        task = mock.Mock()
+        task.meta = mock.Mock(side_effect=tarantool.DatabaseError())
+        with mock.patch("notification_pusher.logger", mock.Mock()):
+            self.assertEqual({}, notification_pusher.get_retry_options(task))
+
+        task.meta = mock.Mock(return_value=None)
+        self.assertEqual({}, notification_pusher.get_retry_options(task))
+
+    def test_put_retried_tasks_nothing_to_put(self):
+        processed = [(mock.Mock(), 'ack')]
+        mock_call_pipelined = mock.Mock()
+
+        with mock.patch("notification_pusher.call_pipelined", mock_call_pipelined):
+            self.assertIs(processed, notification_pusher.put_retried_tasks(mock.Mock(), processed))
+
+        self.assertFalse(mock_call_pipelined.called)
+
+    def test_done_with_processed_tasks_retry(self):
+        task = mock.Mock()
+        task.task_id = 7
+        task.queue.space = 1
+
+        task_queue = mock.Mock()
+        task_queue.get_nowait = mock.Mock(return_value=(task, "retry", "timeout"))
+        task_queue.qsize = mock.Mock(return_value=1)
+
+        mock_call_pipelined = mock.Mock(return_value=[mock.Mock()])
+        mock_put_retried_tasks = mock.Mock(return_value=[(task, 'ack')])
+
+        with mock.patch("notification_pusher.call_pipelined", mock_call_pipelined):
+            with mock.patch("notification_pusher.get_retry_action", mock.Mock(return_value=(task, 'put', 30))):
+                with mock.patch("notification_pusher.put_retried_tasks", mock_put_retried_tasks):
+                    done_with_processed_tasks(task_queue, mock.Mock())
+
+        mock_put_retried_tasks.assert_called_once_with(task.queue, [(task, 'put', 30)])
+        mock_call_pipelined.assert_called_once_with(task.queue.tnt, [('queue.ack', ('1', 7))])
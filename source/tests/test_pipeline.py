@@ -0,0 +1,71 @@
+# coding: utf-8
+import mock
+import socket
+import struct
+import unittest
+from tarantool import Connection
+from tarantool.error import DatabaseError
+from common import pipeline
+from lib.connections import ReconnectingConnection
+
+
+def make_response(return_code=0, message=''):
+    body = struct.pack('<LL', return_code, 0) + message
+    return struct.pack('<LLL', 22, len(body), 0), body
+
+
+class PipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection('localhost', 33013, connect_now=False)
+        self.connection._opt_reconnect = mock.Mock()
+        self.connection._socket = mock.Mock()
+
+    def test_call_pipelined(self):
+        self.connection._read_response = mock.Mock(
+            side_effect=[make_response(), make_response((1 << 8) | 2, 'error\x00')]
+        )
+
+        responses = pipeline.call_pipelined(self.connection, [('queue.ack', ('0', 'a')), ('queue.ack', ('0', 'b'))])
+
+        self.assertEqual(1, self.connection._socket.sendall.call_count)
+        self.assertEqual(0, responses[0].return_code)
+        self.assertIsInstance(responses[1], DatabaseError)
+
+    def test_call_pipelined_network_error(self):
+        self.connection._read_response = mock.Mock(side_effect=socket.error)
+        sock = self.connection._socket
+
+        with self.assertRaises(socket.error):
+            pipeline.call_pipelined(self.connection, [('queue.ack', ('0', 'a'))])
+
+        self.assertTrue(sock.close.called)
+        self.assertIsNone(self.connection._socket)
+
+    def test_call_pipelined_reconnecting_connection(self):
+        connection = ReconnectingConnection('localhost', 33013)
+        sock = mock.Mock()
+
+        def reconnect():
+            connection._socket = sock
+
+        connection._opt_reconnect = mock.Mock(side_effect=reconnect)
+        connection._read_response = mock.Mock(side_effect=[socket.error(), make_response()])
+
+        with mock.patch('lib.connections.time.sleep', mock.Mock()):
+            responses = pipeline.call_pipelined(connection, [('queue.ack', ('0', 'a'))])
+
+        self.assertEqual(0, responses[0].return_code)
+        self.assertEqual(2, sock.sendall.call_count)
+        self.assertEqual(1, connection.reconnects)
+
+    def test_get_put_args(self):
+        tube = mock.Mock()
+        tube.queue.space = 0
+        tube.opt = {'delay': 0, 'ttl': 0, 'ttr': 0, 'pri': 0, 'tube': 'name'}
+        tube.serialize = mock.Mock(return_value='packed')
+
+        self.assertEqual(
+            ('0', 'name', '300', '0', '0', '5', 'packed'),
+            pipeline.get_put_args(tube, {'data': 1}, delay=300, pri=5)
+        )
+        tube.serialize.assert_called_once_with({'data': 1})
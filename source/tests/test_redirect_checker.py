@@ -8,102 +8,78 @@ def stop_loop(*args, **kwargs):
 
 
 class RedirectCheckerTestCase(unittest.TestCase):
-    def test_main_loop_status_workers(self):
-        pid = 13
-        mock_os_getpid = mock.Mock(return_value=pid)
-
-        mock_check_net_status = mock.Mock(return_value=True)
-
-        config = mock.Mock()
-        config.WORKER_POOL_SIZE = 100
-        config.SLEEP = 1
-        config.CHECK_URL = 'CHECK_URL'
-        config.HTTP_TIMEOUT = 100
+    def run_main_loop(self, config, network_status):
+        supervisor = mock.MagicMock()
+        supervisor.wait = mock.Mock(side_effect=stop_loop)
+        mock_supervisor = mock.Mock(return_value=supervisor)
 
-        child = mock.MagicMock()
-        active_children = [child, child]
-        mock_active_children = mock.Mock(return_value=active_children)
+        network_monitor = mock.Mock()
+        network_monitor.check = mock.Mock(return_value=network_status)
 
-        mock_spawn_workers = mock.Mock()
-
-        mock_sleep = mock.Mock(side_effect=stop_loop)
-
-        with mock.patch("os.getpid", mock_os_getpid):
-            with mock.patch("redirect_checker.check_network_status", mock_check_net_status):
-                with mock.patch("redirect_checker.active_children", mock_active_children):
-                    with mock.patch("redirect_checker.spawn_workers", mock_spawn_workers):
-                        with mock.patch("redirect_checker.sleep", mock_sleep):
-                            redirect_checker.main_loop(config=config)
-
-        mock_sleep.assert_called_once_with(config.SLEEP)
-        assert mock_spawn_workers.call_count == 1
+        with mock.patch("os.getpid", mock.Mock(return_value=13)):
+            with mock.patch("redirect_checker.NetworkMonitor", mock.Mock(return_value=network_monitor)):
+                with mock.patch("redirect_checker.Supervisor", mock_supervisor):
+                    with mock.patch("redirect_checker.get_tube", mock.Mock()):
+                        redirect_checker.main_loop(config=config)
 
         redirect_checker.is_run = True
+        return mock_supervisor, supervisor
 
-    def test_main_loop_status_no_workers(self):
-        pid = 13
-        mock_os_getpid = mock.Mock(return_value=pid)
-
-        mock_check_net_status = mock.Mock(return_value=True)
-
+    def test_main_loop_status_workers(self):
         config = mock.Mock()
-        config.WORKER_POOL_SIZE = 2
+        config.WORKER_POOL_SIZE = 100
+        config.WORKER_CONCURRENCY = 1
+        config.AUTOSCALE = False
         config.SLEEP = 1
-        config.CHECK_URL = 'CHECK_URL'
+        config.CHECK_URLS = ['CHECK_URL']
         config.HTTP_TIMEOUT = 100
 
-        child = mock.MagicMock()
-        active_children = [child, child]
-        mock_active_children = mock.Mock(return_value=active_children)
+        mock_supervisor, supervisor = self.run_main_loop(config, True)
 
-        mock_spawn_workers = mock.Mock()
+        mock_supervisor.assert_called_once_with(
+            redirect_checker.worker, (config,), 13,
+            config.RESPAWN_DELAY, config.RESPAWN_DELAY_MAX, config.WORKER_MIN_UPTIME
+        )
+        supervisor.resume.assert_called_once_with()
+        supervisor.resize.assert_called_once_with(100)
+        supervisor.wait.assert_called_once_with(config.SLEEP)
+        supervisor.shutdown.assert_called_once_with(config.DRAIN_TIMEOUT)
 
-        mock_sleep = mock.Mock(side_effect=stop_loop)
+    def test_main_loop_concurrent_workers(self):
+        config = mock.Mock()
+        config.WORKER_CONCURRENCY = 10
+        config.AUTOSCALE = False
 
-        with mock.patch("os.getpid", mock_os_getpid):
-            with mock.patch("redirect_checker.check_network_status", mock_check_net_status):
-                with mock.patch("redirect_checker.active_children", mock_active_children):
-                    with mock.patch("redirect_checker.spawn_workers", mock_spawn_workers):
-                        with mock.patch("redirect_checker.sleep", mock_sleep):
-                            redirect_checker.main_loop(config=config)
+        mock_supervisor, _ = self.run_main_loop(config, True)
 
-        mock_sleep.assert_called_once_with(config.SLEEP)
-        assert mock_spawn_workers.call_count == 0
+        self.assertEqual(redirect_checker.concurrent_worker, mock_supervisor.call_args[0][0])
 
-        redirect_checker.is_run = True
+    def test_main_loop_autoscale(self):
+        config = mock.Mock()
+        config.WORKER_CONCURRENCY = 1
+        autoscaler = mock.Mock()
+        autoscaler.get_size = mock.Mock(return_value=7)
 
-    def test_main_loop_false_status(self):
-        pid = 13
-        mock_os_getpid = mock.Mock(return_value=pid)
+        with mock.patch("redirect_checker.Autoscaler", mock.Mock(return_value=autoscaler)):
+            _, supervisor = self.run_main_loop(config, True)
 
-        mock_check_net_status = mock.Mock(return_value=False)
+        supervisor.resize.assert_called_once_with(7)
+        autoscaler.get_size.assert_called_once_with(len(supervisor))
 
+    def test_main_loop_false_status(self):
         config = mock.Mock()
         config.WORKER_POOL_SIZE = 2
+        config.AUTOSCALE = False
         config.SLEEP = 1
-        config.CHECK_URL = 'CHECK_URL'
+        config.CHECK_URLS = ['CHECK_URL']
         config.HTTP_TIMEOUT = 100
 
-        child = mock.MagicMock()
-        active_children = [child, child]
-        mock_active_children = mock.Mock(return_value=active_children)
-
-        mock_spawn_workers = mock.Mock()
-
-        mock_sleep = mock.Mock(side_effect=stop_loop)
+        _, supervisor = self.run_main_loop(config, False)
 
-        with mock.patch("os.getpid", mock_os_getpid):
-            with mock.patch("redirect_checker.check_network_status", mock_check_net_status):
-                with mock.patch("redirect_checker.active_children", mock_active_children):
-                    with mock.patch("redirect_checker.spawn_workers", mock_spawn_workers):
-                        with mock.patch("redirect_checker.sleep", mock_sleep):
-                            redirect_checker.main_loop(config=config)
-
-        mock_sleep.assert_called_once_with(config.SLEEP)
-        assert mock_spawn_workers.call_count == 0
-        assert child.terminate.call_count == 2
-
-        redirect_checker.is_run = True
+        self.assertFalse(supervisor.resize.called)
+        self.assertFalse(supervisor.stop.called)
+        supervisor.pause.assert_called_once_with()
+        supervisor.wait.assert_called_once_with(config.SLEEP)
 
     def test_main(self):
         argv = mock.MagicMock()
@@ -121,7 +97,8 @@ class RedirectCheckerTestCase(unittest.TestCase):
                             with mock.patch("os.path.expanduser", mock.Mock()):
                                 with mock.patch("redirect_checker.dictConfig", mock.Mock()):
                                     with mock.patch("redirect_checker.main_loop", mock.Mock()):
-                                        exit_code = redirect_checker.main(argv)
+                                        with mock.patch("redirect_checker.signal", mock.Mock()):
+                                            exit_code = redirect_checker.main(argv)
 
         mock_daemonize.assert_called()
         mock_create_pidfile.assert_called()
@@ -145,7 +122,8 @@ class RedirectCheckerTestCase(unittest.TestCase):
                             with mock.patch("os.path.expanduser", mock.Mock()):
                                 with mock.patch("redirect_checker.dictConfig", mock.Mock()):
                                     with mock.patch("redirect_checker.main_loop", mock.Mock()):
-                                        exit_code = redirect_checker.main(argv)
+                                        with mock.patch("redirect_checker.signal", mock.Mock()):
+                                            exit_code = redirect_checker.main(argv)
         assert mock_daemonize.call_count == 0
         assert mock_create_pidfile.call_count == 0
         assert exit_code == config.EXIT_CODE
@@ -0,0 +1,28 @@
+# coding: utf-8
+import mock
+import unittest
+from common import retry
+
+
+class RetryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.policy = retry.RetryPolicy({'timeout': (3, 10), 'tls': (0, 0), 'other': (1, 5)}, delay_max=30, jitter=0.5)
+
+    def test_get_delay_backoff(self):
+        with mock.patch('common.retry.random.random', mock.Mock(return_value=0)):
+            self.assertEqual([10, 20, 30], [self.policy.get_delay('timeout', attempt) for attempt in (1, 2, 3)])
+
+    def test_get_delay_jitter(self):
+        with mock.patch('common.retry.random.random', mock.Mock(return_value=1)):
+            self.assertEqual(5, self.policy.get_delay('timeout', 1))
+
+    def test_get_delay_attempts_exhausted(self):
+        self.assertIsNone(self.policy.get_delay('timeout', 4))
+
+    def test_get_delay_no_retry(self):
+        self.assertIsNone(self.policy.get_delay('tls', 1))
+
+    def test_get_delay_unknown_class(self):
+        with mock.patch('common.retry.random.random', mock.Mock(return_value=0)):
+            self.assertEqual(5, self.policy.get_delay('dns', 1))
+        self.assertIsNone(self.policy.get_delay('dns', 2))
@@ -0,0 +1,71 @@
+# coding: utf-8
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+from lib import scheduler
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'hosts.sqlite')
+
+    def get_scheduler(self, **kwargs):
+        params = dict(max_in_flight=2, backoff=10, backoff_max=25, defer_delay=5, slot_ttl=60)
+        params.update(kwargs)
+        return scheduler.HostScheduler(self.path, **params)
+
+    def test_get_host(self):
+        self.assertEqual('test.com', scheduler.get_host('http://Test.com:8080/path'))
+        self.assertIsNone(scheduler.get_host('test'))
+
+    def test_max_in_flight(self):
+        host_scheduler = self.get_scheduler()
+        first = host_scheduler.acquire('test.com')
+        second = self.get_scheduler().acquire('test.com')
+
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(host_scheduler.acquire('test.com'))
+        self.assertIsNotNone(host_scheduler.acquire('other.com'))
+
+        host_scheduler.release(first, 'test.com')
+        self.assertIsNotNone(host_scheduler.acquire('test.com'))
+
+    def test_slot_expires(self):
+        host_scheduler = self.get_scheduler(max_in_flight=1, slot_ttl=-1)
+        host_scheduler.acquire('test.com')
+        self.assertIsNotNone(host_scheduler.acquire('test.com'))
+
+    def test_backoff(self):
+        host_scheduler = self.get_scheduler()
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            host_scheduler.release(host_scheduler.acquire('test.com'), 'test.com', failed=True)
+            self.assertIsNone(host_scheduler.acquire('test.com'))
+            self.assertEqual(11, host_scheduler.get_delay('test.com'))
+
+        with mock.patch('time.time', mock.Mock(return_value=1011)):
+            host_scheduler.release(host_scheduler.acquire('test.com'), 'test.com', failed=True)
+            self.assertEqual(21, host_scheduler.get_delay('test.com'))
+
+        with mock.patch('time.time', mock.Mock(return_value=1040)):
+            host_scheduler.release(host_scheduler.acquire('test.com'), 'test.com', failed=True)
+            self.assertEqual(26, host_scheduler.get_delay('test.com'))
+
+    def test_success_resets_backoff(self):
+        host_scheduler = self.get_scheduler()
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            host_scheduler.release(host_scheduler.acquire('test.com'), 'test.com', failed=True)
+        host_scheduler.release(host_scheduler.acquire('test.com'), 'test.com')
+
+        self.assertEqual(5, host_scheduler.get_delay('test.com'))
+
+    def test_db_error(self):
+        host_scheduler = self.get_scheduler()
+        with mock.patch.object(host_scheduler, '_get_db', mock.Mock(side_effect=scheduler.sqlite3.Error)):
+            self.assertEqual(0, host_scheduler.acquire('test.com'))
+            host_scheduler.release(0, 'test.com', failed=True)
+            self.assertEqual(5, host_scheduler.get_delay('test.com'))
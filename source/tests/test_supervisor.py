@@ -0,0 +1,123 @@
+# coding: utf-8
+import mock
+import unittest
+from lib import supervisor
+
+
+def make_process(pid, alive=True):
+    process = mock.Mock()
+    process.pid = pid
+    process.exitcode = None if alive else 1
+    process.is_alive = mock.Mock(return_value=alive)
+    return process
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("lib.supervisor.signal")
+        self.mock_signal = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.target = mock.Mock()
+        self.supervisor = supervisor.Supervisor(
+            self.target, ('config',), 13, respawn_delay=1, respawn_delay_max=4, min_uptime=10
+        )
+
+    def test_resize_spawns_missing(self):
+        self.supervisor.processes = {1: (make_process(1), 0)}
+        mock_spawn_workers = mock.Mock(return_value=[make_process(2), make_process(3)])
+
+        with mock.patch("lib.supervisor.spawn_workers", mock_spawn_workers):
+            self.supervisor.resize(3)
+
+        mock_spawn_workers.assert_called_once_with(
+            2, supervisor.run_child, (self.target, 'config'), 13, paused=self.supervisor.paused
+        )
+        self.assertEqual(3, len(self.supervisor))
+
+    def test_resize_stops_youngest(self):
+        old, young = make_process(1), make_process(2)
+        self.supervisor.processes = {1: (old, 0), 2: (young, 100)}
+
+        self.supervisor.resize(1)
+
+        young.terminate.assert_called_once_with()
+        self.assertFalse(old.terminate.called)
+        self.assertEqual(1, len(self.supervisor))
+
+    def test_reap_respawn_backoff(self):
+        mock_spawn_workers = mock.Mock(return_value=[])
+        with mock.patch("lib.supervisor.spawn_workers", mock_spawn_workers):
+            for now, expected_delay in ((100, 1), (102, 2), (105, 4), (110, 4)):
+                self.supervisor.processes = {1: (make_process(1, alive=False), now - 1)}
+                with mock.patch("time.time", mock.Mock(return_value=now)):
+                    self.supervisor.resize(1)
+                self.assertEqual(now + expected_delay, self.supervisor.next_spawn)
+
+        self.assertFalse(mock_spawn_workers.called)
+        self.assertEqual(4, self.supervisor.failures)
+
+    def test_reap_long_running_resets_backoff(self):
+        self.supervisor.failures = 3
+        self.supervisor.processes = {1: (make_process(1, alive=False), 0)}
+
+        with mock.patch("time.time", mock.Mock(return_value=100)):
+            self.supervisor.reap()
+
+        self.assertEqual(0, self.supervisor.failures)
+        self.assertEqual({}, self.supervisor.processes)
+
+    def test_reap_stopped(self):
+        self.supervisor.processes = {1: (make_process(1, alive=False), 99)}
+        self.supervisor.stopping = {1}
+
+        with mock.patch("time.time", mock.Mock(return_value=100)):
+            self.supervisor.reap()
+
+        self.assertEqual(0, self.supervisor.failures)
+        self.assertEqual(set(), self.supervisor.stopping)
+
+    def test_stop(self):
+        process = make_process(1)
+        self.supervisor.processes = {1: (process, 0)}
+
+        self.supervisor.stop()
+        self.supervisor.stop()
+
+        process.terminate.assert_called_once_with()
+        self.assertEqual(0, len(self.supervisor))
+
+    def test_pause_resume(self):
+        self.supervisor.pause()
+        self.assertTrue(self.supervisor.paused.is_set())
+        self.supervisor.resume()
+        self.assertFalse(self.supervisor.paused.is_set())
+
+    def test_wait(self):
+        with mock.patch("time.sleep", mock.Mock()) as mock_sleep:
+            self.supervisor.wait(10)
+            self.supervisor._on_child_exit(17, None)
+            self.supervisor.wait(10)
+
+        mock_sleep.assert_called_once_with(10)
+        self.assertFalse(self.supervisor.child_exited)
+
+    def test_wait_respawn(self):
+        self.supervisor.next_spawn = 102
+        with mock.patch("time.sleep", mock.Mock()) as mock_sleep:
+            with mock.patch("time.time", mock.Mock(return_value=100)):
+                self.supervisor.wait(10)
+
+        mock_sleep.assert_called_once_with(2)
+
+    def test_shutdown(self):
+        stopped = make_process(1, alive=False)
+        hung = make_process(2)
+        self.supervisor.processes = {1: (stopped, 0), 2: (hung, 0)}
+
+        with mock.patch("os.kill", mock.Mock()) as mock_kill:
+            self.supervisor.shutdown(5)
+
+        stopped.terminate.assert_called_once_with()
+        hung.terminate.assert_called_once_with()
+        mock_kill.assert_called_once_with(2, self.mock_signal.SIGKILL)
+        self.assertEqual({}, self.supervisor.processes)
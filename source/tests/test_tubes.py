@@ -0,0 +1,192 @@
+# coding: utf-8
+import mock
+import socket
+import unittest
+from tarantool.error import DatabaseError
+from lib import tubes
+
+
+class TubesTestCase(unittest.TestCase):
+    def test_take_batch(self):
+        tube = mock.MagicMock()
+        tube.take = mock.Mock(return_value='first')
+        taken = mock.Mock()
+        taken.rowcount = 1
+        empty = mock.Mock()
+        empty.rowcount = 0
+        mock_call_pipelined = mock.Mock(return_value=[taken, empty, DatabaseError(1, 'error')])
+
+        with mock.patch('lib.tubes.call_pipelined', mock_call_pipelined):
+            with mock.patch('lib.tubes.Task.from_tuple', mock.Mock(return_value='second')):
+                tasks = tubes.take_batch(tube, 4, 1)
+
+        tube.take.assert_called_once_with(1)
+        calls = mock_call_pipelined.call_args[0][1]
+        self.assertEqual(3, len(calls))
+        # a zero timeout would wait for a task forever
+        self.assertEqual('0.001', calls[0][1][2])
+        self.assertEqual(['first', 'second'], tasks)
+
+    def test_take_batch_empty(self):
+        tube = mock.MagicMock()
+        tube.take = mock.Mock(return_value=None)
+        mock_call_pipelined = mock.Mock()
+
+        with mock.patch('lib.tubes.call_pipelined', mock_call_pipelined):
+            self.assertEqual([], tubes.take_batch(tube, 4, 1))
+
+        self.assertFalse(mock_call_pipelined.called)
+
+    def test_batch_acker(self):
+        queue = mock.Mock()
+        queue.space = 0
+        tasks = [mock.Mock(queue=queue, task_id=str(i)) for i in xrange(3)]
+        mock_call_pipelined = mock.Mock(return_value=[mock.Mock(), mock.Mock()])
+        acker = tubes.BatchAcker(batch_size=2, linger=10)
+
+        with mock.patch('lib.tubes.call_pipelined', mock_call_pipelined):
+            for task in tasks:
+                acker.ack(task)
+
+        mock_call_pipelined.assert_called_once_with(queue.tnt, [('queue.ack', ('0', '0')), ('queue.ack', ('0', '1'))])
+        self.assertTrue(tasks[0].modified)
+        self.assertEqual(1, len(acker))
+
+    def test_batch_acker_linger(self):
+        acker = tubes.BatchAcker(batch_size=10, linger=1)
+        with mock.patch('time.time', mock.Mock(return_value=100)):
+            acker.ack(mock.Mock())
+        flush = mock.Mock()
+
+        with mock.patch.object(acker, 'flush', flush):
+            with mock.patch('time.time', mock.Mock(return_value=100.5)):
+                acker.poll()
+            self.assertFalse(flush.called)
+            with mock.patch('time.time', mock.Mock(return_value=101)):
+                acker.poll()
+            self.assertTrue(flush.called)
+
+    def test_batch_writer(self):
+        acker = mock.Mock()
+        tube = mock.Mock()
+        written, failed = mock.Mock(), mock.Mock()
+        mock_call_pipelined = mock.Mock(return_value=[mock.Mock(), DatabaseError(1, 'error')])
+        writer = tubes.BatchWriter(acker, batch_size=2, linger=10)
+
+        with mock.patch('lib.tubes.get_put_args', mock.Mock(return_value=('args',))):
+            with mock.patch('lib.tubes.call_pipelined', mock_call_pipelined):
+                writer.put(written, tube, 'first')
+                self.assertFalse(mock_call_pipelined.called)
+                writer.put(failed, tube, 'second', delay=300)
+
+        mock_call_pipelined.assert_called_once_with(tube.queue.tnt, [('queue.put', ('args',))] * 2)
+        acker.ack.assert_called_once_with(written)
+        failed.release.assert_called_once_with()
+        self.assertEqual(0, len(writer))
+
+    def test_batch_writer_network_error(self):
+        acker = mock.Mock()
+        task = mock.Mock()
+        writer = tubes.BatchWriter(acker, batch_size=10, linger=10)
+        writer.put(task, mock.Mock(), 'data')
+
+        with mock.patch('lib.tubes.get_put_args', mock.Mock(return_value=())):
+            with mock.patch('lib.tubes.call_pipelined', mock.Mock(side_effect=socket.error)):
+                writer.flush()
+
+        self.assertFalse(acker.ack.called)
+        task.release.assert_called_once_with()
+
+    def test_batch_writer_without_tube(self):
+        acker = mock.Mock()
+        task = mock.Mock()
+        writer = tubes.BatchWriter(acker, batch_size=10, linger=10)
+        writer.put(task)
+
+        acker.ack.assert_called_once_with(task)
+        self.assertEqual(0, len(writer))
+
+    def test_prefetcher(self):
+        first, second = mock.Mock(), mock.Mock()
+        tasks = [first, second]
+        tube = mock.Mock()
+        tube.take = mock.Mock(side_effect=lambda timeout: tasks.pop(0) if tasks else None)
+        prefetcher = tubes.Prefetcher(tube, size=1, take_timeout=0.01, touch_interval=10)
+
+        prefetcher.start()
+        self.assertIs(first, prefetcher.get(1))
+        self.assertIs(second, prefetcher.get(1))
+        self.assertIsNone(prefetcher.get(0.01))
+        prefetcher.stop()
+
+        self.assertFalse(prefetcher.thread.is_alive())
+        self.assertFalse(first.release.called)
+
+    def test_prefetcher_take(self):
+        first, second = mock.Mock(), mock.Mock()
+        tube = mock.Mock()
+        mock_take_batch = mock.Mock(side_effect=[[first], [], socket.error, [second]])
+        prefetcher = tubes.Prefetcher(tube, size=3, take_timeout=0, touch_interval=10)
+
+        with mock.patch('lib.tubes.take_batch', mock_take_batch):
+            for _ in xrange(4):
+                prefetcher.take()
+
+        # the server waits forever on a zero timeout
+        self.assertEqual(mock.call(tube, 3, tubes.TAKE_NOWAIT), mock_take_batch.call_args_list[0])
+        self.assertEqual(mock.call(tube, 2, tubes.TAKE_NOWAIT), mock_take_batch.call_args_list[-1])
+        self.assertEqual(2, len(prefetcher))
+        self.assertIs(first, prefetcher.get(0))
+        self.assertIs(second, prefetcher.get(0))
+
+    def test_prefetcher_take_empty_waits_unlocked(self):
+        tube = mock.Mock()
+        tube.take = mock.Mock(return_value=None)
+        prefetcher = tubes.Prefetcher(tube, size=2, take_timeout=5, touch_interval=10)
+        prefetcher.running = True
+        prefetcher.condition = mock.MagicMock()
+
+        prefetcher.take()
+
+        tube.take.assert_called_once_with(tubes.TAKE_NOWAIT)
+        prefetcher.condition.wait.assert_called_once_with(5)
+
+    def test_prefetcher_touch(self):
+        stale, fresh = mock.Mock(), mock.Mock()
+        prefetcher = tubes.Prefetcher(mock.Mock(), size=2, take_timeout=0, touch_interval=10)
+        prefetcher.buffer.extend([[stale, 100], [fresh, 105]])
+
+        with mock.patch('time.time', mock.Mock(return_value=112)):
+            prefetcher.touch()
+
+        stale.touch.assert_called_once_with()
+        self.assertFalse(fresh.touch.called)
+        self.assertEqual([[stale, 112], [fresh, 105]], list(prefetcher.buffer))
+
+    def test_prefetcher_stop_releases(self):
+        task = mock.Mock()
+        prefetcher = tubes.Prefetcher(mock.Mock(), size=2, take_timeout=0, touch_interval=10)
+        prefetcher.buffer.append([task, 0])
+
+        prefetcher.stop()
+
+        task.release.assert_called_once_with()
+        self.assertEqual(0, len(prefetcher))
+
+    def test_prefetcher_paused(self):
+        task = mock.Mock()
+        tube = mock.Mock()
+        paused = mock.Mock()
+        paused.is_set = mock.Mock(return_value=True)
+        prefetcher = tubes.Prefetcher(tube, size=2, take_timeout=0, touch_interval=10, paused=paused)
+        prefetcher.buffer.append([task, 0])
+        prefetcher.running = True
+
+        def pause(timeout):
+            prefetcher.running = False
+
+        with mock.patch('lib.tubes.time.sleep', mock.Mock(side_effect=pause)):
+            prefetcher.run()
+
+        task.release.assert_called_once_with()
+        self.assertFalse(tube.take.called)
@@ -67,6 +67,31 @@ class UtilsTestCase(unittest.TestCase):
             'value_key_2': 'value_2'
         })
 
+    def test_apply_config_aliases(self):
+        cfg = utils.Config()
+        cfg.CHECK_URL = 'http://t.mail.ru'
+        cfg.RECHECK_DELAY = 300
+
+        utils.apply_config_aliases(cfg)
+
+        self.assertEqual(['http://t.mail.ru'], cfg.CHECK_URLS)
+        self.assertEqual({'other': (1, 300)}, cfg.RETRY_POLICIES)
+        self.assertEqual(300, cfg.RETRY_DELAY_MAX)
+        self.assertEqual(0, cfg.RETRY_JITTER)
+
+    def test_apply_config_aliases_new_keys(self):
+        cfg = utils.Config()
+        cfg.CHECK_URL = 'http://t.mail.ru'
+        cfg.CHECK_URLS = ['http://mail.ru']
+        cfg.RECHECK_DELAY = 300
+        cfg.RETRY_POLICIES = {'dns': (1, 600)}
+
+        utils.apply_config_aliases(cfg)
+
+        self.assertEqual(['http://mail.ru'], cfg.CHECK_URLS)
+        self.assertEqual({'dns': (1, 600)}, cfg.RETRY_POLICIES)
+        self.assertFalse(hasattr(cfg, 'RETRY_DELAY_MAX'))
+
     def test_parse_cmd_args(self):
         arg = mock.MagicMock()
         args = [arg, arg]
@@ -84,12 +109,12 @@ class UtilsTestCase(unittest.TestCase):
         name = 'name'
 
         mock_queue = mock.MagicMock()
-        mock_t_queue = mock.Mock(return_value=mock_queue)
+        mock_get_queue = mock.Mock(return_value=mock_queue)
 
-        with mock.patch("lib.utils.tarantool_queue.Queue", mock_t_queue):
+        with mock.patch("lib.utils.get_queue", mock_get_queue):
             utils.get_tube(host, port, space, name)
 
-        mock_t_queue.assert_called_once_with(host=host, port=port, space=space)
+        mock_get_queue.assert_called_once_with(host, port, space, None)
         mock_queue.tube.assert_called_once_with(name)
 
     def test_spawn_workers(self):
@@ -110,6 +135,38 @@ class UtilsTestCase(unittest.TestCase):
         assert mock_process.call_count == num
         self.assertTrue(mock_p.daemon)
 
+    def test_spawn_workers_returns_processes(self):
+        mock_p = mock.MagicMock()
+        with mock.patch('lib.utils.Process', mock.Mock(return_value=mock_p)):
+            self.assertEqual([mock_p, mock_p], utils.spawn_workers(2, mock.Mock(), (), 13))
+
+    def test_spawn_workers_kwargs(self):
+        mock_process = mock.Mock(return_value=mock.MagicMock())
+        target = mock.Mock()
+        with mock.patch('lib.utils.Process', mock_process):
+            utils.spawn_workers(1, target, (), 13, paused='paused')
+
+        mock_process.assert_called_once_with(target=target, args=(), kwargs={'parent_pid': 13, 'paused': 'paused'})
+
+    def test_run_child(self):
+        target = mock.Mock()
+        with mock.patch('lib.utils.signal.signal', mock.Mock()):
+            with mock.patch('lib.utils.set_parent_death_signal', mock.Mock()) as mock_set_parent_death_signal:
+                with mock.patch('os.getppid', mock.Mock(return_value=13)):
+                    utils.run_child(target, 'config', parent_pid=13)
+
+        mock_set_parent_death_signal.assert_called_once_with(utils.signal.SIGTERM)
+        target.assert_called_once_with('config', parent_pid=13)
+
+    def test_run_child_parent_dead(self):
+        target = mock.Mock()
+        with mock.patch('lib.utils.signal.signal', mock.Mock()):
+            with mock.patch('lib.utils.set_parent_death_signal', mock.Mock()):
+                with mock.patch('os.getppid', mock.Mock(return_value=1)):
+                    utils.run_child(target, 'config', parent_pid=13)
+
+        self.assertFalse(target.called)
+
     def test_network_status_ok(self):
         mock_check_url = mock.Mock()
         timeout = 0
@@ -1,9 +1,37 @@
 import mock
 import unittest
-from lib import worker
+from lib import worker, RedirectError
 
 
 class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("lib.worker.set_dns_cache")
+        self.mock_set_dns_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("lib.worker.set_reconnect_policy")
+        self.mock_set_reconnect_policy = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("lib.worker.get_prefetcher", mock.Mock(return_value=None))
+        self.mock_get_prefetcher = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("lib.worker.signal")
+        self.mock_signal = patcher.start()
+        self.addCleanup(patcher.stop)
+        # one task per take, batches themselves are tested with tubes
+        patcher = mock.patch("lib.worker.take_batch", mock.Mock(
+            side_effect=lambda tube, size, timeout: filter(None, [tube.take(timeout)])
+        ))
+        self.mock_take_batch = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.acker = mock.Mock()
+        patcher = mock.patch("lib.worker.BatchAcker", mock.Mock(return_value=self.acker))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = mock.Mock()
+        patcher = mock.patch("lib.worker.BatchWriter", mock.Mock(return_value=self.writer))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_get_redirect_history_from_task_type_error(self):
         task = mock.Mock()
         task.data = dict(url="url", recheck=False, url_id="url_id")
@@ -18,6 +46,41 @@ class WorkerTestCase(unittest.TestCase):
         assert is_input == True
         assert data == task.data
 
+    def test_make_task_result_retry(self):
+        task = mock.Mock()
+        task.data = dict(url="url", url_id="url_id", attempts=1)
+        retry_policy = mock.Mock()
+        retry_policy.get_delay = mock.Mock(return_value=42)
+
+        is_input, data = worker.make_task_result(task, [RedirectError("timeout")], [], [], retry_policy)
+
+        retry_policy.get_delay.assert_called_once_with("timeout", 2)
+        assert is_input == True
+        assert data == dict(url="url", url_id="url_id", recheck=True, attempts=2, error="timeout", retry_delay=42)
+
+    def test_make_task_result_no_retry(self):
+        task = mock.Mock()
+        task.data = dict(url="url", url_id="url_id", recheck=True)
+        retry_policy = mock.Mock()
+        retry_policy.get_delay = mock.Mock(return_value=None)
+
+        is_input, data = worker.make_task_result(task, [RedirectError("dns")], ["url"], [], retry_policy)
+
+        retry_policy.get_delay.assert_called_once_with("dns", 2)
+        assert is_input == False
+        assert data == {"url_id": "url_id", "result": [["ERROR"], ["url"], []], "check_type": "normal", "error": "dns"}
+
+    def test_complete_task_retry_delay(self):
+        task = mock.Mock()
+        task.meta = mock.Mock(return_value={'pri': 3})
+        data = dict(url="url", attempts=1, retry_delay=42)
+        input_tube = mock.Mock()
+
+        worker.complete_task(task, (True, data), input_tube, mock.Mock())
+
+        input_tube.put.assert_called_once_with(dict(url="url", attempts=1), delay=42, pri=3)
+        self.assertTrue(task.ack.called)
+
     def test_get_redirect_history_from_task_no_error_no_suspicious(self):
         task = mock.Mock()
         task.data = dict(url="url", recheck=False, url_id="url_id")
@@ -51,6 +114,53 @@ class WorkerTestCase(unittest.TestCase):
         assert data["check_type"] == "normal"
         assert data["suspicious"] == task.data["suspicious"]
 
+    def test_get_redirect_history_from_task_cache_hit(self):
+        task = mock.Mock()
+        task.data = dict(url="http://url.ru", url_id="url_id")
+        task.task_id = 13
+
+        history = [["type"], ["urls"], ["counters"]]
+        result_cache = mock.Mock()
+        result_cache.get = mock.Mock(return_value=history)
+        mock_get_redirect_history = mock.Mock()
+
+        with mock.patch("lib.worker.get_redirect_history", mock_get_redirect_history):
+            is_input, data = worker.get_redirect_history_from_task(task=task, timeout=1, result_cache=result_cache)
+
+        result_cache.get.assert_called_once_with(u"http://url.ru")
+        self.assertFalse(mock_get_redirect_history.called)
+        self.assertFalse(result_cache.set.called)
+        assert is_input == False
+        assert data["result"] == history
+
+    def test_get_redirect_history_from_task_cache_miss(self):
+        task = mock.Mock()
+        task.data = dict(url="http://url.ru", url_id="url_id")
+        task.task_id = 13
+
+        history = [["type"], ["urls"], ["counters"]]
+        result_cache = mock.Mock()
+        result_cache.get = mock.Mock(return_value=None)
+
+        with mock.patch("lib.worker.get_redirect_history", mock.Mock(return_value=history)):
+            is_input, data = worker.get_redirect_history_from_task(task=task, timeout=1, result_cache=result_cache)
+
+        result_cache.set.assert_called_once_with(u"http://url.ru", history)
+        assert data["result"] == history
+
+    def test_get_redirect_history_from_task_cache_skips_error(self):
+        task = mock.Mock()
+        task.data = dict(url="http://url.ru", recheck=True, url_id="url_id")
+        task.task_id = 13
+
+        result_cache = mock.Mock()
+        result_cache.get = mock.Mock(return_value=None)
+
+        with mock.patch("lib.worker.get_redirect_history", mock.Mock(return_value=[["ERROR"], [], []])):
+            worker.get_redirect_history_from_task(task=task, timeout=1, result_cache=result_cache)
+
+        self.assertFalse(result_cache.set.called)
+
     def test_worker_parent_proc_not_exist(self):
         config = mock.MagicMock()
         parent_pid = 13
@@ -105,9 +215,9 @@ class WorkerTestCase(unittest.TestCase):
 
         assert input_tube.take.call_count == 1
         assert mock_get_redirect_history_from_task.call_count == 1
-        assert task.ack.call_count == 1
+        self.writer.put.assert_called_once_with(task, None, None)
 
-    def test_worker_parent_proc_exist_task_not_result_exception(self):
+    def test_worker_parent_proc_exist_task_result_is_input(self):
         config = mock.Mock()
         parent_pid = 13
 
@@ -120,7 +230,9 @@ class WorkerTestCase(unittest.TestCase):
         output_tube = mock.MagicMock()
         mock_get_tube = mock.Mock(side_effect=[input_tube, output_tube])
 
-        mock_get_redirect_history_from_task = mock.Mock(return_value=False)
+        is_input = True
+        data = mock.Mock()
+        mock_get_redirect_history_from_task = mock.Mock(return_value=[is_input, data])
         mock_logger = mock.Mock()
 
         with mock.patch("lib.worker.get_tube", mock_get_tube):
@@ -131,10 +243,12 @@ class WorkerTestCase(unittest.TestCase):
 
         assert input_tube.take.call_count == 1
         assert mock_get_redirect_history_from_task.call_count == 1
-        assert task.ack.call_count == 1
-        assert mock_logger.exception.call_count == 1
+        self.writer.put.assert_called_once_with(
+            task, input_tube, data, delay=data.pop.return_value, pri=task.meta.return_value.__getitem__.return_value
+        )
+        self.assertFalse(input_tube.put.called)
 
-    def test_worker_parent_proc_exist_task_result_is_input(self):
+    def test_worker_parent_proc_exist_task_result_no_input(self):
         config = mock.Mock()
         parent_pid = 13
 
@@ -147,7 +261,7 @@ class WorkerTestCase(unittest.TestCase):
         output_tube = mock.MagicMock()
         mock_get_tube = mock.Mock(side_effect=[input_tube, output_tube])
 
-        is_input = True
+        is_input = False
         data = mock.Mock()
         mock_get_redirect_history_from_task = mock.Mock(return_value=[is_input, data])
         mock_logger = mock.Mock()
@@ -160,36 +274,306 @@ class WorkerTestCase(unittest.TestCase):
 
         assert input_tube.take.call_count == 1
         assert mock_get_redirect_history_from_task.call_count == 1
-        assert input_tube.put.call_count == 1
-        assert task.ack.call_count == 1
-        assert mock_logger.exception.call_count == 1
+        self.writer.put.assert_called_once_with(task, output_tube, data)
+        self.assertFalse(output_tube.put.called)
 
-    def test_worker_parent_proc_exist_task_result_no_input(self):
+    def test_worker_dns_cache(self):
         config = mock.Mock()
-        parent_pid = 13
+        config.DNS_CACHE_PATH = 'path'
 
-        from tarantool import DatabaseError
+        mock_get_tube = mock.Mock(side_effect=[mock.MagicMock(), mock.MagicMock()])
+        dns_cache = mock.Mock()
+        dns_cache.stats = mock.Mock(return_value={'hits': 0, 'misses': 0})
+        mock_dns_cache = mock.Mock(return_value=dns_cache)
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("lib.worker.DnsCache", mock_dns_cache):
+                with mock.patch("os.path.exists", mock.Mock(return_value=False)):
+                    worker.worker(config, 13)
+
+        mock_dns_cache.assert_called_once_with(
+            'path', config.DNS_CACHE_SIZE, config.DNS_CACHE_TTL, config.DNS_CACHE_NEGATIVE_TTL
+        )
+        self.mock_set_dns_cache.assert_called_once_with(mock_dns_cache.return_value)
+
+    def test_worker_no_dns_cache(self):
+        config = mock.Mock()
+        config.DNS_CACHE_PATH = None
+
+        mock_get_tube = mock.Mock(side_effect=[mock.MagicMock(), mock.MagicMock()])
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("os.path.exists", mock.Mock(return_value=False)):
+                worker.worker(config, 13)
+
+        self.assertFalse(self.mock_set_dns_cache.called)
+
+    def test_worker_host_busy(self):
+        config = mock.Mock()
         task = mock.MagicMock()
-        task.ack = mock.Mock(side_effect=DatabaseError)
+        task.data = dict(url="http://url.ru/path", url_id="url_id")
+
+        input_tube = mock.MagicMock()
+        input_tube.take = mock.Mock(return_value=task)
+        mock_get_tube = mock.Mock(side_effect=[input_tube, mock.MagicMock()])
+        host_scheduler = mock.Mock()
+        host_scheduler.acquire = mock.Mock(return_value=None)
+        host_scheduler.get_delay = mock.Mock(return_value=5)
+        mock_get_redirect_history_from_task = mock.Mock()
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("lib.worker.HostScheduler", mock.Mock(return_value=host_scheduler)):
+                with mock.patch("os.path.exists", mock.Mock(side_effect=[True, False])):
+                    with mock.patch("lib.worker.get_redirect_history_from_task", mock_get_redirect_history_from_task):
+                        worker.worker(config, 13)
+
+        host_scheduler.acquire.assert_called_once_with("url.ru")
+        task.release.assert_called_once_with(delay=5)
+        self.assertFalse(mock_get_redirect_history_from_task.called)
+        self.assertFalse(self.writer.put.called)
+
+    def test_worker_host_slot_released(self):
+        config = mock.Mock()
+        task = mock.MagicMock()
+        task.data = dict(url="http://url.ru/path", url_id="url_id")
 
         input_tube = mock.MagicMock()
         input_tube.take = mock.Mock(return_value=task)
+        mock_get_tube = mock.Mock(side_effect=[input_tube, mock.MagicMock()])
+        host_scheduler = mock.Mock()
+        host_scheduler.acquire = mock.Mock(return_value=7)
+        result = (False, {"result": [["ERROR"], [], []]})
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("lib.worker.HostScheduler", mock.Mock(return_value=host_scheduler)):
+                with mock.patch("os.path.exists", mock.Mock(side_effect=[True, False])):
+                    with mock.patch("lib.worker.get_redirect_history_from_task", mock.Mock(return_value=result)):
+                        worker.worker(config, 13)
+
+        host_scheduler.release.assert_called_once_with(7, "url.ru", failed=True)
+        self.assertTrue(self.writer.put.called)
+
+    def test_concurrent_worker(self):
+        config = mock.Mock()
+        config.WORKER_CONCURRENCY = 2
+        config.QUEUE_TAKE_BATCH = 10
+        config.HOST_SCHEDULER_PATH = None
+        config.RESULT_CACHE_PATH = None
+        first = mock.MagicMock()
+        first.task_id = 1
+        first.data = dict(url="http://first.ru", url_id=1)
+        second = mock.MagicMock()
+        second.task_id = 2
+        second.data = dict(url="http://second.ru", url_id=2)
+
         output_tube = mock.MagicMock()
-        mock_get_tube = mock.Mock(side_effect=[input_tube, output_tube])
+        mock_get_tube = mock.Mock(side_effect=[mock.MagicMock(), output_tube])
+        mock_take_batch = mock.Mock(side_effect=[[first, second], []])
+        acker = mock.Mock()
+        writer = mock.Mock()
+        engine = mock.Mock()
+        engine.perform = mock.Mock(side_effect=[[(2, (["http_status"], ["urls"], []))], []])
 
-        is_input = False
-        data = mock.Mock()
-        mock_get_redirect_history_from_task = mock.Mock(return_value=[is_input, data])
-        mock_logger = mock.Mock()
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("lib.worker.take_batch", mock_take_batch):
+                with mock.patch("lib.worker.BatchAcker", mock.Mock(return_value=acker)):
+                    with mock.patch("lib.worker.BatchWriter", mock.Mock(return_value=writer)):
+                        with mock.patch("lib.worker.RedirectEngine", mock.Mock(return_value=engine)):
+                            with mock.patch("os.path.exists", mock.Mock(side_effect=[True, True, False])):
+                                worker.concurrent_worker(config, 13)
+
+        self.assertEqual(2, mock_take_batch.call_args_list[0][0][1])
+        self.assertEqual(config.QUEUE_TAKE_TIMEOUT, mock_take_batch.call_args_list[0][0][2])
+        self.assertEqual(1, mock_take_batch.call_args_list[1][0][1])
+        self.assertEqual(0.001, mock_take_batch.call_args_list[1][0][2])
+        self.assertEqual([mock.call(1, u"http://first.ru"), mock.call(2, u"http://second.ru")],
+                         engine.add.call_args_list)
+        writer.put.assert_called_once_with(
+            second, output_tube, {"url_id": 2, "result": [["http_status"], ["urls"], []], "check_type": "normal"}
+        )
+        self.assertTrue(writer.flush.called)
+        self.assertTrue(acker.flush.called)
+        self.assertFalse(first.ack.called)
+        first.release.assert_called_once_with()
+        self.assertTrue(engine.close.called)
+
+    def test_concurrent_worker_cached_result(self):
+        config = mock.Mock()
+        config.WORKER_CONCURRENCY = 2
+        config.QUEUE_TAKE_BATCH = 10
+        config.HOST_SCHEDULER_PATH = None
+        task = mock.MagicMock()
+        task.task_id = 1
+        task.data = dict(url="http://first.ru", url_id=1)
+
+        output_tube = mock.MagicMock()
+        mock_get_tube = mock.Mock(side_effect=[mock.MagicMock(), output_tube])
+        result_cache = mock.Mock()
+        result_cache.get = mock.Mock(return_value=[[], ["http://first.ru"], []])
+        result_cache.stats = mock.Mock(return_value={'hits': 1, 'misses': 0})
+        acker = mock.Mock()
+        writer = mock.Mock()
+        engine = mock.Mock()
+        engine.perform = mock.Mock(return_value=[])
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("lib.worker.take_batch", mock.Mock(return_value=[task])):
+                with mock.patch("lib.worker.BatchAcker", mock.Mock(return_value=acker)):
+                    with mock.patch("lib.worker.BatchWriter", mock.Mock(return_value=writer)):
+                        with mock.patch("lib.worker.RedirectEngine", mock.Mock(return_value=engine)):
+                            with mock.patch("lib.worker.SqliteCache", mock.Mock(return_value=result_cache)):
+                                with mock.patch("os.path.exists", mock.Mock(side_effect=[True, False])):
+                                    worker.concurrent_worker(config, 13)
+
+        self.assertFalse(engine.add.called)
+        writer.put.assert_called_once_with(
+            task, output_tube, {"url_id": 1, "result": [[], ["http://first.ru"], []], "check_type": "normal"}
+        )
+        self.assertFalse(task.release.called)
+
+    def test_worker_prefetch(self):
+        config = mock.Mock()
+        task = mock.MagicMock()
+        input_tube = mock.MagicMock()
+        mock_get_tube = mock.Mock(side_effect=[input_tube, mock.MagicMock()])
+        prefetcher = mock.Mock()
+        prefetcher.get = mock.Mock(return_value=task)
+        self.mock_get_prefetcher.return_value = prefetcher
 
         with mock.patch("lib.worker.get_tube", mock_get_tube):
             with mock.patch("os.path.exists", mock.Mock(side_effect=[True, False])):
-                with mock.patch("lib.worker.get_redirect_history_from_task", mock_get_redirect_history_from_task):
-                    with mock.patch("lib.worker.logger", mock_logger):
-                        worker.worker(config, parent_pid)
+                with mock.patch("lib.worker.get_redirect_history_from_task", mock.Mock(return_value=False)):
+                    worker.worker(config, 13)
 
+        prefetcher.get.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+        self.assertFalse(input_tube.take.called)
+        self.writer.put.assert_called_once_with(task, None, None)
+        self.assertTrue(prefetcher.stop.called)
+
+    def test_worker_stop(self):
+        config = mock.Mock()
+        task = mock.MagicMock()
+
+        input_tube = mock.MagicMock()
+        input_tube.take = mock.Mock(return_value=task)
+        mock_get_tube = mock.Mock(side_effect=[input_tube, mock.MagicMock()])
+
+        def get_history(*args):
+            worker.stop(15, None)
+            return False
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("os.path.exists", mock.Mock(return_value=True)):
+                with mock.patch("lib.worker.get_redirect_history_from_task", mock.Mock(side_effect=get_history)):
+                    worker.worker(config, 13)
+        worker.is_run = True
+
+        self.mock_signal.signal.assert_called_once_with(self.mock_signal.SIGTERM, worker.stop)
         assert input_tube.take.call_count == 1
-        assert mock_get_redirect_history_from_task.call_count == 1
-        assert output_tube.put.call_count == 1
-        assert task.ack.call_count == 1
-        assert mock_logger.exception.call_count == 1
+        self.writer.put.assert_called_once_with(task, None, None)
+        self.assertTrue(self.writer.flush.called)
+        self.assertTrue(self.acker.flush.called)
+
+    def test_worker_paused(self):
+        config = mock.Mock()
+        input_tube = mock.MagicMock()
+        mock_get_tube = mock.Mock(side_effect=[input_tube, mock.MagicMock()])
+        paused = mock.Mock()
+        paused.is_set = mock.Mock(return_value=True)
+
+        with mock.patch("lib.worker.get_tube", mock_get_tube):
+            with mock.patch("os.path.exists", mock.Mock(side_effect=[True, False])):
+                with mock.patch("time.sleep", mock.Mock()) as mock_sleep:
+                    worker.worker(config, 13, paused)
+
+        self.assertFalse(input_tube.take.called)
+        mock_sleep.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+
+    def test_worker_take_batch(self):
+        config = mock.Mock()
+        config.HOST_SCHEDULER_PATH = None
+        first, second, third = mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+        input_tube = mock.MagicMock()
+        self.mock_take_batch.side_effect = [[first, second, third]]
+        mock_get_redirect_history_from_task = mock.Mock(return_value=False)
+
+        with mock.patch("lib.worker.get_tube", mock.Mock(side_effect=[input_tube, mock.MagicMock()])):
+            with mock.patch("lib.worker.get_redirect_history_from_task", mock_get_redirect_history_from_task):
+                with mock.patch("os.path.exists", mock.Mock(side_effect=[True, True, False])):
+                    worker.worker(config, 13)
+
+        self.mock_take_batch.assert_called_once_with(input_tube, config.QUEUE_TAKE_BATCH, config.QUEUE_TAKE_TIMEOUT)
+        self.assertEqual([mock.call(first, None, None), mock.call(second, None, None)],
+                         self.writer.put.call_args_list)
+        third.release.assert_called_once_with()
+        self.assertEqual(2, self.acker.poll.call_count)
+        self.assertTrue(self.acker.flush.called)
+
+    def test_worker_paused_releases_taken(self):
+        config = mock.Mock()
+        config.HOST_SCHEDULER_PATH = None
+        first, second = mock.MagicMock(), mock.MagicMock()
+        self.mock_take_batch.side_effect = [[first, second]]
+        paused = mock.Mock()
+        paused.is_set = mock.Mock(side_effect=[False, False, True])
+
+        with mock.patch("lib.worker.get_tube", mock.Mock(side_effect=[mock.MagicMock(), mock.MagicMock()])):
+            with mock.patch("lib.worker.get_redirect_history_from_task", mock.Mock(return_value=False)):
+                with mock.patch("os.path.exists", mock.Mock(side_effect=[True, True, False])):
+                    with mock.patch("time.sleep", mock.Mock()):
+                        worker.worker(config, 13, paused)
+
+        self.writer.put.assert_called_once_with(first, None, None)
+        second.release.assert_called_once_with()
+
+    def test_concurrent_worker_paused_releases_tasks(self):
+        config = mock.Mock()
+        config.WORKER_CONCURRENCY = 2
+        config.QUEUE_TAKE_BATCH = 10
+        config.HOST_SCHEDULER_PATH = None
+        config.RESULT_CACHE_PATH = None
+        task = mock.MagicMock()
+        task.task_id = 1
+        task.data = dict(url="http://first.ru", url_id=1)
+        paused = mock.Mock()
+        paused.is_set = mock.Mock(side_effect=[False, True, True])
+
+        mock_take_batch = mock.Mock(return_value=[task])
+        writer = mock.Mock()
+        engine = mock.Mock()
+        engine.perform = mock.Mock(return_value=[])
+
+        with mock.patch("lib.worker.get_tube", mock.Mock(side_effect=[mock.MagicMock(), mock.MagicMock()])):
+            with mock.patch("lib.worker.take_batch", mock_take_batch):
+                with mock.patch("lib.worker.BatchAcker", mock.Mock()):
+                    with mock.patch("lib.worker.BatchWriter", mock.Mock(return_value=writer)):
+                        with mock.patch("lib.worker.RedirectEngine", mock.Mock(return_value=engine)):
+                            with mock.patch("os.path.exists", mock.Mock(side_effect=[True, True, True, False])):
+                                with mock.patch("time.sleep", mock.Mock()) as mock_sleep:
+                                    worker.concurrent_worker(config, 13, paused)
+
+        self.assertEqual(1, mock_take_batch.call_count)
+        self.assertEqual(1, engine.perform.call_count)
+        engine.cancel.assert_called_once_with()
+        task.release.assert_called_once_with()
+        self.assertFalse(writer.put.called)
+        self.assertEqual(2, mock_sleep.call_count)
+
+    def test_worker_paused_during_check(self):
+        config = mock.Mock()
+        config.HOST_SCHEDULER_PATH = None
+        input_tube = mock.MagicMock()
+        task = mock.MagicMock()
+        input_tube.take = mock.Mock(return_value=task)
+        paused = mock.Mock()
+        paused.is_set = mock.Mock(side_effect=[False, True])
+        result = (True, {'url': 'http://first.ru'})
+
+        with mock.patch("lib.worker.get_tube", mock.Mock(side_effect=[input_tube, mock.MagicMock()])):
+            with mock.patch("lib.worker.get_redirect_history_from_task", mock.Mock(return_value=result)):
+                with mock.patch("lib.worker.complete_task", mock.Mock()) as mock_complete_task:
+                    with mock.patch("os.path.exists", mock.Mock(side_effect=[True, False])):
+                        worker.worker(config, 13, paused)
+
+        task.release.assert_called_once_with()
+        self.assertFalse(mock_complete_task.called)